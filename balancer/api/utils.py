@@ -1,3 +1,11 @@
+import datetime
+import json
+
+from openstack.common import wsgi
+
+from balancer import exception
+
+
 def http_success_code(code):
     """Attaches response code to a method.
 
@@ -10,3 +18,99 @@ def http_success_code(code):
         func.wsgi_code = code
         return func
     return decorator
+
+
+def get_list_params(req, filter_keys=(), sort_keys=('id',)):
+    """Get list arguments for core API calls from request parameters.
+
+    Understands marker, limit, sort_key, sort_dir, fields (a comma
+    separated list of attributes to return) and a parameter for every
+    key in filter_keys.
+    """
+    params = req.params
+    kwargs = {}
+    filters = dict((key, params[key]) for key in filter_keys
+                   if key in params)
+    if filters:
+        kwargs['filters'] = filters
+    if 'marker' in params:
+        kwargs['marker'] = params['marker']
+    if 'limit' in params:
+        try:
+            kwargs['limit'] = int(params['limit'])
+        except ValueError:
+            kwargs['limit'] = -1
+        if kwargs['limit'] < 0:
+            raise exception.InvalidListParameter(
+                    "Invalid limit: %s" % (params['limit'],))
+    if 'sort_key' in params:
+        if params['sort_key'] not in sort_keys:
+            raise exception.InvalidListParameter(
+                    "Invalid sort_key: %s" % (params['sort_key'],))
+        kwargs['sort_key'] = params['sort_key']
+    if 'sort_dir' in params:
+        if params['sort_dir'] not in ('asc', 'desc'):
+            raise exception.InvalidListParameter(
+                    "Invalid sort_dir: %s" % (params['sort_dir'],))
+        kwargs['sort_dir'] = params['sort_dir']
+    if params.get('fields'):
+        fields = set(field.strip() for field in params['fields'].split(','))
+        fields.add('id')
+        kwargs['fields'] = fields
+    return kwargs
+
+
+def _sanitizer(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return obj
+
+
+class StreamingJSONResponseSerializer(wsgi.JSONResponseSerializer):
+    """JSON serializer that writes the response body in chunks.
+
+    Lists are encoded one item at a time, so a long list is never held
+    in memory as a single JSON string.
+    """
+
+    chunk_size = 65536
+
+    def iterencode(self, data, encoder):
+        if isinstance(data, dict):
+            yield '{'
+            for i, (key, value) in enumerate(data.iteritems()):
+                yield '%s%s: ' % (', ' if i else '', encoder.encode(key))
+                for chunk in self.iterencode(value, encoder):
+                    yield chunk
+            yield '}'
+        elif isinstance(data, (list, tuple)):
+            yield '['
+            for i, item in enumerate(data):
+                if i:
+                    yield ', '
+                yield encoder.encode(item)
+            yield ']'
+        else:
+            yield encoder.encode(data)
+
+    def get_chunks(self, data):
+        encoder = json.JSONEncoder(default=_sanitizer)
+        chunk = []
+        size = 0
+        for part in self.iterencode(data, encoder):
+            chunk.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def default(self, response, result):
+        if not isinstance(result, (dict, list, tuple)):
+            # NOTE: keep failing early on results that can't be encoded
+            return super(StreamingJSONResponseSerializer, self).default(
+                    response, result)
+        response.content_type = 'application/json'
+        response.app_iter = self.get_chunks(result)
@@ -26,6 +26,9 @@ import balancer.db.api as db_api
 
 logger = logging.getLogger('balancer.api.v1.devices')
 
+DEVICE_FILTERS = ('name', 'type')
+DEVICE_SORT_KEYS = ('id', 'name', 'type')
+
 
 class Controller(object):
     def __init__(self, conf):
@@ -35,8 +38,10 @@ class Controller(object):
     def index(self,  req):
         try:
             logger.debug("Got index request. Request: %s", req)
-            result = core_api.device_get_index(self.conf)
-            logger.debug("Obtained response: %s" % result)
+            params = utils.get_list_params(req, DEVICE_FILTERS,
+                                           DEVICE_SORT_KEYS)
+            result = core_api.device_get_index(self.conf, **params)
+            logger.debug("Obtained response: %s", result)
             return {'devices': result}
         except exception.NotFound:
             msg = "Element not found"
@@ -75,6 +80,18 @@ class Controller(object):
         except exception.NotFound:
             raise exc.DeviceNotFound
 
+    def show_drift(self, req, **args):
+        logger.debug("Got drift request. Request: %s Id: %s",
+                     req, args['id'])
+        result = core_api.device_show_drift(self.conf, args['id'])
+        return {'drift': result}
+
+    def fix_drift(self, req, **args):
+        logger.debug("Got fix drift request. Request: %s Id: %s",
+                     req, args['id'])
+        result = core_api.device_fix_drift(self.conf, args['id'])
+        return {'drift': result}
+
     def device_status(self, req, **args):
         # NOTE(yorik-sar): broken, there is no processing anymore
         try:
@@ -132,5 +149,5 @@ class Controller(object):
 def create_resource(conf):
     """Devices  resource factory method"""
     deserializer = wsgi.JSONRequestDeserializer()
-    serializer = wsgi.JSONResponseSerializer()
+    serializer = utils.StreamingJSONResponseSerializer()
     return wsgi.Resource(Controller(conf), deserializer, serializer)
@@ -25,6 +25,11 @@ from balancer.db import api as db_api
 
 logger = logging.getLogger('balancer.api.v1.loadbalancers')
 
+LB_FILTERS = ('status', 'name', 'device_id')
+LB_SORT_KEYS = ('id', 'name', 'status', 'created_at', 'updated_at')
+NODE_FILTERS = ('status', 'name', 'address')
+NODE_SORT_KEYS = ('id', 'name', 'status', 'address')
+
 
 class Controller(object):
 
@@ -45,7 +50,8 @@ class Controller(object):
     def index(self, req):
         logger.debug("Got index request. Request: %s", req)
         tenant_id = req.headers.get('X-Tenant-Id', "")
-        result = core_api.lb_get_index(self.conf, tenant_id)
+        params = utils.get_list_params(req, LB_FILTERS, LB_SORT_KEYS)
+        result = core_api.lb_get_index(self.conf, tenant_id, **params)
         return {'loadbalancers': result}
 
     @utils.http_success_code(202)
@@ -91,7 +97,8 @@ class Controller(object):
 
     def showNodes(self, req, **args):
         logger.debug("Got showNodes request. Request: %s", req)
-        return core_api.lb_show_nodes(self.conf, args['id'])
+        params = utils.get_list_params(req, NODE_FILTERS, NODE_SORT_KEYS)
+        return core_api.lb_show_nodes(self.conf, args['id'], **params)
 
     def showNode(self, req, lb_id, lb_node_id):
         logger.debug("Got showNode request. Request: %s", req)
@@ -162,5 +169,5 @@ class Controller(object):
 def create_resource(conf):
     """Loadbalancers resource factory method"""
     deserializer = wsgi.JSONRequestDeserializer()
-    serializer = wsgi.JSONResponseSerializer()
+    serializer = utils.StreamingJSONResponseSerializer()
     return wsgi.Resource(Controller(conf), deserializer, serializer)
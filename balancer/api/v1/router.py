@@ -132,6 +132,12 @@ class API(wsgi.Router):
         mapper.connect("/devices/{id}/info", controller=device_resource,
                        action="device_info")
 
+        mapper.connect("/devices/{id}/drift", controller=device_resource,
+                       action="show_drift", conditions=dict(method=["GET"]))
+
+        mapper.connect("/devices/{id}/drift", controller=device_resource,
+                       action="fix_drift", conditions=dict(method=["POST"]))
+
         mapper.connect("/devices/",
                        controller=device_resource,
                        action="create",
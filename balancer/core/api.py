@@ -22,8 +22,10 @@ import eventlet
 from openstack.common import exception
 import balancer.exception as exc
 
+from balancer.core import cache
 from balancer.core import commands
 from balancer.core import lb_status
+from balancer.core import reconciler
 from balancer.core import scheduller
 from balancer import drivers
 from balancer.loadbalancers import vserver
@@ -44,9 +46,9 @@ def asynchronous(func):
     return _inner
 
 
-def lb_get_index(conf, tenant_id=''):
-    lbs = db_api.loadbalancer_get_all_by_project(conf, tenant_id)
-    lbs = [db_api.unpack_extra(lb) for lb in lbs]
+def lb_get_index(conf, tenant_id='', fields=None, **kwargs):
+    lbs = db_api.loadbalancer_get_all_by_project(conf, tenant_id, **kwargs)
+    lbs = [db_api.unpack_extra(lb, fields) for lb in lbs]
     return lbs
 
 
@@ -56,6 +58,7 @@ def lb_find_for_vm(conf, vm_id, tenant_id=''):
     return lbs
 
 
+@cache.cached('data')
 def lb_get_data(conf, lb_id):
     logger.debug("Getting information about loadbalancer with id: %s" % lb_id)
     lb = db_api.loadbalancer_get(conf, lb_id)
@@ -63,12 +66,14 @@ def lb_get_data(conf, lb_id):
     return db_api.unpack_extra(lb)
 
 
+@cache.cached('details')
 def lb_show_details(conf, lb_id):
     #store = Storage(conf)
     #reader = store.getReader()
 
     lb = vserver.Balancer(conf)
-    lb.loadFromDB(lb_id)
+    with db_api.transaction(conf):
+        lb.loadFromDB(lb_id)
 
     obj = {'loadbalancer':  db_api.unpack_extra(lb.lb)}
     lbobj = obj['loadbalancer']
@@ -85,17 +90,18 @@ def lb_show_details(conf, lb_id):
 def create_lb(conf, **params):
     balancer_instance = vserver.Balancer(conf)
 
-    #Step 1. Parse parameters came from request
-    balancer_instance.parseParams(params)
-    bal_instance = scheduller.Scheduller.Instance(conf)
-    # device = sched.getDevice()
-    device = bal_instance.getDeviceByID(balancer_instance.lb['device_id'])
+    with db_api.transaction(conf):
+        #Step 1. Parse parameters came from request
+        balancer_instance.parseParams(params)
+        bal_instance = scheduller.Scheduller.Instance(conf)
+        # device = sched.getDevice()
+        device = bal_instance.getDeviceByID(balancer_instance.lb['device_id'])
 
-    lb = balancer_instance.getLB()
-    lb['device_id'] = device['id']
+        lb = balancer_instance.getLB()
+        lb['device_id'] = device['id']
 
-    #Step 2. Save config in DB
-    balancer_instance.savetoDB()
+        #Step 2. Save config in DB
+        balancer_instance.savetoDB()
 
     #Step 3. Deploy config to device
     device_driver = drivers.get_device_driver(conf, device['id'])
@@ -121,49 +127,36 @@ def update_lb(conf, lb_id, lb_body):
     old_balancer_instance = vserver.Balancer(conf)
     balancer_instance = vserver.Balancer(conf)
     logger.debug("Loading LB data from DB for Lb id: %s" % lb_id)
-    #TODO add clone function to vserver.Balancer in order to avoid double read
-    balancer_instance.loadFromDB(lb_id)
+    # NOTE: two loads in separate sessions, so that the objects of the old
+    # state are not changed with the new one
     old_balancer_instance.loadFromDB(lb_id)
+    balancer_instance.loadFromDB(lb_id)
 
-    #Step 2. Parse parameters came from request
-    lb = balancer_instance.lb
-    #old_predictor_id = None
-    #port_updated = False
-    for key in lb_body.keys():
-        if hasattr(lb, key):
-            logger.debug("updating attribute %s of LB. Value is %s"\
-            % (key, lb_body[key]))
-            setattr(lb, key, lb_body[key])
-            if key.lower() == "algorithm":
-                #old_predictor_id = balancer_instance.sf._predictor.id
-#                balancer_instance.sf._predictor =\
-#                createPredictor(lb_body[key])
-                balancer_instance.sf._predictor = \
-                db_api.predictor_pack_extra({'type': lb_body[key]})
-            else:
-                logger.debug("Got unknown attribute %s of LB. Value is %s"\
-                % (key, lb_body[key]))
-
-    #Step 3: Save updated data in DB
-    lb.status = lb_status.PENDING_UPDATE
-    balancer_instance.update()
+    #Step 2. Apply parameters came from request
+    with db_api.transaction(conf):
+        balancer_instance.updateParams(lb_body)
 
-    #Step 5. Deploy new config to device
-    device_driver = drivers.get_device_driver(conf, lb['device_id'])
+        #Step 3: Save updated data in DB, removed objects are deleted
+        # after they are undeployed
+        balancer_instance.lb.status = lb_status.PENDING_UPDATE
+        balancer_instance.savetoDB(delete_removed=False)
+
+    #Step 4. Deploy the differences to device
+    device_driver = drivers.get_device_driver(conf,
+                        balancer_instance.lb['device_id'])
     try:
         with device_driver.request_context() as ctx:
             commands.update_loadbalancer(ctx, old_balancer_instance,
                     balancer_instance)
-    except:
-        old_balancer_instance.lb.status = lb_status.ERROR
-        old_balancer_instance.update()
+    except Exception:
+        logger.exception("Failed to update loadbalancer %s", lb_id)
+        balancer_instance.lb.status = lb_status.ERROR
+        balancer_instance.update()
         return
 
-    #balancer_instance.lb.status =\
-    #    balancer.loadbalancers.loadbalancer.LB_ACTIVE_STATUS
-    #balancer_instance.update()
-    #self._task.status = STATUS_DONE
-    return lb['id']
+    balancer_instance.lb.status = lb_status.ACTIVE
+    balancer_instance.update()
+    return lb_id
 
 
 def delete_lb(conf, lb_id):
@@ -182,56 +175,59 @@ def delete_lb(conf, lb_id):
     with device_driver.request_context() as ctx:
         commands.delete_loadbalancer(ctx, balancer_instance)
 
-    balancer_instance.removeFromDB()
+    with db_api.transaction(conf):
+        balancer_instance.removeFromDB()
     return
 
 
 def lb_add_nodes(conf, lb_id, lb_nodes):
-    id_list = []
     balancer_instance = vserver.Balancer(conf)
-
-    for lb_node in lb_nodes:
-        logger.debug("Got new node description %s" % lb_node)
+    with db_api.transaction(conf):
         balancer_instance.loadFromDB(lb_id)
-        balancer_instance.removeFromDB()
-
-        rs = db_api.server_pack_extra(lb_node)
-        rs['sf_id'] = balancer_instance.sf['id']
+        device_id = balancer_instance.lb['device_id']
+
+        # We need to check if there is already real server with the
+        # same IP deployed
+        parent_refs = db_api.server_get_all_by_address_on_device(conf,
+                [lb_node.get('address') for lb_node in lb_nodes], device_id)
+        rs_list = []
+        for lb_node in lb_nodes:
+            logger.debug("Got new node description %s" % lb_node)
+            rs = db_api.server_pack_extra(lb_node)
+            rs['sf_id'] = balancer_instance.sf['id']
+            parent_ref = parent_refs.get(rs['address'])
+            if parent_ref is not None and parent_ref.get('address') != '':
+                rs['parent_id'] = parent_ref['id']
+            rs_list.append(rs)
+
+        rs_list = db_api.server_create_all(conf, rs_list)
+    balancer_instance.rs.extend(rs_list)
+    balancer_instance.sf._rservers.extend(rs_list)
 
-        balancer_instance.rs.append(rs)
-        balancer_instance.sf._rservers.append(rs)
-        balancer_instance.savetoDB()
-
-        rs = balancer_instance.rs[-1]
-        device_driver = drivers.get_device_driver(conf, balancer_instance.\
-                                                        lb['device_id'])
+    device_driver = drivers.get_device_driver(conf, device_id)
+    with device_driver.request_context() as ctx:
+        commands.add_nodes_to_loadbalancer(ctx, balancer_instance, rs_list)
 
-        with device_driver.request_context() as ctx:
-            commands.add_node_to_loadbalancer(ctx, balancer_instance, rs)
+    return {'nodes': [{'id': rs['id']} for rs in rs_list]}
 
-        id_list.append({'id': rs['id']})
 
-    return {'nodes': id_list}
-
-
-def lb_show_nodes(conf, lb_id):
-    balancer_instance = vserver.Balancer(conf)
-    nodes = {'nodes': []}
-    balancer_instance.loadFromDB(lb_id)
-    for rs in balancer_instance.rs:
-        rs_dict = db_api.unpack_extra(rs)
-        nodes['nodes'].append(rs_dict)
-    return nodes
+def lb_show_nodes(conf, lb_id, fields=None, **kwargs):
+    sf_refs = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)
+    if not sf_refs:
+        raise exc.LoadBalancerNotFound(loadbalancer_id=lb_id)
+    rs_refs = db_api.server_get_all_by_sf_id(conf, sf_refs[0]['id'], **kwargs)
+    return {'nodes': [db_api.unpack_extra(rs, fields) for rs in rs_refs]}
 
 
 def lb_delete_node(conf, lb_id, lb_node_id):
     balancer_instance = vserver.Balancer(conf)
-    #Step 1: Load balancer from DB
-    balancer_instance.loadFromDB(lb_id)
-    #Step 3: Get RS object from DB
-    rs = db_api.server_get(conf, lb_node_id)
-    #Step 4: Delete RS from DB
-    db_api.server_destroy(conf, lb_node_id)
+    with db_api.transaction(conf):
+        #Step 1: Load balancer from DB
+        balancer_instance.loadFromDB(lb_id)
+        #Step 3: Get RS object from DB
+        rs = db_api.server_get(conf, lb_node_id)
+        #Step 4: Delete RS from DB
+        db_api.server_destroy(conf, lb_node_id)
 
     #Step 5: Delete real server from device
     device_driver = drivers.get_device_driver(conf,
@@ -243,9 +239,9 @@ def lb_delete_node(conf, lb_id, lb_node_id):
 
 def lb_change_node_status(conf, lb_id, lb_node_id, lb_node_status):
     balancer_instance = vserver.Balancer(conf)
-    balancer_instance.loadFromDB(lb_id)
-
-    rs = db_api.server_get(conf, lb_node_id)
+    with db_api.transaction(conf):
+        balancer_instance.loadFromDB(lb_id)
+        rs = db_api.server_get(conf, lb_node_id)
     sf = balancer_instance.sf
     if rs['state'] == lb_node_status:
         return "OK"
@@ -255,7 +251,7 @@ def lb_change_node_status(conf, lb_id, lb_node_id, lb_node_status):
     if rs['parent_id'] != "":
         rs['name'] = rs['parent_id']
     logger.debug("Changing RServer status to: %s" % lb_node_status)
-    device_driver = drivers.get_device_driver(
+    device_driver = drivers.get_device_driver(conf,
                         balancer_instance.lb['device_id'])
     with device_driver.request_context() as ctx:
         if lb_node_status == "inservice":
@@ -269,27 +265,29 @@ def lb_change_node_status(conf, lb_id, lb_node_id, lb_node_status):
 
 
 def lb_update_node(conf, lb_id, lb_node_id, lb_node):
-    rs = db_api.server_get(conf, lb_node_id)
+    with db_api.transaction(conf):
+        rs = db_api.server_get(conf, lb_node_id)
+        old_rs = dict(rs.iteritems())
+        lb = db_api.loadbalancer_get(conf, lb_id)
+        sf = db_api.serverfarm_get(conf, rs['sf_id'])
 
-    lb = db_api.loadbalancer_get(conf, lb_id)
     device_driver = drivers.get_device_driver(conf, lb['device_id'])
-    sf = db_api.serverfarm_get(conf, rs['sf_id'])
 
     with device_driver.request_context() as ctx:
-        commands.delete_rserver_from_server_farm(ctx, sf, rs)
         rs.update(lb_node)
         new_rs = db_api.server_update(conf, rs['id'], rs)
-        commands.add_rserver_to_server_farm(ctx, sf, new_rs)
+        commands.update_rserver_in_server_farm(ctx, sf, old_rs, new_rs)
     return db_api.unpack_extra(new_rs)
 
 
 def lb_show_probes(conf, lb_id):
-    try:
-        sf_ref = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
-    except IndexError:
-        raise exc.ServerFarmNotFound
+    with db_api.transaction(conf):
+        try:
+            sf_ref = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
+        except IndexError:
+            raise exc.ServerFarmNotFound
 
-    probes = db_api.probe_get_all_by_sf_id(conf, sf_ref['id'])
+        probes = db_api.probe_get_all_by_sf_id(conf, sf_ref['id'])
 
     list = []
     dict = {"healthMonitoring": {}}
@@ -306,15 +304,15 @@ def lb_add_probe(conf, lb_id, lb_probe):
 
     balancer_instance = vserver.Balancer(conf)
 
-    balancer_instance.loadFromDB(lb_id)
-    balancer_instance.removeFromDB()
+    with db_api.transaction(conf):
+        balancer_instance.loadFromDB(lb_id)
 
-    prb = db_api.probe_pack_extra(lb_probe)
-    prb['sf_id'] = balancer_instance.sf['id']
+        prb = db_api.probe_pack_extra(lb_probe)
+        prb['sf_id'] = balancer_instance.sf['id']
 
-    balancer_instance.probes.append(prb)
-    balancer_instance.sf._probes.append(prb)
-    balancer_instance.savetoDB()
+        balancer_instance.probes.append(prb)
+        balancer_instance.sf._probes.append(prb)
+        balancer_instance.savetoDB()
 
     prb = balancer_instance.probes[-1]
 
@@ -329,15 +327,16 @@ def lb_add_probe(conf, lb_id, lb_probe):
 def lb_delete_probe(conf, lb_id, probe_id):
     balancer_instance = vserver.Balancer(conf)
 
-    #Step 1: Load balancer from DB
-    balancer_instance.loadFromDB(lb_id)
+    with db_api.transaction(conf):
+        #Step 1: Load balancer from DB
+        balancer_instance.loadFromDB(lb_id)
 
-    #Step 2: Get reader and writer
-    #Step 3: Get RS object from DB
-    prb = db_api.probe_get(conf, probe_id)
+        #Step 2: Get reader and writer
+        #Step 3: Get RS object from DB
+        prb = db_api.probe_get(conf, probe_id)
 
-    #Step 4: Delete RS from DB
-    db_api.probe_destroy(conf, probe_id)
+        #Step 4: Delete RS from DB
+        db_api.probe_destroy(conf, probe_id)
 
     #Step 5: Delete real server from device
     device_driver = drivers.get_device_driver(conf,
@@ -348,12 +347,13 @@ def lb_delete_probe(conf, lb_id, probe_id):
 
 
 def lb_show_sticky(conf, lb_id):
-    try:
-        sf_ref = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
-    except IndexError:
-        raise  exc.ServerFarmNotFound
+    with db_api.transaction(conf):
+        try:
+            sf_ref = db_api.serverfarm_get_all_by_lb_id(conf, lb_id)[0]
+        except IndexError:
+            raise  exc.ServerFarmNotFound
 
-    stickies = db_api.sticky_get_all_by_sf_id(conf, sf_ref['id'])
+        stickies = db_api.sticky_get_all_by_sf_id(conf, sf_ref['id'])
 
     list = []
     dict = {"sessionPersistence": {}}
@@ -370,14 +370,14 @@ def lb_add_sticky(conf, lb_id, sticky):
 
     balancer_instance = vserver.Balancer(conf)
 
-    balancer_instance.loadFromDB(lb_id)
-    balancer_instance.removeFromDB()
+    with db_api.transaction(conf):
+        balancer_instance.loadFromDB(lb_id)
 
-    st = db_api.sticky_pack_extra(sticky)
-    st['sf_id'] = balancer_instance.sf['id']
+        st = db_api.sticky_pack_extra(sticky)
+        st['sf_id'] = balancer_instance.sf['id']
 
-    balancer_instance.sf._sticky.append(st)
-    balancer_instance.savetoDB()
+        balancer_instance.sf._sticky.append(st)
+        balancer_instance.savetoDB()
 
     st = balancer_instance.sf._sticky[-1]
 
@@ -391,15 +391,16 @@ def lb_add_sticky(conf, lb_id, sticky):
 def lb_delete_sticky(conf, lb_id, sticky_id):
     balancer_instance = vserver.Balancer(conf)
 
-    #Step 1: Load balancer from DB
-    balancer_instance.loadFromDB(lb_id)
+    with db_api.transaction(conf):
+        #Step 1: Load balancer from DB
+        balancer_instance.loadFromDB(lb_id)
 
-    #Step 2: Get reader and writer
-    #Step 3: Get sticky object from DB
-    st = db_api.sticky_get(conf, sticky_id)
+        #Step 2: Get reader and writer
+        #Step 3: Get sticky object from DB
+        st = db_api.sticky_get(conf, sticky_id)
 
-    #Step 4: Delete sticky from DB
-    db_api.sticky_destroy(conf, sticky_id)
+        #Step 4: Delete sticky from DB
+        db_api.sticky_destroy(conf, sticky_id)
 
     #Step 5: Delete real server from device
     device_driver = drivers.get_device_driver(conf,
@@ -409,9 +410,9 @@ def lb_delete_sticky(conf, lb_id, sticky_id):
     return sticky_id
 
 
-def device_get_index(conf):
-    devices = db_api.device_get_all(conf)
-    devices = [db_api.unpack_extra(dev) for dev in devices]
+def device_get_index(conf, fields=None, **kwargs):
+    devices = db_api.device_get_all(conf, **kwargs)
+    devices = [db_api.unpack_extra(dev, fields) for dev in devices]
     return devices
 
 
@@ -422,6 +423,14 @@ def device_create(conf, **params):
     return device['id']
 
 
+def device_show_drift(conf, device_id):
+    return reconciler.get_report(conf, device_id)
+
+
+def device_fix_drift(conf, device_id):
+    return reconciler.reconcile_device(conf, device_id, fix=True)
+
+
 def device_info(params):
     query = params['query_params']
     logger.debug("DeviceInfoWorker start with Params: %s Query: %s",
@@ -0,0 +1,179 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Read-through cache of load balancer data served by the API.
+
+Entries are keyed by load balancer id and a generation token.  Every
+database change of a load balancer aggregate replaces the token of that
+load balancer once the change is committed, so entries written from data
+read before the change are never returned again.
+"""
+
+import collections
+import copy
+import functools
+import logging
+import threading
+import time
+import uuid
+
+from balancer.common import cfg
+from balancer.db import session as db_session
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_GROUP_NAME = 'cache'
+CACHE_OPTIONS = (
+    # One of 'memory', 'memcached' or 'none'
+    cfg.StrOpt('backend', default='memory'),
+    cfg.IntOpt('max_size', default=1024),
+    cfg.IntOpt('ttl', default=300),
+    cfg.ListOpt('memcached_servers', default=['127.0.0.1:11211']),
+)
+
+CACHE = None
+CACHE_BACKEND = None
+
+
+class NullCache(object):
+    """Backend that stores nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+class MemoryCache(object):
+    """In-process LRU backend with expiration."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                return None
+            self._data[key] = item
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        item = (time.time() + self.ttl, copy.deepcopy(value))
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = item
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class MemcachedCache(object):
+    """Backend that keeps entries in memcached, shared by all workers."""
+
+    def __init__(self, servers, ttl):
+        if memcache is None:
+            raise RuntimeError("python-memcached is required for the "
+                               "memcached cache backend")
+        self.ttl = ttl
+        self._client = memcache.Client(servers)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value):
+        self._client.set(key, value, time=self.ttl)
+
+
+def register_conf_opts(conf, options=CACHE_OPTIONS, group=CACHE_GROUP_NAME):
+    """Register cache options."""
+
+    conf.register_group(cfg.OptGroup(name=group))
+    conf.register_opts(options, group=group)
+
+
+def get_cache(conf):
+    """Return the cache backend selected in the configuration."""
+    global CACHE, CACHE_BACKEND
+
+    register_conf_opts(conf)
+    backend = conf.cache.backend
+    if CACHE is None or CACHE_BACKEND != backend:
+        if backend == 'memory':
+            CACHE = MemoryCache(conf.cache.max_size, conf.cache.ttl)
+        elif backend == 'memcached':
+            CACHE = MemcachedCache(conf.cache.memcached_servers,
+                                   conf.cache.ttl)
+        elif backend == 'none':
+            CACHE = NullCache()
+        else:
+            raise ValueError("Unknown cache backend: %s" % (backend,))
+        CACHE_BACKEND = backend
+    return CACHE
+
+
+def _get_generation(cache, lb_id):
+    key = 'balancer/lb/%s' % (lb_id,)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.set(key, generation)
+    return generation
+
+
+def invalidate(conf, lb_ids):
+    """Drop cached data of load balancers."""
+    cache = get_cache(conf)
+    for lb_id in lb_ids:
+        cache.set('balancer/lb/%s' % (lb_id,), uuid.uuid4().hex)
+
+
+db_session.add_change_listener(invalidate)
+
+
+def cached(view):
+    """Cache results of a function of (conf, lb_id) per load balancer."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def _inner(conf, lb_id):
+            # NOTE: uncommitted data of an open transaction is not cached
+            if getattr(db_session._LOCAL, 'session', None) is not None:
+                return func(conf, lb_id)
+            cache = get_cache(conf)
+            generation = _get_generation(cache, lb_id)
+            key = 'balancer/lb/%s/%s/%s' % (lb_id, generation, view)
+            result = cache.get(key)
+            if result is None:
+                result = func(conf, lb_id)
+                cache.set(key, result)
+            else:
+                logger.debug("Cache hit for %s of loadbalancer %s",
+                             view, lb_id)
+            return result
+        return _inner
+    return decorator
@@ -15,10 +15,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import functools
 import logging
 import types
 
+from balancer.core import executor
 from balancer.db import api as db_api
 
 LOG = logging.getLogger(__name__)
@@ -50,7 +52,7 @@ class RollbackContextManager(object):
         while rollback_stack:
             rollback_stack.pop()(good)
         if not good:
-            raise exc_value, exc_type, exc_tb
+            raise exc_type, exc_value, exc_tb
 
 
 class Rollback(Exception):
@@ -183,6 +185,21 @@ def delete_rserver_from_server_farm(ctx, server_farm, rserver):
     ctx.device.delete_real_server_from_server_farm(server_farm, rserver)
 
 
+@with_rollback
+def update_rserver_in_server_farm(ctx, server_farm, old_rserver, new_rserver):
+    try:
+        if (new_rserver.get('parent_id') and new_rserver['parent_id'] != ""):
+            old_rserver['name'] = new_rserver['name'] = \
+                    new_rserver['parent_id']
+        ctx.device.update_real_server_in_server_farm(server_farm,
+                                                     old_rserver, new_rserver)
+        yield
+    except Exception:
+        ctx.device.update_real_server_in_server_farm(server_farm,
+                                                     new_rserver, old_rserver)
+        raise
+
+
 @ignore_exceptions
 def delete_probe(ctx, probe):
     ctx.device.delete_probe(probe)
@@ -249,9 +266,8 @@ def create_loadbalancer(ctx, balancer):
         create_probe(ctx,  probe)
     port = 80
     create_server_farm(ctx, balancer.sf)
+    add_nodes_to_loadbalancer(ctx, balancer, balancer.rs)
     for rserver in balancer.rs:
-        create_rserver(ctx, rserver)
-        add_rserver_to_server_farm(ctx, balancer.sf, rserver)
         port = rserver['port']
     for probe in balancer.probes:
         probe['port'] = port
@@ -267,9 +283,7 @@ def delete_loadbalancer(ctx, balancer):
 #    for pr in balancer.probes:
 #        DeleteProbeFromSFCommand(driver,  context,  balancer.sf,  pr)
 #        DeleteProbeCommand(driver,  context,  pr)
-    for rserver in balancer.rs:
-        delete_rserver_from_server_farm(ctx, balancer.sf, rserver)
-        delete_rserver(ctx, rserver)
+    remove_nodes_from_loadbalancer(ctx, balancer, balancer.rs)
     for probe in balancer.probes:
         remove_probe_from_server_farm(ctx, balancer.sf, probe)
         delete_probe(ctx, probe)
@@ -278,9 +292,117 @@ def delete_loadbalancer(ctx, balancer):
     delete_server_farm(ctx, balancer.sf)
 
 
+# NOTE: these fields are kept in the database only, changes in them are
+# not deployed
+_NOT_DEPLOYED_FIELDS = frozenset(['deployed', 'status', 'created_at',
+                                  'updated_at'])
+
+
+def _get_deployed_values(ref, ignore=()):
+    return dict((key, value) for key, value in ref.iteritems()
+                if key not in _NOT_DEPLOYED_FIELDS and key not in ignore)
+
+
+def _diff(old_refs, new_refs, ignore=()):
+    """Match objects by id, return (added, removed, changed).
+
+    changed is a list of (old, new) pairs of objects with different
+    deployed values, fields in ignore are not compared.
+    """
+    old_by_id = dict((ref['id'], ref) for ref in old_refs)
+    new_ids = set()
+    added, changed = [], []
+    for ref in new_refs:
+        if ref['id'] in new_ids:
+            continue
+        new_ids.add(ref['id'])
+        old_ref = old_by_id.get(ref['id'])
+        if old_ref is None:
+            added.append(ref)
+        elif (_get_deployed_values(old_ref, ignore) !=
+                _get_deployed_values(ref, ignore)):
+            changed.append((old_ref, ref))
+    removed = []
+    for ref in old_refs:
+        if ref['id'] not in new_ids:
+            new_ids.add(ref['id'])
+            removed.append(ref)
+    return added, removed, changed
+
+
+def _server_farm_changed(old_sf, new_sf):
+    return (_get_deployed_values(old_sf) != _get_deployed_values(new_sf) or
+            _get_deployed_values(old_sf._predictor) !=
+            _get_deployed_values(new_sf._predictor))
+
+
+@with_rollback
+def update_server_farm(ctx, old_sf, new_sf):
+    try:
+        # NOTE: drivers change options of an existing server farm in place,
+        # its real servers and probes are kept
+        ctx.device.create_server_farm(new_sf, new_sf._predictor)
+        yield
+    except Exception:
+        ctx.device.create_server_farm(old_sf, old_sf._predictor)
+        raise
+
+
+def _update_node(ctx, balancer, old_rserver, new_rserver):
+    if (_get_deployed_values(old_rserver, ['state']) !=
+            _get_deployed_values(new_rserver, ['state'])):
+        # NOTE: copies, the command changes names of real servers with
+        # a parent
+        update_rserver_in_server_farm(ctx, balancer.sf,
+                                      dict(old_rserver.iteritems()),
+                                      dict(new_rserver.iteritems()))
+    state = (new_rserver['state'] or '').lower()
+    if state != (old_rserver['state'] or '').lower():
+        rserver = dict(new_rserver.iteritems())
+        if rserver.get('parent_id'):
+            rserver['name'] = rserver['parent_id']
+        if state == 'inservice':
+            activate_rserver(ctx, balancer.sf, rserver)
+        else:
+            suspend_rserver(ctx, balancer.sf, rserver)
+
+
 def update_loadbalancer(ctx, old_bal,  new_bal):
-    if old_bal.lb.algorithm != new_bal.lb.algorithm:
-        create_server_farm(ctx, new_bal.sf)
+    """Deploy the differences between two states of a load balancer.
+
+    Objects are matched by id. Removed objects are undeployed first, then
+    the server farm and nodes are changed and new objects are deployed.
+    Changed probes, stickies and VIPs are deployed again, the drivers
+    can't change them in place.
+    """
+    rs_added, rs_removed, rs_changed = _diff(old_bal.rs, new_bal.rs)
+    pr_added, pr_removed, pr_changed = _diff(old_bal.probes, new_bal.probes)
+    st_added, st_removed, st_changed = _diff(old_bal.sf._sticky,
+                                             new_bal.sf._sticky)
+    vip_added, vip_removed, vip_changed = _diff(old_bal.vips, new_bal.vips)
+
+    for vip in vip_removed + [old for old, new in vip_changed]:
+        delete_vip(ctx, vip)
+    for sticky in st_removed + [old for old, new in st_changed]:
+        remove_sticky_from_loadbalancer(ctx, old_bal, sticky)
+    for probe in pr_removed + [old for old, new in pr_changed]:
+        makeDeleteProbeFromLBChain(ctx, old_bal, probe)
+    if rs_removed:
+        remove_nodes_from_loadbalancer(ctx, old_bal, rs_removed)
+
+    if _server_farm_changed(old_bal.sf, new_bal.sf):
+        update_server_farm(ctx, old_bal.sf, new_bal.sf)
+    for old_rserver, new_rserver in rs_changed:
+        _update_node(ctx, new_bal, old_rserver, new_rserver)
+    if rs_added:
+        add_nodes_to_loadbalancer(ctx, new_bal, rs_added)
+
+    for probe in pr_added + [new for old, new in pr_changed]:
+        add_probe_to_loadbalancer(ctx, new_bal, probe)
+    for sticky in st_added + [new for old, new in st_changed]:
+        add_sticky_to_loadbalancer(ctx, new_bal, sticky)
+    for vip in vip_added + [new for old, new in vip_changed]:
+        create_vip(ctx, vip, new_bal.sf)
 
 
 def add_node_to_loadbalancer(ctx, balancer, rserver):
@@ -293,6 +415,35 @@ def remove_node_from_loadbalancer(ctx, balancer, rserver):
     delete_rserver(ctx, rserver)
 
 
+def _group_by_address(rservers):
+    # Real servers with the same address share one parent on the device,
+    # so they are processed one by one in the same step
+    groups = collections.OrderedDict()
+    for rserver in rservers:
+        groups.setdefault(rserver['address'], []).append(rserver)
+    return groups.values()
+
+
+def _add_nodes(ctx, balancer, rservers):
+    for rserver in rservers:
+        add_node_to_loadbalancer(ctx, balancer, rserver)
+
+
+def _remove_nodes(ctx, balancer, rservers):
+    for rserver in rservers:
+        remove_node_from_loadbalancer(ctx, balancer, rserver)
+
+
+def add_nodes_to_loadbalancer(ctx, balancer, rservers):
+    executor.execute_parallel(ctx, _add_nodes,
+            [(balancer, group) for group in _group_by_address(rservers)])
+
+
+def remove_nodes_from_loadbalancer(ctx, balancer, rservers):
+    executor.execute_parallel(ctx, _remove_nodes,
+            [(balancer, group) for group in _group_by_address(rservers)])
+
+
 def add_probe_to_loadbalancer(ctx, balancer, probe):
     create_probe(ctx, probe)
     add_probe_to_server_farm(ctx, balancer.sf, probe)
@@ -0,0 +1,147 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import sys
+
+import contextlib
+
+import eventlet
+from eventlet import corolocal
+from eventlet import greenthread
+from eventlet import semaphore
+
+from balancer.common import cfg
+
+LOG = logging.getLogger(__name__)
+
+executor_opts = [
+    cfg.IntOpt('device_parallel_operations', default=4,
+               help='Maximum number of command steps executed on one '
+                    'device at the same time.'),
+]
+
+DEVICE_SEMAPHORES = {}
+
+_LOCAL = corolocal.local()
+
+
+def current_context():
+    """Return the request or step context the green thread works in."""
+    return getattr(_LOCAL, 'context', None)
+
+
+@contextlib.contextmanager
+def bind_context(ctx):
+    """Make ctx the context of the current green thread in the block."""
+    previous = current_context()
+    _LOCAL.context = ctx
+    try:
+        yield ctx
+    finally:
+        _LOCAL.context = previous
+
+
+def request_owner():
+    """Return the identity of the request the green thread works for.
+
+    Green threads running steps of a request share the identity of the
+    request, outside of a request every green thread is its own owner.
+    """
+    ctx = current_context()
+    if ctx is None:
+        return greenthread.getcurrent()
+    return ctx.owner
+
+
+class StepContext(object):
+    """Context of one step, collects rollbacks added by the step.
+
+    Everything else, the owner of the request included, is taken from the
+    request context.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.rollback_stack = []
+
+    def add_rollback(self, rollback):
+        self.rollback_stack.append(self.device.wrap_rollback(rollback))
+
+    def __getattr__(self, name):
+        return getattr(self.parent, name)
+
+
+def get_device_semaphore(conf, device):
+    try:
+        return DEVICE_SEMAPHORES[device]
+    except KeyError:
+        conf.register_opts(executor_opts)
+        sem = semaphore.Semaphore(conf.device_parallel_operations)
+        return DEVICE_SEMAPHORES.setdefault(device, sem)
+
+
+def execute_parallel(ctx, func, args_list):
+    """Execute func(ctx, *args) for every args in green threads.
+
+    Steps must be independent of each other and must not call
+    execute_parallel themselves. At most device_parallel_operations steps
+    run on one device at the same time, over all requests. When all steps
+    are done, their rollbacks are added to ctx in the order of args_list,
+    as if the steps were executed one by one, and the first error is
+    raised.
+
+    What drivers can rely on:
+
+    * ctx is the context of a device request, steps run within it. Each
+      step runs in its own green thread bound to a StepContext, so
+      current_context() returns the step context and request_owner()
+      the owner of the request. State of a request must be kept per
+      request owner, not per thread, see base_driver.RequestLock.
+    * A rollback added by a step is passed to the wrap_rollback() hook
+      of the driver right away, in the green thread of the step. It
+      reaches ctx.rollback_stack only when all steps are done, so the
+      position of a rollback in the stack means nothing to the driver.
+    """
+    if current_context() is None:
+        raise RuntimeError("Steps must be executed within a device request")
+    if (isinstance(ctx, StepContext) or
+            isinstance(current_context(), StepContext)):
+        raise RuntimeError("Steps must not execute steps themselves")
+    args_list = list(args_list)
+    sem = get_device_semaphore(ctx.conf, ctx.device)
+
+    def run_step(args):
+        step_ctx = StepContext(ctx)
+        with sem:
+            try:
+                with bind_context(step_ctx):
+                    func(step_ctx, *args)
+            except Exception:
+                LOG.exception("Step %s%r failed", func.__name__, args)
+                return step_ctx, sys.exc_info()
+        return step_ctx, None
+
+    pool = eventlet.GreenPool(max(len(args_list), 1))
+    error = None
+    for step_ctx, exc_info in pool.imap(run_step, args_list):
+        for rollback in step_ctx.rollback_stack:
+            ctx.add_rollback(rollback)
+        if error is None:
+            error = exc_info
+    if error is not None:
+        raise error[0], error[1], error[2]
@@ -0,0 +1,346 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Detection and repair of drift between the database and devices.
+
+Objects marked as deployed in the database are compared with the state
+the driver reads from the device in bulk. Every difference is reported
+with the action that fixes it, if there is one: missing objects are
+created again and real servers in a wrong state are activated or
+suspended through the commands layer. Objects found only on the device
+are reported and never removed, they may be not ours.
+"""
+
+import datetime
+import logging
+
+import eventlet
+
+from balancer.common import cfg
+from balancer.core import commands
+from balancer.db import api as db_api
+from balancer import drivers
+from balancer import exception
+from balancer.loadbalancers import vserver
+
+LOG = logging.getLogger(__name__)
+
+RECONCILER_GROUP_NAME = 'reconciler'
+RECONCILER_OPTIONS = (
+    # Seconds between checks of all devices, 0 disables periodic checks.
+    # Every process that reads the option runs the checks, so enable it in
+    # one process only
+    cfg.IntOpt('interval', default=0),
+    cfg.IntOpt('concurrency', default=2),
+    # Fix drift found by periodic checks, not only report it
+    cfg.BoolOpt('auto_fix', default=False),
+)
+
+MISSING = 'missing'
+STATE = 'state'
+UNEXPECTED = 'unexpected'
+
+REPORTS = {}
+
+
+def register_conf_opts(conf, options=RECONCILER_OPTIONS,
+                       group=RECONCILER_GROUP_NAME):
+    """Register reconciler options."""
+
+    conf.register_group(cfg.OptGroup(name=group))
+    conf.register_opts(options, group=group)
+
+
+def _rserver_name(rserver):
+    # NOTE: real servers with a parent are deployed under the parent id,
+    # see commands.add_rserver_to_server_farm
+    return rserver.get('parent_id') or rserver['name']
+
+
+def _is_deployed(ref):
+    return ref['deployed'] == 'True'
+
+
+def _entry(balancer, kind, ref, name, problem, action, **kwargs):
+    entry = {
+        'lb_id': balancer.lb['id'] if balancer is not None else None,
+        'kind': kind,
+        'id': ref['id'] if ref is not None else None,
+        'name': name,
+        'problem': problem,
+        'action': action,
+    }
+    entry.update(kwargs)
+    return entry
+
+
+def compute_plan(balancers, state):
+    """Return the differences between balancers and the device state.
+
+    The plan is a list of (entry, balancer, ref) in the order the actions
+    must be applied, entry is a dict describing the difference.
+    """
+    plan = []
+    expected = dict((kind, set()) for kind in state)
+    for balancer in balancers:
+        sf = balancer.sf
+        sf_name = sf['name']
+        if 'serverfarm' in state and _is_deployed(sf):
+            expected['serverfarm'].add(sf_name)
+            if sf_name not in state['serverfarm']:
+                plan.append((_entry(balancer, 'serverfarm', sf, sf_name,
+                                    MISSING, 'create_server_farm'),
+                             balancer, sf))
+        if 'probe' in state:
+            for probe in balancer.probes:
+                if not _is_deployed(probe):
+                    continue
+                expected['probe'].add(probe['name'])
+                if probe['name'] not in state['probe']:
+                    plan.append((_entry(balancer, 'probe', probe,
+                                        probe['name'], MISSING,
+                                        'create_probe'),
+                                 balancer, probe))
+        if 'rserver' in state and _is_deployed(sf):
+            for rserver in balancer.rs:
+                key = (sf_name, _rserver_name(rserver))
+                if key in expected['rserver']:
+                    continue
+                expected['rserver'].add(key)
+                actual = state['rserver'].get(key)
+                if actual is None:
+                    plan.append((_entry(balancer, 'rserver', rserver,
+                                        key[1], MISSING, 'add_node'),
+                                 balancer, rserver))
+                elif (rserver['state'] and actual.get('state') and
+                        rserver['state'].lower() != actual['state']):
+                    if rserver['state'].lower() == 'inservice':
+                        action = 'activate_rserver'
+                    else:
+                        action = 'suspend_rserver'
+                    plan.append((_entry(balancer, 'rserver', rserver,
+                                        key[1], STATE, action,
+                                        expected=rserver['state'],
+                                        actual=actual['state']),
+                                 balancer, rserver))
+        if 'vip' in state:
+            for vip in balancer.vips:
+                if not _is_deployed(vip):
+                    continue
+                expected['vip'].add(vip['name'])
+                if vip['name'] not in state['vip']:
+                    plan.append((_entry(balancer, 'vip', vip, vip['name'],
+                                        MISSING, 'create_vip'),
+                                 balancer, vip))
+    managed_sfs = expected.get('serverfarm', set())
+    for kind in sorted(state):
+        for name in sorted(set(state[kind]) - expected[kind]):
+            if kind == 'rserver':
+                if name[0] not in managed_sfs:
+                    continue
+                name = name[1]
+            plan.append((_entry(None, kind, None, name, UNEXPECTED, None),
+                         None, None))
+    return plan
+
+
+def _create_server_farm(ctx, balancer, sf):
+    commands.create_server_farm(ctx, sf)
+
+
+def _create_probe(ctx, balancer, probe):
+    commands.add_probe_to_loadbalancer(ctx, balancer, probe)
+
+
+def _add_node(ctx, balancer, rserver):
+    commands.add_node_to_loadbalancer(ctx, balancer, rserver)
+
+
+def _activate_rserver(ctx, balancer, rserver):
+    commands.activate_rserver(ctx, balancer.sf, rserver)
+
+
+def _suspend_rserver(ctx, balancer, rserver):
+    commands.suspend_rserver(ctx, balancer.sf, rserver)
+
+
+def _create_vip(ctx, balancer, vip):
+    commands.create_vip(ctx, vip, balancer.sf)
+
+
+ACTIONS = {
+    'create_server_farm': _create_server_farm,
+    'create_probe': _create_probe,
+    'add_node': _add_node,
+    'activate_rserver': _activate_rserver,
+    'suspend_rserver': _suspend_rserver,
+    'create_vip': _create_vip,
+}
+
+
+def _recheck(driver, lb_id, steps):
+    """Return the steps of a balancer that are still needed.
+
+    The balancer is read again and compared with the device state, the
+    returned steps carry the fresh balancer and refs.
+    """
+    balancer = _load_balancer(driver.conf, driver.device_ref['id'], lb_id)
+    if balancer is None:
+        return []
+    fresh = {}
+    for entry, fresh_balancer, ref in compute_plan(
+            [balancer], driver.get_device_state()):
+        if entry['action'] is not None:
+            key = (entry['kind'], entry['id'], entry['action'])
+            fresh[key] = (fresh_balancer, ref)
+    result = []
+    for entry, old_balancer, old_ref in steps:
+        key = (entry['kind'], entry['id'], entry['action'])
+        if key in fresh:
+            result.append((entry,) + fresh[key])
+    return result
+
+
+def apply_plan(driver, plan):
+    """Apply the actions of a plan, in one device request per balancer.
+
+    Within the request the balancer is checked again and only the drift
+    still there is fixed, the other entries are marked stale. A failed
+    balancer is rolled back and the error is recorded in its entries, the
+    other balancers are still fixed.
+    """
+    steps = {}
+    order = []
+    for entry, balancer, ref in plan:
+        if entry['action'] is None:
+            continue
+        lb_id = entry['lb_id']
+        if lb_id not in steps:
+            steps[lb_id] = []
+            order.append(lb_id)
+        steps[lb_id].append((entry, balancer, ref))
+    for lb_id in order:
+        try:
+            with driver.request_context() as ctx:
+                todo = _recheck(driver, lb_id, steps[lb_id])
+                for entry, balancer, ref in todo:
+                    ACTIONS[entry['action']](ctx, balancer, ref)
+        except Exception, e:
+            LOG.exception("Failed to fix drift of loadbalancer %s", lb_id)
+            for entry, balancer, ref in steps[lb_id]:
+                entry['error'] = str(e)
+        else:
+            fixed = set(id(entry) for entry, balancer, ref in todo)
+            for entry, balancer, ref in steps[lb_id]:
+                if id(entry) in fixed:
+                    entry['fixed'] = True
+                else:
+                    entry['stale'] = True
+
+
+def _load_balancers(conf, device_id):
+    balancers = []
+    with db_api.transaction(conf):
+        for lb_ref in db_api.loadbalancer_get_all_by_device_id(conf,
+                                                              device_id):
+            if not lb_ref.serverfarms:
+                continue
+            balancer = vserver.Balancer(conf)
+            balancer.loadFromAggregate(lb_ref)
+            balancers.append(balancer)
+    return balancers
+
+
+def _load_balancer(conf, device_id, lb_id):
+    """Return a balancer if it still has a farm on the device."""
+    with db_api.transaction(conf):
+        try:
+            lb_ref = db_api.loadbalancer_get_aggregate(conf, lb_id)
+        except exception.LoadBalancerNotFound:
+            return None
+        if lb_ref['device_id'] != device_id or not lb_ref.serverfarms:
+            return None
+        balancer = vserver.Balancer(conf)
+        balancer.loadFromAggregate(lb_ref)
+    return balancer
+
+
+def reconcile_device(conf, device_id, fix=False):
+    """Check one device for drift and optionally fix it.
+
+    The report is returned and kept as the latest one of the device.
+    The database and the device are read within one device request, so
+    changes made through the API in this process don't interleave. Fixes
+    are applied in later requests, one per balancer, and each of them
+    checks its balancer again first, see apply_plan.
+    """
+    db_api.device_get(conf, device_id)
+    report = {
+        'device_id': device_id,
+        'checked_at': datetime.datetime.utcnow().isoformat(),
+        'drift': [],
+        'error': None,
+    }
+    try:
+        driver = drivers.get_device_driver(conf, device_id)
+        with driver.request_context():
+            balancers = _load_balancers(conf, device_id)
+            plan = compute_plan(balancers, driver.get_device_state())
+        if fix:
+            apply_plan(driver, plan)
+        report['drift'] = [entry for entry, balancer, ref in plan]
+    except NotImplementedError:
+        report['error'] = "Drift detection is not supported by the driver"
+    except Exception, e:
+        LOG.exception("Failed to check drift of device %s", device_id)
+        report['error'] = str(e)
+    REPORTS[device_id] = report
+    return report
+
+
+def get_report(conf, device_id):
+    """Return the latest report of a device, check it if there is none."""
+    report = REPORTS.get(device_id)
+    if report is None:
+        report = reconcile_device(conf, device_id)
+    return report
+
+
+def reconcile_all(conf, fix=False):
+    """Check all devices, at most concurrency of them at the same time."""
+    register_conf_opts(conf)
+    device_ids = [device['id'] for device in db_api.device_get_all(conf)]
+    pool = eventlet.GreenPool(conf.reconciler.concurrency)
+    return list(pool.imap(lambda device_id:
+                          reconcile_device(conf, device_id, fix),
+                          device_ids))
+
+
+def _run_periodic(conf):
+    while True:
+        eventlet.sleep(conf.reconciler.interval)
+        try:
+            reconcile_all(conf, conf.reconciler.auto_fix)
+        except Exception:
+            LOG.exception("Periodic drift check failed")
+
+
+def start(conf):
+    """Start periodic checks of all devices in a green thread."""
+    register_conf_opts(conf)
+    if conf.reconciler.interval <= 0:
+        return None
+    return eventlet.spawn(_run_periodic, conf)
@@ -22,8 +22,13 @@
 import functools
 import datetime
 
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload_all, subqueryload
+from sqlalchemy.sql import and_, or_
+
 from balancer.db import models
-from balancer.db.session import get_session
+from balancer.db import session as db_session
+from balancer.db.session import get_session, transaction
 from balancer import exception
 
 
@@ -38,9 +43,26 @@ def pack_extra(model, values):
     return obj_ref
 
 
-def unpack_extra(obj_ref):
-    obj_dict = dict(obj_ref.iteritems())
-    obj_dict.update(obj_dict.pop('extra', None) or {})
+# NOTE: these columns used to be kept in extra, they are left out of
+# unpacked objects when not set as they were before
+PROMOTED_FIELDS = frozenset(['maxCon', 'minCon', 'state', 'proto', 'appProto',
+                             'probeInterval', 'passDetectInterval'])
+
+
+def unpack_extra(obj_ref, fields=None):
+    obj_dict = {}
+    extra = None
+    for name in obj_ref:
+        value = obj_ref[name]
+        if name == 'extra':
+            extra = value
+        elif value is not None or name not in PROMOTED_FIELDS:
+            obj_dict[name] = value
+    if extra:
+        obj_dict.update(extra.iteritems())
+    if fields:
+        obj_dict = dict((name, obj_dict[name]) for name in fields
+                        if name in obj_dict)
     return obj_dict
 
 
@@ -53,6 +75,161 @@ probe_pack_extra = functools.partial(pack_extra, models.Probe)
 sticky_pack_extra = functools.partial(pack_extra, models.Sticky)
 predictor_pack_extra = functools.partial(pack_extra, models.Predictor)
 
+
+def paginate_query(query, model, filters=None, marker=None, limit=None,
+                   sort_key=None, sort_dir=None):
+    """Apply filters, sorting and marker/limit pagination to a query.
+
+    Rows are ordered by sort_key and then by id, so a page always starts
+    right after the marker row whatever the sort key is.  NULL values are
+    expected to sort first, as on SQLite and MySQL.
+    """
+    if filters:
+        query = query.filter_by(**filters)
+    if marker is None and limit is None and sort_key is None:
+        return query
+    sort_column = getattr(model, sort_key or 'id')
+    if sort_dir == 'desc':
+        query = query.order_by(sort_column.desc(), model.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), model.id.asc())
+    if marker is not None:
+        marker_ref = query.session.query(model).get(marker)
+        if marker_ref is None:
+            raise exception.InvalidMarker(marker=marker)
+        value = getattr(marker_ref, sort_column.key)
+        if sort_dir == 'desc':
+            if value is None:
+                query = query.filter(and_(sort_column.is_(None),
+                                          model.id < marker))
+            else:
+                query = query.filter(or_(sort_column < value,
+                                         sort_column.is_(None),
+                                         and_(sort_column == value,
+                                              model.id < marker)))
+        else:
+            if value is None:
+                query = query.filter(or_(sort_column.isnot(None),
+                                         model.id > marker))
+            else:
+                query = query.filter(or_(sort_column > value,
+                                         and_(sort_column == value,
+                                              model.id > marker)))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+# NOTE: a server farm never moves to another load balancer, so the load
+# balancer of every farm seen by the process is kept
+_SERVERFARM_LB = {}
+
+
+def _remember_serverfarm(sf_id, lb_id):
+    if sf_id is not None and lb_id is not None:
+        _SERVERFARM_LB[sf_id] = lb_id
+
+
+@event.listens_for(models.ServerFarm, 'load')
+def _on_serverfarm_load(serverfarm_ref, context):
+    _remember_serverfarm(serverfarm_ref.id, serverfarm_ref.lb_id)
+
+
+@event.listens_for(models.ServerFarm, 'after_insert')
+def _on_serverfarm_insert(mapper, connection, serverfarm_ref):
+    _remember_serverfarm(serverfarm_ref.id, serverfarm_ref.lb_id)
+
+
+def _invalidate(conf, session, lb_ids=(), sf_ids=()):
+    """Report load balancers changed in the session.
+
+    Farms not seen by the process yet are read in one query.
+    """
+    lb_ids = set(lb_ids)
+    unknown = set()
+    for sf_id in sf_ids:
+        if sf_id is None:
+            continue
+        if sf_id in _SERVERFARM_LB:
+            lb_ids.add(_SERVERFARM_LB[sf_id])
+        else:
+            unknown.add(sf_id)
+    if unknown:
+        query = session.query(models.ServerFarm.id,
+                              models.ServerFarm.lb_id).\
+                        filter(models.ServerFarm.id.in_(unknown))
+        for row in query:
+            _remember_serverfarm(row.id, row.lb_id)
+            lb_ids.add(row.lb_id)
+    db_session.changed(conf, session, lb_ids)
+
+
+def _invalidate_refs(conf, session, refs):
+    """Report load balancers that own the given objects as changed."""
+    lb_ids = set()
+    sf_ids = set()
+    for ref in refs:
+        if isinstance(ref, models.LoadBalancer):
+            lb_ids.add(ref['id'])
+        elif isinstance(ref, models.ServerFarm):
+            _remember_serverfarm(ref['id'], ref['lb_id'])
+            lb_ids.add(ref['lb_id'])
+        elif isinstance(ref, models.VirtualServer) and ref['lb_id']:
+            lb_ids.add(ref['lb_id'])
+        elif not isinstance(ref, models.Device):
+            sf_ids.add(ref['sf_id'])
+    _invalidate(conf, session, lb_ids, sf_ids)
+
+
+def save_all(conf, new_refs, updates, deletes=(), lb_ids=None):
+    """Write changes of several objects in one transaction.
+
+    new_refs are inserted, or merged if a row with the same id already
+    exists. updates is a list of (model, id, values) tuples, only the
+    columns in values are written. deletes is a list of (model, id)
+    tuples of rows to delete. lb_ids are the load balancers the changed
+    objects belong to, they are looked up if not given.
+    """
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        ids_by_model = {}
+        for ref in new_refs:
+            ids_by_model.setdefault(type(ref), []).append(ref['id'])
+        existing = set()
+        for model, ids in ids_by_model.iteritems():
+            query = session.query(model.id).filter(model.id.in_(ids))
+            existing.update((model, row.id) for row in query)
+        for ref in new_refs:
+            if (type(ref), ref['id']) in existing:
+                session.merge(ref)
+            else:
+                session.add(ref)
+        if lb_ids is None:
+            _invalidate_refs(conf, session, new_refs)
+            lb_ids = set()
+            ids_by_model = {}
+            for model, obj_id, values in updates:
+                if model is models.LoadBalancer:
+                    lb_ids.add(obj_id)
+                elif model is not models.Device:
+                    ids_by_model.setdefault(model, []).append(obj_id)
+            for model, obj_id in deletes:
+                ids_by_model.setdefault(model, []).append(obj_id)
+            sf_ids = ids_by_model.pop(models.ServerFarm, [])
+            for model, ids in ids_by_model.iteritems():
+                query = session.query(model.sf_id).\
+                                filter(model.id.in_(ids))
+                sf_ids.extend(row.sf_id for row in query)
+            _invalidate(conf, session, lb_ids, sf_ids)
+        else:
+            _invalidate(conf, session, lb_ids)
+        for model, obj_id, values in updates:
+            session.query(model).filter_by(id=obj_id).\
+                    update(values, synchronize_session=False)
+        for model, obj_id in deletes:
+            session.query(model).filter_by(id=obj_id).\
+                    delete(synchronize_session=False)
+
 # Device
 
 
@@ -65,15 +242,15 @@ def device_get(conf, device_id, session=None):
     return device_ref
 
 
-def device_get_all(conf):
+def device_get_all(conf, **kwargs):
     session = get_session(conf)
     query = session.query(models.Device)
-    return query.all()
+    return paginate_query(query, models.Device, **kwargs).all()
 
 
 def device_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = models.Device()
         device_ref.update(values)
         session.add(device_ref)
@@ -82,7 +259,7 @@ def device_create(conf, values):
 
 def device_update(conf, device_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = device_get(conf, device_id, session=session)
         device_ref.update(values)
         return device_ref
@@ -90,7 +267,7 @@ def device_update(conf, device_id, values):
 
 def device_destroy(conf, device_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         device_ref = device_get(conf, device_id, session=session)
         session.delete(device_ref)
 
@@ -106,10 +283,41 @@ def loadbalancer_get(conf, loadbalancer_id, session=None):
     return loadbalancer_ref
 
 
-def loadbalancer_get_all_by_project(conf, tenant_id):
+def loadbalancer_get_aggregate(conf, loadbalancer_id, session=None):
+    """Return a load balancer with its whole object graph loaded.
+
+    Server farms with their predictors, probes, stickies and virtual
+    servers come with the load balancer row in one joined query, real
+    servers are fetched by one more query for all farms at once.
+    """
+    session = session or get_session(conf)
+    loadbalancer_ref = _aggregate_query(session).\
+            filter_by(id=loadbalancer_id).first()
+    if not loadbalancer_ref:
+        raise exception.LoadBalancerNotFound(loadbalancer_id=loadbalancer_id)
+    return loadbalancer_ref
+
+
+def loadbalancer_get_all_by_device_id(conf, device_id, session=None):
+    """Return all load balancers of a device with their object graphs."""
+    session = session or get_session(conf)
+    return _aggregate_query(session).filter_by(device_id=device_id).\
+            order_by(models.LoadBalancer.id).all()
+
+
+def _aggregate_query(session):
+    return session.query(models.LoadBalancer).\
+            options(joinedload_all('serverfarms.predictors'),
+                    joinedload_all('serverfarms.probes'),
+                    joinedload_all('serverfarms.stickies'),
+                    joinedload_all('serverfarms.virtualservers'),
+                    subqueryload('serverfarms.servers'))
+
+
+def loadbalancer_get_all_by_project(conf, tenant_id, **kwargs):
     session = get_session(conf)
     query = session.query(models.LoadBalancer).filter_by(tenant_id=tenant_id)
-    return query.all()
+    return paginate_query(query, models.LoadBalancer, **kwargs).all()
 
 
 def loadbalancer_get_all_by_vm_id(conf, vm_id, tenant_id):
@@ -126,26 +334,29 @@ def loadbalancer_get_all_by_vm_id(conf, vm_id, tenant_id):
 
 def loadbalancer_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = models.LoadBalancer()
         lb_ref.update(values)
         session.add(lb_ref)
+        _invalidate_refs(conf, session, [lb_ref])
         return lb_ref
 
 
 def loadbalancer_update(conf, lb_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = loadbalancer_get(conf, lb_id, session=session)
         lb_ref.update(values)
         lb_ref['updated_at'] = datetime.datetime.utcnow()
+        _invalidate_refs(conf, session, [lb_ref])
         return lb_ref
 
 
 def loadbalancer_destroy(conf, lb_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         lb_ref = loadbalancer_get(conf, lb_id, session=session)
+        _invalidate_refs(conf, session, [lb_ref])
         session.delete(lb_ref)
 
 # Probe
@@ -173,31 +384,35 @@ def probe_get_all_by_sf_id(conf, sf_id):
 
 def probe_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = models.Probe()
         probe_ref.update(values)
         session.add(probe_ref)
+        _invalidate_refs(conf, session, [probe_ref])
         return probe_ref
 
 
 def probe_update(conf, probe_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = probe_get(conf, probe_id, session=session)
         probe_ref.update(values)
+        _invalidate_refs(conf, session, [probe_ref])
         return probe_ref
 
 
 def probe_destroy(conf, probe_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         probe_ref = probe_get(conf, probe_id, session=session)
+        _invalidate_refs(conf, session, [probe_ref])
         session.delete(probe_ref)
 
 
 def probe_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
     with session.begin(subtransactions=True):
+        _invalidate(conf, session, sf_ids=[sf_id])
         session.query(models.Probe).filter_by(sf_id=sf_id).delete()
 
 # Sticky
@@ -225,31 +440,35 @@ def sticky_get_all_by_sf_id(conf, sf_id):
 
 def sticky_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = models.Sticky()
         sticky_ref.update(values)
         session.add(sticky_ref)
+        _invalidate_refs(conf, session, [sticky_ref])
         return sticky_ref
 
 
 def sticky_update(conf, sticky_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = sticky_get(conf, sticky_id, session=session)
         sticky_ref.update(values)
+        _invalidate_refs(conf, session, [sticky_ref])
         return sticky_ref
 
 
 def sticky_destroy(conf, sticky_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         sticky_ref = sticky_get(conf, sticky_id, session=session)
+        _invalidate_refs(conf, session, [sticky_ref])
         session.delete(sticky_ref)
 
 
 def sticky_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
     with session.begin(subtransactions=True):
+        _invalidate(conf, session, sf_ids=[sf_id])
         session.query(models.Sticky).filter_by(sf_id=sf_id).delete()
 
 # Server
@@ -283,18 +502,42 @@ def server_get_by_address(conf, server_address):
     return server_ref
 
 
+def _server_on_device_query(session, device_id):
+    return session.query(models.Server).\
+                   join(models.ServerFarm,
+                        models.Server.sf_id == models.ServerFarm.id).\
+                   join(models.LoadBalancer,
+                        models.ServerFarm.lb_id == models.LoadBalancer.id).\
+                   filter(models.LoadBalancer.device_id == device_id).\
+                   filter(models.Server.deployed == 'True')
+
+
 def server_get_by_address_on_device(conf, server_address, device_id):
     session = get_session(conf)
-    server_refs = session.query(models.Server).\
-                         filter_by(address=server_address).\
-                         filter_by(deployed='True')
-    for server_ref in server_refs:
-        sf = serverfarm_get(conf, server_ref['sf_id'], session=session)
-        lb = loadbalancer_get(conf, sf['lb_id'])
-        if device_id == lb['device_id']:
-            return server_ref
-    raise exception.ServerNotFound(server_address=server_address,
-                                   device_id=device_id)
+    server_ref = _server_on_device_query(session, device_id).\
+                         filter(models.Server.address == server_address).\
+                         first()
+    if not server_ref:
+        raise exception.ServerNotFound(server_address=server_address,
+                                       device_id=device_id)
+    return server_ref
+
+
+def server_get_all_by_address_on_device(conf, server_addresses, device_id):
+    """Return a dict of deployed servers on the device by address.
+
+    Addresses without a deployed server are not in the dict.
+    """
+    session = get_session(conf)
+    addresses = list(set(server_addresses))
+    server_refs = {}
+    # Keep the number of bound parameters below the SQLite limit
+    for i in xrange(0, len(addresses), 500):
+        query = _server_on_device_query(session, device_id).\
+                        filter(models.Server.address.in_(addresses[i:i + 500]))
+        for server_ref in query:
+            server_refs.setdefault(server_ref['address'], server_ref)
+    return server_refs
 
 
 def server_get_all_by_parent_id(conf, parent_id):
@@ -303,39 +546,56 @@ def server_get_all_by_parent_id(conf, parent_id):
     return query.all()
 
 
-def server_get_all_by_sf_id(conf, sf_id):
+def server_get_all_by_sf_id(conf, sf_id, **kwargs):
     session = get_session(conf)
     query = session.query(models.Server).filter_by(sf_id=sf_id)
-    return query.all()
+    return paginate_query(query, models.Server, **kwargs).all()
 
 
 def server_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = models.Server()
         server_ref.update(values)
         session.add(server_ref)
+        _invalidate_refs(conf, session, [server_ref])
         return server_ref
 
 
+def server_create_all(conf, values_list):
+    session = get_session(conf)
+    with session.begin(subtransactions=True):
+        server_refs = []
+        for values in values_list:
+            server_ref = models.Server()
+            server_ref.update(values)
+            server_refs.append(server_ref)
+        session.add_all(server_refs)
+        _invalidate_refs(conf, session, server_refs)
+        return server_refs
+
+
 def server_update(conf, server_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = server_get(conf, server_id, session=session)
         server_ref.update(values)
+        _invalidate_refs(conf, session, [server_ref])
         return server_ref
 
 
 def server_destroy(conf, server_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         server_ref = server_get(conf, server_id, session=session)
+        _invalidate_refs(conf, session, [server_ref])
         session.delete(server_ref)
 
 
 def server_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
     with session.begin(subtransactions=True):
+        _invalidate(conf, session, sf_ids=[sf_id])
         session.query(models.Server).filter_by(sf_id=sf_id).delete()
 
 # ServerFarm
@@ -358,25 +618,28 @@ def serverfarm_get_all_by_lb_id(conf, lb_id):
 
 def serverfarm_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = models.ServerFarm()
         serverfarm_ref.update(values)
         session.add(serverfarm_ref)
+        _invalidate_refs(conf, session, [serverfarm_ref])
         return serverfarm_ref
 
 
 def serverfarm_update(conf, serverfarm_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = serverfarm_get(conf, serverfarm_id, session=session)
         serverfarm_ref.update(values)
+        _invalidate_refs(conf, session, [serverfarm_ref])
         return serverfarm_ref
 
 
 def serverfarm_destroy(conf, serverfarm_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         serverfarm_ref = serverfarm_get(conf, serverfarm_id, session=session)
+        _invalidate_refs(conf, session, [serverfarm_ref])
         session.delete(serverfarm_ref)
 
 # Predictor
@@ -399,31 +662,35 @@ def predictor_get_all_by_sf_id(conf, sf_id):
 
 def predictor_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = models.Predictor()
         predictor_ref.update(values)
         session.add(predictor_ref)
+        _invalidate_refs(conf, session, [predictor_ref])
         return predictor_ref
 
 
 def predictor_update(conf, predictor_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = predictor_get(conf, predictor_id, session=session)
         predictor_ref.update(values)
+        _invalidate_refs(conf, session, [predictor_ref])
         return predictor_ref
 
 
 def predictor_destroy(conf, predictor_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         predictor_ref = predictor_get(conf, predictor_id, session=session)
+        _invalidate_refs(conf, session, [predictor_ref])
         session.delete(predictor_ref)
 
 
 def predictor_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
     with session.begin(subtransactions=True):
+        _invalidate(conf, session, sf_ids=[sf_id])
         session.query(models.Predictor).filter_by(sf_id=sf_id).delete()
 
 # VirtualServer
@@ -457,29 +724,33 @@ def virtualserver_get_all_by_lb_id(conf, lb_id):
 
 def virtualserver_create(conf, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = models.VirtualServer()
         vserver_ref.update(values)
         session.add(vserver_ref)
+        _invalidate_refs(conf, session, [vserver_ref])
         return vserver_ref
 
 
 def virtualserver_update(conf, vserver_id, values):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = virtualserver_get(conf, vserver_id, session=session)
         vserver_ref.update(values)
+        _invalidate_refs(conf, session, [vserver_ref])
         return vserver_ref
 
 
 def virtualserver_destroy(conf, vserver_id):
     session = get_session(conf)
-    with session.begin():
+    with session.begin(subtransactions=True):
         vserver_ref = virtualserver_get(conf, vserver_id, session=session)
+        _invalidate_refs(conf, session, [vserver_ref])
         session.delete(vserver_ref)
 
 
 def virtualserver_destroy_by_sf_id(conf, sf_id, session=None):
     session = session or get_session(conf)
     with session.begin(subtransactions=True):
+        _invalidate(conf, session, sf_ids=[sf_id])
         session.query(models.VirtualServer).filter_by(sf_id=sf_id).delete()
@@ -19,10 +19,17 @@
 #    under the License.
 """Base classes and custome fields for balancer models."""
 
-import json
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import object_mapper
+from sqlalchemy.ext.mutable import Mutable
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy import Text
 
@@ -43,8 +50,17 @@ class DictBase(object):
     def get(self, key, default=None):
         return getattr(self, key, default)
 
+    @classmethod
+    def column_names(cls):
+        """Return a tuple of column names, computed once per model."""
+        names = cls.__dict__.get('_column_names')
+        if names is None:
+            names = tuple(col.name for col in class_mapper(cls).columns)
+            cls._column_names = names
+        return names
+
     def __iter__(self):
-        return (col.name for col in object_mapper(self).columns)
+        return iter(self.column_names())
 
     def keys(self):
         return list(self)
@@ -56,13 +72,72 @@ class DictBase(object):
             setattr(self, key, value)
 
     def iteritems(self):
-        items = []
-        for key in self:
-            value = getattr(self,  key)
+        for key in self.column_names():
+            value = getattr(self, key)
             if isinstance(value, dict):
                 value = value.copy()
-            items.append((key, value))
-        return iter(items)
+            yield key, value
+
+
+def _writer(name):
+    method = getattr(dict, name)
+
+    def writer(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._raw = None
+        self.changed()
+        return result
+    return writer
+
+
+class JsonDict(Mutable, dict):
+    """Dict decoded from JSON that reports in-place changes.
+
+    The JSON text it was decoded from is kept until the dict is changed
+    so unchanged values are not encoded again, and changes are reported
+    to the owning model.
+    """
+
+    _raw = None
+
+    @classmethod
+    def from_json(cls, raw):
+        # NOTE: decoded right away, a dict subclass that is filled later
+        # looks empty to dict(), json.dumps() and ** until then
+        if raw == '{}':
+            obj = cls()
+        else:
+            obj = cls(json.loads(raw))
+        obj._raw = raw
+        return obj
+
+    @classmethod
+    def coerce(cls, key, value):
+        if isinstance(value, cls) or value is None:
+            return value
+        if isinstance(value, dict):
+            return cls(value)
+        return Mutable.coerce(key, value)
+
+    def to_json(self):
+        if self._raw is None:
+            self._raw = json.dumps(self)
+        return self._raw
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def copy(self):
+        return dict(self)
+
+
+for name in ('__setitem__', '__delitem__', 'clear', 'pop', 'popitem',
+             'setdefault', 'update'):
+    setattr(JsonDict, name, _writer(name))
+del name
 
 
 class JsonBlob(TypeDecorator):
@@ -70,7 +145,14 @@ class JsonBlob(TypeDecorator):
     impl = Text
 
     def process_bind_param(self, value, dialect):
+        if isinstance(value, JsonDict):
+            return value.to_json()
         return json.dumps(value)
 
     def process_result_value(self, value, dialect):
-        return json.loads(value)
+        if value is None or value == 'null':
+            return None
+        return JsonDict.from_json(value)
+
+
+JsonDict.associate_with(JsonBlob)
@@ -0,0 +1,38 @@
+from sqlalchemy.schema import MetaData, Table, Index
+
+
+INDEXES = (
+    ('loadbalancer', ('device_id',)),
+    ('loadbalancer', ('tenant_id',)),
+    ('serverfarm', ('lb_id',)),
+    ('virtualserver', ('sf_id',)),
+    ('virtualserver', ('lb_id',)),
+    ('server', ('sf_id',)),
+    ('server', ('parent_id',)),
+    ('server', ('vm_id',)),
+    ('server', ('address', 'deployed')),
+    ('probe', ('sf_id',)),
+    ('sticky', ('sf_id',)),
+    ('predictor', ('sf_id',)),
+)
+
+
+def get_indexes(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    tables = {}
+    for table_name, columns in INDEXES:
+        if table_name not in tables:
+            tables[table_name] = Table(table_name, meta, autoload=True)
+        table = tables[table_name]
+        name = 'ix_%s_%s' % (table_name, '_'.join(columns))
+        yield Index(name, *[table.c[column] for column in columns])
+
+
+def upgrade(migrate_engine):
+    for index in get_indexes(migrate_engine):
+        index.create()
+
+
+def downgrade(migrate_engine):
+    for index in get_indexes(migrate_engine):
+        index.drop()
@@ -0,0 +1,57 @@
+import json
+
+from migrate import changeset  # adds Column.create and Column.drop
+from sqlalchemy.schema import MetaData, Table, Column
+from sqlalchemy.types import Integer, String
+
+
+# Fields read by drivers on every operation, moved out of the extra blob.
+# Column names are the same as the API keys.
+FIELDS = (
+    ('server', 'maxCon', Integer),
+    ('server', 'minCon', Integer),
+    ('server', 'state', String(255)),
+    ('virtualserver', 'proto', String(255)),
+    ('virtualserver', 'appProto', String(255)),
+    ('probe', 'probeInterval', Integer),
+    ('probe', 'passDetectInterval', Integer),
+)
+
+
+def get_tables(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    tables = {}
+    for table_name, name, type_ in FIELDS:
+        if table_name not in tables:
+            tables[table_name] = (Table(table_name, meta, autoload=True), [])
+        tables[table_name][1].append((name, type_))
+    return tables.values()
+
+
+def move_values(table, names, to_columns):
+    rows = table.select().execute().fetchall()
+    for row in rows:
+        extra = json.loads(row['extra']) if row['extra'] else {}
+        values = {}
+        for name in names:
+            if to_columns:
+                values[name] = extra.pop(name, None)
+            elif row[name] is not None:
+                extra[name] = row[name]
+        values['extra'] = json.dumps(extra)
+        table.update().where(table.c.id == row['id']).\
+                values(**values).execute()
+
+
+def upgrade(migrate_engine):
+    for table, columns in get_tables(migrate_engine):
+        for name, type_ in columns:
+            Column(name, type_).create(table)
+        move_values(table, [name for name, type_ in columns], True)
+
+
+def downgrade(migrate_engine):
+    for table, columns in get_tables(migrate_engine):
+        move_values(table, [name for name, type_ in columns], False)
+        for name, type_ in columns:
+            table.c[name].drop()
@@ -24,7 +24,7 @@ import uuid
 
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy import (Column, ForeignKey, Integer, String, Boolean,
-                        DateTime)
+                        DateTime, Index)
 
 from balancer.db.base import Base, DictBase, JsonBlob
 
@@ -53,12 +53,12 @@ class LoadBalancer(DictBase, Base):
 
     __tablename__ = 'loadbalancer'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    device_id = Column(String(32), ForeignKey('device.id'))
+    device_id = Column(String(32), ForeignKey('device.id'), index=True)
     name = Column(String(255))
     algorithm = Column(String(255))
     protocol = Column(String(255))
     status = Column(String(255))
-    tenant_id = Column(String(255))
+    tenant_id = Column(String(255), index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow,
                         nullable=False)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow,
@@ -77,7 +77,7 @@ class ServerFarm(DictBase, Base):
 
     __tablename__ = 'serverfarm'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    lb_id = Column(String(32), ForeignKey('loadbalancer.id'))
+    lb_id = Column(String(32), ForeignKey('loadbalancer.id'), index=True)
     name = Column(String(255))
     type = Column(String(255))
     status = Column(String(255))
@@ -94,14 +94,16 @@ class VirtualServer(DictBase, Base):
 
     __tablename__ = 'virtualserver'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    sf_id = Column(String(32), ForeignKey('serverfarm.id'))
-    lb_id = Column(String(32), ForeignKey('loadbalancer.id'))
+    sf_id = Column(String(32), ForeignKey('serverfarm.id'), index=True)
+    lb_id = Column(String(32), ForeignKey('loadbalancer.id'), index=True)
     name = Column(String(255))
     address = Column(String(255))
     mask = Column(String(255))
     port = Column(String(255))
     status = Column(String(255))
     deployed = Column(String(40))
+    proto = Column(String(255))
+    appProto = Column(String(255))
     extra = Column(JsonBlob())
 
     serverfarm = relationship(ServerFarm,
@@ -116,17 +118,22 @@ class Server(DictBase, Base):
     """Represents a real server."""
 
     __tablename__ = 'server'
+    __table_args__ = (Index('ix_server_address_deployed',
+                            'address', 'deployed'),)
     id = Column(String(32), primary_key=True, default=create_uuid)
-    sf_id = Column(String(32), ForeignKey('serverfarm.id'))
+    sf_id = Column(String(32), ForeignKey('serverfarm.id'), index=True)
     name = Column(String(255))
     type = Column(String(255))
     address = Column(String(255))
     port = Column(String(255))
     weight = Column(Integer)
     status = Column(String(255))
-    parent_id = Column(Integer)
+    parent_id = Column(Integer, index=True)
     deployed = Column(String(40))
-    vm_id = Column(Integer)
+    vm_id = Column(Integer, index=True)
+    maxCon = Column(Integer)
+    minCon = Column(Integer)
+    state = Column(String(255))
     extra = Column(JsonBlob())
 
     serverfarm = relationship(ServerFarm,
@@ -139,10 +146,12 @@ class Probe(DictBase, Base):
 
     __tablename__ = 'probe'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    sf_id = Column(String(32), ForeignKey('serverfarm.id'))
+    sf_id = Column(String(32), ForeignKey('serverfarm.id'), index=True)
     name = Column(String(255))
     type = Column(String(255))
     deployed = Column(String(40))
+    probeInterval = Column(Integer)
+    passDetectInterval = Column(Integer)
     extra = Column(JsonBlob())
 
     serverfarm = relationship(ServerFarm,
@@ -155,7 +164,7 @@ class Sticky(DictBase, Base):
 
     __tablename__ = 'sticky'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    sf_id = Column(String(32), ForeignKey('serverfarm.id'))
+    sf_id = Column(String(32), ForeignKey('serverfarm.id'), index=True)
     name = Column(String(255))
     type = Column(String(255))
     deployed = Column(String(40))
@@ -171,7 +180,7 @@ class Predictor(DictBase, Base):
 
     __tablename__ = 'predictor'
     id = Column(String(32), primary_key=True, default=create_uuid)
-    sf_id = Column(String(32), ForeignKey('serverfarm.id'))
+    sf_id = Column(String(32), ForeignKey('serverfarm.id'), index=True)
     type = Column(String(255))
     deployed = Column(String(40))
     extra = Column(JsonBlob())
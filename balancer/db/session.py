@@ -19,15 +19,19 @@
 #    under the License.
 """Session management functions."""
 
+import contextlib
 import os
 import logging
+import weakref
 
+from eventlet import corolocal
 from migrate.versioning import api as versioning_api
 from migrate import exceptions as versioning_exceptions
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.exc import DisconnectionError
 
 from balancer.common import cfg
@@ -38,11 +42,24 @@ DB_GROUP_NAME = 'sql'
 DB_OPTIONS = (
     cfg.IntOpt('idle_timeout', default=3600),
     cfg.StrOpt('connection', default='sqlite:///balancer.sqlite'),
+    cfg.IntOpt('max_pool_size', default=10),
+    cfg.IntOpt('max_overflow', default=20),
+    cfg.IntOpt('pool_timeout', default=30),
+    cfg.BoolOpt('pool_pre_ping', default=True),
+    cfg.BoolOpt('sqlite_wal', default=True),
 )
 
 MAKER = None
 ENGINE = None
 
+# Session of the transaction running in the current green thread
+_LOCAL = corolocal.local()
+
+# Load balancers changed in not yet committed sessions and listeners of
+# the changes
+_CHANGES = weakref.WeakKeyDictionary()
+_CHANGE_LISTENERS = []
+
 
 class MySQLPingListener(object):
     """
@@ -73,22 +90,113 @@ class MySQLPingListener(object):
                 raise
 
 
+class PingListener(object):
+    """Ensures that connections checked out of the pool are alive."""
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        try:
+            dbapi_con.cursor().execute('select 1')
+        except dbapi_con.OperationalError, ex:
+            logging.warn('Got database connection error: %s', ex)
+            raise DisconnectionError("Database server went away")
+
+
+class SQLiteWALListener(object):
+    """Switches new SQLite connections to write-ahead logging.
+
+    With WAL readers do not block the writer and the writer does not block
+    readers, so pooled connections can be used by concurrent requests.
+    """
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
 def get_session(conf, autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy session."""
+    """Return a SQLAlchemy session.
+
+    Inside transaction() the session of the transaction is returned.
+    """
     global MAKER
 
-    if MAKER is None:
-        MAKER = sessionmaker(autocommit=autocommit,
-                             expire_on_commit=expire_on_commit)
+    session = getattr(_LOCAL, 'session', None)
+    if session is not None:
+        return session
     engine = get_engine(conf)
-    MAKER.configure(bind=engine)
-    session = MAKER()
-    return session
+    if MAKER is None:
+        MAKER = sessionmaker(bind=engine)
+        event.listen(MAKER, 'after_commit', _after_commit)
+        event.listen(MAKER, 'after_rollback', _after_rollback)
+    return MAKER(autocommit=autocommit, expire_on_commit=expire_on_commit)
+
+
+def add_change_listener(listener):
+    """Call listener(conf, lb_ids) when load balancers are changed.
+
+    It is called when the change is made and once more when the session
+    commits, so a reader that loaded rows before the commit can't keep
+    stale data. Changes of a session that rolls back are forgotten.
+    """
+    if listener not in _CHANGE_LISTENERS:
+        _CHANGE_LISTENERS.append(listener)
+
+
+def _notify(conf, lb_ids):
+    for listener in _CHANGE_LISTENERS:
+        listener(conf, lb_ids)
+
+
+def changed(conf, session, lb_ids):
+    """Report load balancers changed in a session."""
+    lb_ids = set(lb_id for lb_id in lb_ids if lb_id is not None)
+    if not lb_ids:
+        return
+    _notify(conf, lb_ids)
+    pending = _CHANGES.get(session)
+    if pending is None:
+        pending = _CHANGES[session] = (conf, set())
+    pending[1].update(lb_ids)
+
+
+def _after_commit(session):
+    pending = _CHANGES.pop(session, None)
+    if pending is not None:
+        _notify(*pending)
+
+
+def _after_rollback(session):
+    _CHANGES.pop(session, None)
+
+
+@contextlib.contextmanager
+def transaction(conf):
+    """Run the block in one transaction.
+
+    All database API calls made by the current green thread inside the
+    block use the same session and join its transaction. Nested blocks
+    join the outer transaction.
+    """
+    session = getattr(_LOCAL, 'session', None)
+    if session is not None:
+        with session.begin(subtransactions=True):
+            yield session
+        return
+    session = get_session(conf)
+    _LOCAL.session = session
+    try:
+        with session.begin():
+            yield session
+    finally:
+        del _LOCAL.session
+        session.close()
 
 
 def get_engine(conf):
     """Return a SQLAlchemy engine."""
-    global ENGINE
+    global ENGINE, MAKER
 
     register_conf_opts(conf)
     connection_url = make_url(conf.sql.connection)
@@ -97,11 +205,33 @@ def get_engine(conf):
                        'echo': False,
                        'convert_unicode': True
                        }
+        pool_args = {'pool_size': conf.sql.max_pool_size,
+                     'max_overflow': conf.sql.max_overflow,
+                     'pool_timeout': conf.sql.pool_timeout,
+                     }
+        listeners = []
         if 'sqlite' in connection_url.drivername:
-            engine_args['poolclass'] = NullPool
-        if 'mysql' in connection_url.drivername:
-            engine_args['listeners'] = [MySQLPingListener()]
+            # Pooled connections are handed over between green threads
+            engine_args['connect_args'] = {'check_same_thread': False}
+            if connection_url.database in (None, '', ':memory:'):
+                # Every connection to :memory: opens a new empty database
+                engine_args['poolclass'] = StaticPool
+            else:
+                engine_args['poolclass'] = QueuePool
+                engine_args.update(pool_args)
+                if conf.sql.sqlite_wal:
+                    listeners.append(SQLiteWALListener())
+        else:
+            engine_args.update(pool_args)
+            if conf.sql.pool_pre_ping:
+                if 'mysql' in connection_url.drivername:
+                    listeners.append(MySQLPingListener())
+                else:
+                    listeners.append(PingListener())
+        if listeners:
+            engine_args['listeners'] = listeners
         ENGINE = create_engine(conf.sql.connection, **engine_args)
+        MAKER = None
     return ENGINE
 
 
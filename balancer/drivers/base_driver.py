@@ -14,7 +14,12 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import sys
+
+from eventlet import semaphore
+
 from balancer.core import commands
+from balancer.core import executor
 
 
 class DeviceRequestContext(commands.RollbackContext):
@@ -22,6 +27,91 @@ class DeviceRequestContext(commands.RollbackContext):
         super(DeviceRequestContext, self).__init__()
         self.conf = conf
         self.device = device
+        # NOTE: a request nested in another one belongs to the outer one
+        self.owner = self
+
+    def add_rollback(self, rollback):
+        super(DeviceRequestContext, self).add_rollback(
+                self.device.wrap_rollback(rollback))
+
+
+class RequestLock(object):
+    """Lock of a device held by a request rather than by a green thread.
+
+    It is reentrant for the request, so green threads running steps of
+    the request join it, see executor.execute_parallel. Other requests
+    and changes made outside of a request wait for it.
+    """
+
+    def __init__(self):
+        self._sem = semaphore.Semaphore(1)
+        self._owner = None
+        self._count = 0
+
+    def acquire(self):
+        owner = executor.request_owner()
+        if self._owner is not owner:
+            self._sem.acquire()
+            self._owner = owner
+        self._count += 1
+
+    def release(self):
+        self._count -= 1
+        if not self._count:
+            self._owner = None
+            self._sem.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.release()
+
+
+class DeviceRequestContextManager(commands.RollbackContextManager):
+    """Wraps a request to the device into the driver's request hooks.
+
+    begin_request() is called on enter. On a clean exit commit_request()
+    is called before the rollbacks are released, so an error raised by it
+    rolls the whole request back. rollback_request() is called before the
+    rollbacks are run. end_request() is always called last.
+
+    The context is bound to the green thread for the whole request, see
+    executor.current_context().
+    """
+
+    def __enter__(self):
+        context = super(DeviceRequestContextManager, self).__enter__()
+        outer = executor.current_context()
+        if outer is not None:
+            context.owner = outer.owner
+        self._binding = executor.bind_context(context)
+        self._binding.__enter__()
+        try:
+            context.device.begin_request(context)
+        except Exception:
+            self._binding.__exit__(None, None, None)
+            raise
+        return context
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        device = self.context.device
+        try:
+            if exc_type is None:
+                try:
+                    device.commit_request(self.context)
+                except Exception:
+                    exc_type, exc_value, exc_tb = sys.exc_info()
+            if exc_type is not None:
+                device.rollback_request(self.context)
+            return super(DeviceRequestContextManager, self).__exit__(
+                    exc_type, exc_value, exc_tb)
+        finally:
+            try:
+                device.end_request(self.context)
+            finally:
+                self._binding.__exit__(None, None, None)
 
 
 class BaseDriver(object):
@@ -30,9 +120,29 @@ class BaseDriver(object):
         self.device_ref = device_ref
 
     def request_context(self):
-        return commands.RollbackContextManager(
+        return DeviceRequestContextManager(
                 DeviceRequestContext(self.conf, self))
 
+    def begin_request(self, ctx):
+        pass
+
+    def commit_request(self, ctx):
+        pass
+
+    def rollback_request(self, ctx):
+        pass
+
+    def end_request(self, ctx):
+        pass
+
+    def wrap_rollback(self, rollback):
+        """Return the rollback to keep for a command of the request.
+
+        Called when the command adds its rollback, in the green thread
+        that executed the command, see executor.execute_parallel.
+        """
+        return rollback
+
     def checkNone(self, obj):
         if bool(obj):
             if obj != 'None':
@@ -90,6 +200,11 @@ class BaseDriver(object):
     def delete_real_server_from_server_farm(self, serverfarm, rserver):
         raise NotImplementedError
 
+    def update_real_server_in_server_farm(self, serverfarm, old_rserver,
+                                          new_rserver):
+        self.delete_real_server_from_server_farm(serverfarm, old_rserver)
+        self.add_real_server_to_server_farm(serverfarm, new_rserver)
+
     def add_probe_to_server_farm(self, serverfarm, probe):
         raise NotImplementedError
 
@@ -111,8 +226,30 @@ class BaseDriver(object):
     def get_statistics(self, serverfarm, rserver):
         raise NotImplementedError
 
+    def get_device_state(self):
+        """Return objects deployed on the device, read in bulk.
+
+        The result maps a kind of object to the objects of that kind keyed
+        by their names on the device: 'serverfarm', 'probe' and 'vip' map
+        a name to a dict, 'rserver' maps a (serverfarm name, rserver name)
+        pair to a dict with its 'state', 'inservice' or 'outofservice'.
+        Kinds the driver can't read are left out.
+        """
+        raise NotImplementedError
+
+    def get_statistics_all(self):
+        raise NotImplementedError
+
 
 def is_sequence(arg):
     return (not hasattr(arg, "strip") and
             hasattr(arg, "__getitem__") or
             hasattr(arg, "__iter__"))
+
+
+def get_field(obj, key):
+    """Return a field that is a column now but may still be in extra."""
+    value = obj.get(key)
+    if value is None:
+        value = (obj.get('extra') or {}).get(key)
+    return value
@@ -16,54 +16,221 @@
 #    under the License.
 
 import md5
-import urllib2
 import base64
 import logging
 import ipaddr
-from balancer.drivers.base_driver import BaseDriver, is_sequence
+from eventlet import corolocal
+from balancer.common import cfg
+from balancer.drivers.base_driver import BaseDriver, RequestLock
+from balancer.drivers.base_driver import is_sequence, get_field
+from balancer.drivers.cisco_ace import nat_pool as nat_pool_index
+from balancer.drivers.cisco_ace import running_config
+from balancer.drivers.cisco_ace import xml_agent
 import openstack.common.exception
 
 
 logger = logging.getLogger(__name__)
 
+ace_opts = [
+    cfg.IntOpt('ace_connection_pool_size', default=4,
+               help='Maximum number of HTTPS connections per ACE device.'),
+    cfg.IntOpt('ace_connection_idle_timeout', default=60,
+               help='Seconds after which an unused HTTPS connection to an '
+                    'ACE device is closed.'),
+    cfg.IntOpt('ace_request_timeout', default=60,
+               help='Seconds to wait for a response from ACE XML agent.'),
+    cfg.IntOpt('ace_config_ttl', default=30,
+               help='Seconds the parsed running config of an ACE device '
+                    'is reused between requests, 0 reads it once per '
+                    'request.'),
+]
+
+
+class QueuedConfig(object):
+    """Config snippet in the batch of a request."""
+
+    def __init__(self, text):
+        self.text = text
+        self.sent = False
+
 
 class AceDriver(BaseDriver):
     def __init__(self,  conf,  device_ref):
         super(AceDriver, self).__init__(conf, device_ref)
-        self.url = "https://%s:%s/bin/xml_agent" % (device_ref['ip'],
-                                                    device_ref['port'])
+        conf.register_opts(ace_opts)
         base64str = base64.encodestring('%s:%s' % \
             (device_ref['login'], device_ref['password']))[:-1]
         self.authheader = "Basic %s" % base64str
+        self._pool = None
+        self._request_lock = RequestLock()
+        self._request_depth = 0
+        self._batch = None
+        # NOTE: config queued by the green thread since its last command
+        # added a rollback, and whether its config is discarded
+        self._local = corolocal.local()
+        self._running_config = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = xml_agent.HTTPSConnectionPool(
+                    self.device_ref['ip'], int(self.device_ref['port']),
+                    max_size=self.conf.ace_connection_pool_size,
+                    idle_timeout=self.conf.ace_connection_idle_timeout,
+                    timeout=self.conf.ace_request_timeout)
+        return self._pool
+
+    def _send(self, lines):
+        data = "xml_cmd=<request_raw>\n%s\n</request_raw>" % \
+                "\n".join(lines)
+        logger.debug("send data to ACE:\n" + data)
+        s = self._get_pool().request(data, {
+            "Authorization": self.authheader,
+            "Content-Type": "application/x-www-form-urlencoded",
+        })
+        logger.debug("data from ACE:\n" + s)
+        return s
+
+    def _flush(self):
+        """Send the batched config snippets in one XML agent request."""
+        queued, self._batch = self._batch, []
+        if not queued:
+            return
+        for config in queued:
+            config.sent = True
+        snippets = [config.text for config in queued]
+        lines, owners = xml_agent.build_batch(snippets)
+        s = self._send(lines)
+        errors = xml_agent.map_errors(s, lines, owners)
+        if errors is None:
+            if s.find('XML_CMD_SUCCESS') > 0:
+                return
+            errors = {None: [('', s)]}
+        if not errors:
+            return
+        self._running_config = None
+        messages = []
+        for index in sorted(errors):
+            snippet = snippets[index] if index is not None else None
+            for command, text in errors[index]:
+                logger.error("[ACE] command %r of config:\n%s\nfailed: %s",
+                             command, snippet, text)
+                messages.append("%s: %s" % (command, text))
+        raise xml_agent.AceCommandError("ACE rejected commands: %s" %
+                                        "; ".join(messages))
+
+    def begin_request(self, ctx):
+        self._request_lock.acquire()
+        if self._batch is None:
+            self._batch = []
+        if not self._request_depth:
+            self._expire_running_config()
+        self._request_depth += 1
+
+    def commit_request(self, ctx):
+        if self._request_depth != 1:
+            return
+        self._flush()
+
+    def rollback_request(self, ctx):
+        # NOTE: not sent commands are dropped, rollbacks go to the device
+        # right away, see wrap_rollback
+        self._batch = None
+        self._running_config = None
+
+    def end_request(self, ctx):
+        self._request_depth -= 1
+        if not self._request_depth:
+            self._batch = None
+            self._local.queued = []
+        self._request_lock.release()
+
+    def wrap_rollback(self, rollback):
+        """Keep the rollback from sending config if the command sent none.
+
+        The config queued by the green thread since the previous rollback
+        belongs to the command. If none of it was sent when the request
+        is rolled back, the rollback still runs but its config is
+        discarded.
+        """
+        queued = getattr(self._local, 'queued', None)
+        self._local.queued = []
+        if not queued:
+            return rollback
+
+        def _inner(good):
+            if good or any(config.sent for config in queued):
+                return rollback(good)
+            self._local.muted = True
+            try:
+                rollback(good)
+            finally:
+                self._local.muted = False
+        return _inner
 
     def deployConfig(self, s):
-        request = urllib2.Request(self.url)
-        request.add_header("Authorization", self.authheader)
-        d = "xml_cmd=<request_raw>\nconfigure\n%s\nend\n</request_raw>" % s
-        logger.debug("send data to ACE:\n" + d)
+        if getattr(self._local, 'muted', False):
+            return 'OK'
+        if self._batch is not None:
+            config = QueuedConfig(s)
+            self._batch.append(config)
+            if getattr(self._local, 'queued', None) is None:
+                self._local.queued = []
+            self._local.queued.append(config)
+            return 'OK'
         try:
-            message = urllib2.urlopen(request, d)
-            s = message.read()
+            s = self._send(['configure', s, 'end'])
         except (Exception):
+            self._running_config = None
             return Exception
-        logger.debug("data from ACE:\n" + s)
         if (s.find('XML_CMD_SUCCESS') > 0):
             return 'OK'
         else:
+            self._running_config = None
             return Exception
 
     def getConfig(self, s):
-        request = urllib2.Request(self.url)
-        request.add_header("Authorization", self.authheader)
-        data = "xml_cmd=<request_raw>\nshow runn %s\n</request_raw>" % s
-        logger.debug("send data to ACE:\n" + data)
+        if self._batch:
+            self._flush()
         try:
-            message = urllib2.urlopen(request, data)
-            s = message.read()
+            return self._send(['show runn %s' % s])
         except (Exception):
             return Exception
-        logger.debug("data from ACE:\n" + s)
-        return s
+
+    def _expire_running_config(self):
+        config = self._running_config
+        if config is not None and config.expired(self.conf.ace_config_ttl):
+            self._running_config = None
+
+    def _get_running_config(self):
+        """Return the parsed running config, read it if there is none.
+
+        Within a request the same snapshot is used until the request ends,
+        changes made by the driver are applied to it as they are sent.
+        """
+        if not self._request_depth:
+            self._expire_running_config()
+        if self._running_config is None:
+            s = self.getConfig("")
+            if s is Exception:
+                raise xml_agent.AceCommandError(
+                        "Can't read running config of ACE %s" %
+                        self.device_ref['ip'])
+            self._running_config = running_config.RunningConfig.parse(s)
+        return self._running_config
+
+    def get_device_state(self):
+        self._running_config = None
+        config = self._get_running_config()
+        rservers = {}
+        for sf_name, members in config.serverfarms.iteritems():
+            for rs_name, state in members.iteritems():
+                rservers[(sf_name, rs_name)] = {'state': state}
+        return {
+            'serverfarm': dict((name, {}) for name in config.serverfarms),
+            'rserver': rservers,
+            'probe': dict((name, {}) for name in config.probes),
+            'vip': dict((name, {}) for name in config.class_maps),
+        }
 
     def create_nat_pool(self, nat_pool):
         cmd = "int vlan " + str(nat_pool['vlan']) + \
@@ -74,11 +241,16 @@ class AceDriver(BaseDriver):
         if nat_pool.get('pat'):
             cmd += " pat"
         self.deployConfig(cmd)
+        if self._running_config is not None:
+            self._running_config.add_nat_pool(nat_pool)
 
     def delete_nat_pool(self, nat_pool):
         cmd = "int vlan " + nat_pool['vlan'] + "\nno nat-pool " + \
               nat_pool['id']
         self.deployConfig(cmd)
+        if self._running_config is not None:
+            self._running_config.delete_nat_pool(nat_pool['vlan'],
+                                                 nat_pool['id'])
 
     def add_nat_pool_to_vip(self, nat_pool, vip):
         cmd = "policy-map multi-match "
@@ -105,46 +277,17 @@ class AceDriver(BaseDriver):
         self.deployConfig(cmd)
 
     def get_nat_pools(self):
-        vlan_interfaces = self.getConfig("| i interface vlan").split('\n')
-        result = []
-        for vlan in vlan_interfaces:
-            s = self.getConfig("int vlan %s | i nat-pool" % vlan).split('\n')
-            for f in s:
-                f = f.split()
-            r = []
-            for w in f:
-                if len(w) > 4:
-                    r.append(w)
-            if len(r) > 0:
-                res = {}
-                res['vlan'] = vlan[-1]
-                res['id'] = r[0]
-                res['ip1'] = r[1]
-                if len(r) > 3:
-                    res['ip2'] = r[2]
-                    res['netmask'] = r[3]
-                else:
-                    res['ip2'] = r[1]
-                    res['netmask'] = r[2]
-                result.append(res)
-        return result
+        return self._get_running_config().get_nat_pools()
 
-    def find_nat_pool_for_vip(self, vip):
+    def _get_vip_network(self, vip):
         if '4' in vip.get('ipVersion'):
-            ip = ipaddr.IPv4Address(vip['address'])
-            network = ipaddr.IPv4Network(vip['address'] + "/" + vip['mask'])
+            return ipaddr.IPv4Network(vip['address'] + "/" + vip['mask'])
         else:
-            ip = ipaddr.IPv6Address(vip['address'])
-            network = ipaddr.IPv6Network(vip['address'] + "/" + vip['mask'])
-        nat_pools = self.get_nat_pools()
-        for nat_pool in nat_pools:
-            if (nat_pool['ip1'] in network.iterhosts() and
-                nat_pool['ip2'] in network.iterhosst()):
-                ip = nat_pool['ip1']
-                network_nat = ipaddr.ip_network(ip + "/" + nat_pool['netmask'])
-                if ip in network_nat:
-                    return nat_pool
-        return None
+            return ipaddr.IPv6Network(vip['address'] + "/" + vip['mask'])
+
+    def find_nat_pool_for_vip(self, vip):
+        network = self._get_vip_network(vip)
+        return self._get_running_config().nat_pools.find(network)
 
     def generate_nat_pool_for_vip(self, vip):
         nat_pool = {}
@@ -155,20 +298,9 @@ class AceDriver(BaseDriver):
             logger.warning("\n\n Can't generate NAT Pool for All VLANs! \n\n")
             nat_pool['vlan'] = '-1'
         nat_pool['netmask'] = vip['mask']
-        if '4' in vip.get('ipVersion'):
-            network = ipaddr.IPv4Network(vip['address'] + "/" + vip['mask'])
-        else:
-            network = ipaddr.IPv6Network(vip['address'] + "/" + vip['mask'])
-        ips = []
-        for ip in network.iterhosts():
-            ips.append(ip)
-        nat_pool['ip1'] = ips[-1]
-        ids = []
-        for i in self.get_nat_pools():
-            ids.append(i.get('id'))
-        for i in range(1, 2000):
-            if not i in ids:
-                nat_pool['id'] = i
+        network = self._get_vip_network(vip)
+        nat_pool['ip1'] = str(nat_pool_index.get_last_host(network))
+        nat_pool['id'] = self._get_running_config().nat_pools.get_free_id()
         nat_pool['pat'] = True
         return nat_pool
 
@@ -245,9 +377,11 @@ class AceDriver(BaseDriver):
                 cmd += "\nwebhost-redirection " + srv_extra['webHostRedir']
                 if srv_extra.get('redirectionCode'):
                     cmd += " " + str(srv_extra['redirectionCode'])
-        if (srv_extra.get('maxCon') and srv_extra.get('minCon')):
-            cmd += "\nconn-limit max " + str(srv_extra['maxCon']) + \
-                " min " + str(srv_extra['minCon'])
+        max_con = get_field(rserver, 'maxCon')
+        min_con = get_field(rserver, 'minCon')
+        if (max_con and min_con):
+            cmd += "\nconn-limit max " + str(max_con) + \
+                " min " + str(min_con)
         if srv_extra.get('rateConnection'):
             cmd += "\nrate-limit connection " + \
                    str(srv_extra['rateConnection'])
@@ -301,12 +435,12 @@ class AceDriver(BaseDriver):
         cmd = "\nprobe " + pr_type + " " + probe['name']
         if pr_extra.get('description'):
             cmd += "\ndescription " + pr_extra['description']
-        if pr_extra.get('probeInterval'):
-            cmd += "\ninterval " + str(pr_extra['probeInterval'])
+        if get_field(probe, 'probeInterval'):
+            cmd += "\ninterval " + str(get_field(probe, 'probeInterval'))
         if (pr_type != 'vm'):
-            if pr_extra.get('passDetectInterval'):
+            if get_field(probe, 'passDetectInterval'):
                 cmd += "\npassdetect interval " + \
-                       str(pr_extra['passDetectInterval'])
+                       str(get_field(probe, 'passDetectInterval'))
             if pr_extra.get('passDetectCount'):
                 cmd += "\npassdetect count " + str(pr_extra['passDetectCount'])
             if pr_extra.get('failDetect'):
@@ -485,9 +619,11 @@ class AceDriver(BaseDriver):
             cmd += "\nbackup-rserver " + srv_extra['backupRS']
             if rs_extra.get('backupRSport'):
                 cmd += " " + str(rs_extra['backupRSport'])
-        if rs_extra.get('maxCon') and rs_extra.get('minCon'):
-            cmd += "\nconn-limit max " + str(rs_extra['maxCon']) + \
-                   " min " + str(rs_extra['minCon'])
+        max_con = get_field(rserver, 'maxCon')
+        min_con = get_field(rserver, 'minCon')
+        if max_con and min_con:
+            cmd += "\nconn-limit max " + str(max_con) + \
+                   " min " + str(min_con)
         if rs_extra.get('rateConnection'):
             cmd += "\nrate-limit connection " + \
                    str(rs_extra['rateConnection'])
@@ -497,9 +633,10 @@ class AceDriver(BaseDriver):
             cmd += "\ncookie-string " + rs_extra['cookieStr']
         if rs_extra.get('failOnAll'):
             cmd += "\nfail-on-all"
-        if rs_extra.get('state'):
+        state = get_field(rserver, 'state')
+        if state:
             cmd += "\ninservice"
-            if rs_extra.get('state').lower() == "standby":
+            if state.lower() == "standby":
                 cmd += " standby"
         self.deployConfig(cmd)
 
@@ -634,7 +771,8 @@ class AceDriver(BaseDriver):
         cmd = "access-list vip-acl extended permit ip any host " + \
               vip['address']
         self.deployConfig(cmd)
-        appProto = vip_extra.get('appProto')
+        appProto = get_field(vip, 'appProto')
+        proto = get_field(vip, 'proto')
         if appProto.lower() in ('other', 'http'):
             appProto = ""
         else:
@@ -650,8 +788,8 @@ class AceDriver(BaseDriver):
         if vip_extra.get('description'):
             cmd += "description " + vip_extra['description'] + "\n"
         cmd += "match virtual-address " + vip['address'] + " " + \
-               str(vip['mask']) + " " + vip_extra['proto'].lower()
-        if vip_extra['proto'].lower() != "any" and vip_extra.get('port'):
+               str(vip['mask']) + " " + proto.lower()
+        if proto.lower() != "any" and vip_extra.get('port'):
             cmd += " eq " + str(vip_extra['port'])
         cmd += "\nexit\npolicy-map multi-match " + pmap + "\nclass " + \
                vip['name']
@@ -661,6 +799,8 @@ class AceDriver(BaseDriver):
         if vip_extra.get('ICMPreply'):
             cmd += "\nloadbalance vip icmp-reply"
         self.deployConfig(cmd)
+        if self._running_config is not None:
+            self._running_config.add_policy_map_class(pmap, vip['name'])
         if vip_extra.get('allVLANs'):
             cmd = "service-policy input " + pmap
             try:
@@ -674,6 +814,8 @@ class AceDriver(BaseDriver):
                     cmd = "interface vlan " + str(i) + \
                           "\nservice-policy input " + pmap
                     self.deployConfig(cmd)
+                    if self._running_config is not None:
+                        self._running_config.add_service_policy(i, pmap)
                     cmd = "interface vlan " + str(i) + \
                           "\naccess-group input vip-acl"
                     try:
@@ -684,6 +826,8 @@ class AceDriver(BaseDriver):
                     cmd = "interface vlan " + str(VLAN) + \
                           "\nservice-policy input " + pmap
                     self.deployConfig(cmd)
+                    if self._running_config is not None:
+                        self._running_config.add_service_policy(VLAN, pmap)
                     cmd = "interface vlan " + str(VLAN) + \
                           "\naccess-group input vip-acl"
                     try:
@@ -704,14 +848,16 @@ class AceDriver(BaseDriver):
             pmap = "global"
         else:
             pmap = "int-" + str(md5.new(vip_extra['VLAN']).hexdigest())
+        config = self._get_running_config()
         cmd = "policy-map multi-match " + pmap + "\nno class " + vip['name']
         self.deployConfig(cmd)
+        config.delete_policy_map_class(pmap, vip['name'])
         cmd = "no class-map match-all " + vip['name'] + "\n"
         self.deployConfig(cmd)
         cmd = "no policy-map type loadbalance first-match " + \
               vip['name'] + "-l7slb"
         self.deployConfig(cmd)
-        if (self.getConfig("policy-map %s" % pmap).find("class") <= 0):
+        if not config.get_policy_map_classes(pmap):
             if vip_extra.get('allVLANs'):
                 cmd = "no service-policy input " + pmap
                 self.deployConfig(cmd)
@@ -728,6 +874,7 @@ class AceDriver(BaseDriver):
                         self.deployConfig(cmd)
             cmd = "no policy-map multi-match " + pmap
             self.deployConfig(cmd)
+            config.delete_policy_map(pmap)
         cmd = "no access-list vip-acl extended permit ip any host " + \
               vip['address']
         self.deployConfig(cmd)
@@ -0,0 +1,132 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+
+import ipaddr
+
+from openstack.common import exception
+
+
+MAX_NAT_POOL_ID = 1999
+
+
+class NoFreeNatPoolId(exception.Error):
+    pass
+
+
+def get_host_range(network):
+    """Return the first and the last usable host of a network as ints."""
+    first = int(network.network) + 1
+    last = int(network.broadcast) - 1
+    if first > last:
+        return int(network.network), int(network.broadcast)
+    return first, last
+
+
+def get_last_host(network):
+    return ipaddr.IPAddress(get_host_range(network)[1],
+                            version=network.version)
+
+
+class NatPoolIndex(object):
+    """Ids and address ranges of the NAT pools of one device.
+
+    Used ids are kept in a bitmap, so the lowest free id is found with a
+    few integer operations. Address ranges are kept sorted by the first
+    address, so pools within a network are found with a binary search
+    instead of walking the hosts of the network.
+    """
+
+    def __init__(self, max_id=MAX_NAT_POOL_ID):
+        self.max_id = max_id
+        # NOTE: bit 0 is always set, there is no pool with id 0
+        self._used_ids = 1
+        self._id_counts = {}
+        self._ranges = []
+        self._pools = {}
+
+    def __len__(self):
+        return len(self._pools)
+
+    def add(self, nat_pool):
+        key = (str(nat_pool['vlan']), str(nat_pool['id']))
+        self.remove(*key)
+        entry = _get_range(nat_pool)
+        self._pools[key] = (nat_pool, entry)
+        if entry is not None:
+            bisect.insort(self._ranges, entry + key)
+        pool_id = _get_id(nat_pool['id'])
+        if pool_id is not None:
+            self._id_counts[pool_id] = self._id_counts.get(pool_id, 0) + 1
+            self._used_ids |= 1 << pool_id
+
+    def remove(self, vlan, pool_id):
+        key = (str(vlan), str(pool_id))
+        nat_pool, entry = self._pools.pop(key, (None, None))
+        if nat_pool is None:
+            return
+        if entry is not None:
+            i = bisect.bisect_left(self._ranges, entry + key)
+            del self._ranges[i]
+        pool_id = _get_id(pool_id)
+        if pool_id is not None:
+            self._id_counts[pool_id] -= 1
+            if not self._id_counts[pool_id]:
+                del self._id_counts[pool_id]
+                self._used_ids &= ~(1 << pool_id)
+
+    def find(self, network):
+        """Return a pool with all addresses within the hosts of network."""
+        first, last = get_host_range(network)
+        i = bisect.bisect_left(self._ranges, (network.version, first))
+        while i < len(self._ranges):
+            version, start, end, vlan, pool_id = self._ranges[i]
+            if version != network.version or start > last:
+                break
+            if end <= last:
+                return self._pools[(vlan, pool_id)][0]
+            i += 1
+        return None
+
+    def get_free_id(self):
+        """Return the lowest id not used by any pool."""
+        used = self._used_ids
+        pool_id = (~used & (used + 1)).bit_length() - 1
+        if pool_id > self.max_id:
+            raise NoFreeNatPoolId("All NAT pool ids up to %s are used" %
+                                  self.max_id)
+        return pool_id
+
+
+def _get_id(pool_id):
+    try:
+        pool_id = int(pool_id)
+    except (TypeError, ValueError):
+        return None
+    return pool_id if pool_id > 0 else None
+
+
+def _get_range(nat_pool):
+    try:
+        ip1 = ipaddr.IPAddress(str(nat_pool['ip1']))
+        ip2 = ipaddr.IPAddress(str(nat_pool.get('ip2') or nat_pool['ip1']))
+    except ValueError:
+        return None
+    if ip1.version != ip2.version:
+        return None
+    return (ip1.version, int(min(ip1, ip2)), int(max(ip1, ip2)))
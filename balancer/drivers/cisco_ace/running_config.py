@@ -0,0 +1,149 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from balancer.drivers.cisco_ace import nat_pool as nat_pool_index
+
+
+class RunningConfig(object):
+    """Indexes of an ACE running config the driver reads.
+
+    vlans maps a VLAN number to its NAT pools, keyed by pool id, and the
+    service policies applied to the interface. policy_maps maps the name
+    of a multi-match policy map to the set of its classes. nat_pools
+    indexes the NAT pools of all VLANs by id and address range.
+
+    serverfarms maps a server farm name to the states of its real servers,
+    probes and class_maps are sets of names. These are not updated by the
+    driver, they are only read from a fresh snapshot.
+    """
+
+    def __init__(self, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.vlans = {}
+        self.policy_maps = {}
+        self.nat_pools = nat_pool_index.NatPoolIndex()
+        self.serverfarms = {}
+        self.probes = set()
+        self.class_maps = set()
+
+    @classmethod
+    def parse(cls, text, timestamp=None):
+        """Build indexes from the output of 'show running-config'."""
+        config = cls(timestamp)
+        vlan = None
+        policy_map = None
+        serverfarm = None
+        rserver = None
+        for line in text.splitlines():
+            words = line.split()
+            if not words:
+                continue
+            if not line[0].isspace():
+                vlan = policy_map = serverfarm = rserver = None
+                if words[0] == 'serverfarm' and len(words) > 1:
+                    serverfarm = config.serverfarms.setdefault(words[-1], {})
+                elif words[0] == 'probe' and len(words) > 2:
+                    config.probes.add(words[2])
+                elif words[:2] == ['class-map', 'match-all'] and \
+                        len(words) > 2:
+                    config.class_maps.add(words[2])
+                elif words[:2] == ['interface', 'vlan'] and len(words) > 2:
+                    vlan = words[2]
+                    config._get_vlan(vlan)
+                elif (words[:2] == ['policy-map', 'multi-match'] and
+                        len(words) > 2):
+                    policy_map = words[2]
+                    config.policy_maps.setdefault(policy_map, set())
+            elif vlan is not None:
+                if words[0] == 'nat-pool' and len(words) > 3:
+                    config.add_nat_pool(_parse_nat_pool(vlan, words[1:]))
+                elif words[:2] == ['service-policy', 'input'] and \
+                        len(words) > 2:
+                    config.add_service_policy(vlan, words[2])
+            elif policy_map is not None:
+                if words[0] == 'class' and len(words) > 1:
+                    config.policy_maps[policy_map].add(words[1])
+            elif serverfarm is not None:
+                indent = len(line) - len(line.lstrip())
+                if rserver is not None and indent > rserver[1]:
+                    if words[0] == 'inservice':
+                        serverfarm[rserver[0]] = 'inservice'
+                elif words[0] == 'rserver' and len(words) > 1:
+                    rserver = (words[1], indent)
+                    serverfarm[words[1]] = 'outofservice'
+                else:
+                    rserver = None
+        return config
+
+    def expired(self, ttl):
+        return time.time() - self.timestamp >= ttl
+
+    def _get_vlan(self, vlan):
+        vlan = str(vlan)
+        if vlan not in self.vlans:
+            self.vlans[vlan] = {'nat_pools': {}, 'service_policies': set()}
+        return self.vlans[vlan]
+
+    def get_nat_pools(self):
+        result = []
+        for vlan in sorted(self.vlans):
+            nat_pools = self.vlans[vlan]['nat_pools']
+            result.extend(nat_pools[pool_id]
+                          for pool_id in sorted(nat_pools))
+        return result
+
+    def add_nat_pool(self, nat_pool):
+        nat_pool = dict((key, str(value)) for key, value in
+                        nat_pool.iteritems() if key != 'pat')
+        nat_pool.setdefault('ip2', nat_pool['ip1'])
+        self._get_vlan(nat_pool['vlan'])['nat_pools'][nat_pool['id']] = \
+                nat_pool
+        self.nat_pools.add(nat_pool)
+
+    def delete_nat_pool(self, vlan, pool_id):
+        nat_pools = self.vlans.get(str(vlan), {}).get('nat_pools', {})
+        nat_pools.pop(str(pool_id), None)
+        self.nat_pools.remove(vlan, pool_id)
+
+    def add_service_policy(self, vlan, name):
+        self._get_vlan(vlan)['service_policies'].add(name)
+
+    def get_policy_map_classes(self, name):
+        return self.policy_maps.get(name, set())
+
+    def add_policy_map_class(self, name, class_name):
+        self.policy_maps.setdefault(name, set()).add(class_name)
+
+    def delete_policy_map_class(self, name, class_name):
+        self.policy_maps.get(name, set()).discard(class_name)
+
+    def delete_policy_map(self, name):
+        self.policy_maps.pop(name, None)
+        for vlan in self.vlans.itervalues():
+            vlan['service_policies'].discard(name)
+
+
+def _parse_nat_pool(vlan, words):
+    # nat-pool <id> <ip1> [<ip2>] [netmask] <netmask> [pat]
+    addresses = [word for word in words[1:] if word not in ('netmask', 'pat')]
+    nat_pool = {'vlan': vlan, 'id': words[0], 'ip1': addresses[0]}
+    if len(addresses) > 2:
+        nat_pool['ip2'] = addresses[1]
+    nat_pool['netmask'] = addresses[-1]
+    return nat_pool
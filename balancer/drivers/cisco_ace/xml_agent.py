@@ -0,0 +1,181 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import logging
+import re
+import threading
+import time
+
+from eventlet.green import httplib
+from eventlet.green import socket
+
+from openstack.common import exception
+
+
+logger = logging.getLogger(__name__)
+
+XML_AGENT_PATH = '/bin/xml_agent'
+SUCCESS_CODE = '100'
+
+_STATUS_RE = re.compile(r'<command>\s*(.*?)\s*</command>\s*'
+                        r'<status\s+code="(\d+)"\s+text="([^"]*)"', re.S)
+
+
+class AceCommandError(exception.Error):
+    pass
+
+
+class HTTPSConnectionPool(object):
+    """Bounded pool of keep-alive HTTPS connections to one ACE XML agent.
+
+    Connections are reused between requests and closed after idle_timeout
+    seconds without use. At most max_size connections are open at the
+    same time, callers wait for a free slot when the pool is exhausted.
+    """
+
+    def __init__(self, host, port, max_size=4, idle_timeout=60, timeout=60):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._free = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_size)
+
+    def _connect(self):
+        logger.debug("[ACE] open https connection to %s:%s",
+                     self.host, self.port)
+        return httplib.HTTPSConnection(self.host, self.port,
+                                       timeout=self.timeout)
+
+    def _pop_free(self):
+        with self._lock:
+            deadline = time.time() - self.idle_timeout
+            idle = [conn for conn, last_used in self._free
+                    if last_used < deadline]
+            self._free = [(conn, last_used) for conn, last_used in self._free
+                          if last_used >= deadline]
+            conn = self._free.pop()[0] if self._free else None
+        for idle_conn in idle:
+            idle_conn.close()
+        return conn
+
+    def get(self):
+        self._slots.acquire()
+        try:
+            return self._pop_free() or self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put(self, conn, broken=False):
+        try:
+            if broken:
+                conn.close()
+            else:
+                with self._lock:
+                    self._free.append((conn, time.time()))
+        finally:
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        broken = False
+        try:
+            yield conn
+        except (httplib.HTTPException, socket.error):
+            broken = True
+            raise
+        finally:
+            self.put(conn, broken)
+
+    def request(self, body, headers):
+        """POST body to the XML agent and return the response body.
+
+        A request that fails on a reused connection is sent once more on
+        a new one, the device may have closed the idle connection.
+        """
+        for reused in (True, False):
+            with self.connection() as conn:
+                fresh = conn.sock is None
+                try:
+                    conn.request('POST', XML_AGENT_PATH, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error):
+                    if fresh or not reused:
+                        raise
+                    logger.debug("[ACE] retry request on a new connection "
+                                 "to %s:%s", self.host, self.port)
+                    conn.close()
+                    continue
+                if response.will_close:
+                    conn.close()
+                return data
+
+    def close_all(self):
+        with self._lock:
+            free, self._free = self._free, []
+        for conn, _last_used in free:
+            conn.close()
+
+
+def parse_statuses(response):
+    """Return (command, code, text) of every command in an agent response."""
+    return _STATUS_RE.findall(response)
+
+
+def build_batch(snippets):
+    """Return the CLI lines of a batch and the snippet index of each line.
+
+    Every snippet is run in its own configure ... end block, so a snippet
+    that leaves the CLI in a submode does not affect the next one.
+    """
+    lines = []
+    owners = []
+    for index, snippet in enumerate(snippets):
+        for line in ['configure'] + snippet.split('\n') + ['end']:
+            lines.append(line)
+            owners.append(index)
+    return lines, owners
+
+
+def map_errors(response, lines, owners):
+    """Return {snippet index: [(command, message)]} of failed commands.
+
+    Statuses come back in the order commands were sent, each one is
+    matched to the next sent line with the same text. Returns None when
+    the response has no per-command statuses.
+    """
+    statuses = parse_statuses(response)
+    if not statuses:
+        return None
+    errors = {}
+    position = 0
+    for command, code, text in statuses:
+        owner = None
+        for i in xrange(position, len(lines)):
+            if lines[i].strip() == command.strip():
+                owner = owners[i]
+                position = i + 1
+                break
+        if code != SUCCESS_CODE:
+            errors.setdefault(owner, []).append((command, text))
+    return errors
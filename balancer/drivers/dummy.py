@@ -103,3 +103,7 @@ class DummyDriver(BaseDriver):
     def get_statistics(self, serverfarm, rserver):
         logger.debug("Called DummyDriver.getStatistics(%r, %r).",
                      serverfarm, rserver)
+
+    def get_statistics_all(self):
+        logger.debug("Called DummyDriver.getStatisticsAll().")
+        return {}
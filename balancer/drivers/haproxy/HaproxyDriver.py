@@ -17,25 +17,79 @@
 #    under the License
 
 
+import contextlib
+import itertools
 import logging
-from balancer.drivers.base_driver import BaseDriver
+import threading
+import time
+
+from collections import OrderedDict
+
+import eventlet
+
+from openstack.common import exception
+
+from balancer.common import cfg
+from balancer.drivers.base_driver import BaseDriver, RequestLock
+from balancer.drivers.haproxy.RemoteControl import SSHConnectionPool
+from balancer.drivers.haproxy.RemoteControl import HaproxySocketChannel
+from balancer.drivers.haproxy.RemoteControl import GracefulReload
+from balancer.drivers.haproxy.RemoteControl import MasterWorkerReload
+from balancer.drivers.haproxy.RemoteControl import RestartReload
 from balancer.drivers.haproxy.RemoteControl import RemoteConfig
 from balancer.drivers.haproxy.RemoteControl import RemoteInterface
 from balancer.drivers.haproxy.RemoteControl import RemoteSocketOperation
+from balancer.drivers.haproxy.RemoteControl import RemoteStatistics
 
 
 logger = logging.getLogger(__name__)
 
+haproxy_opts = [
+    cfg.IntOpt('haproxy_ssh_pool_size', default=4,
+               help='Maximum number of SSH connections per haproxy device.'),
+    cfg.IntOpt('haproxy_ssh_idle_timeout', default=300,
+               help='Seconds after which an unused SSH connection to a '
+                    'haproxy device is closed.'),
+    cfg.IntOpt('haproxy_ssh_keepalive', default=30,
+               help='Interval in seconds between SSH keepalive packets, '
+                    '0 disables keepalive.'),
+    cfg.StrOpt('haproxy_reload_method', default='auto',
+               help='How haproxy picks up a new configuration: graceful '
+                    '(-sf, plus -x to take over the listening sockets '
+                    'when the device has a stats socket, starts haproxy '
+                    'outside of the init system), master-worker, auto, '
+                    'which uses master-worker if the device has '
+                    'master_socket and graceful otherwise, or restart '
+                    'through the service script, which drops connections '
+                    'and is only used if set explicitly. Can be '
+                    'overridden by reload_method in device extra.'),
+    cfg.BoolOpt('haproxy_async_persist', default=True,
+                help='Persist changes applied through the runtime API to '
+                     'the config file in background, after the request '
+                     'is finished.'),
+    cfg.IntOpt('haproxy_socket_timeout', default=10,
+               help='Seconds to wait for a response from haproxy stats '
+                    'socket.'),
+    cfg.IntOpt('haproxy_stats_ttl', default=5,
+               help='Seconds the statistics of all servers of a haproxy '
+                    'device are cached, 0 disables caching.'),
+]
+
 
 class HaproxyDriver(BaseDriver):
     def __init__(self, conf, device_ref):
         super(HaproxyDriver, self).__init__(conf, device_ref)
+        conf.register_opts(haproxy_opts)
+        self.connection_pool = SSHConnectionPool(device_ref,
+                max_size=conf.haproxy_ssh_pool_size,
+                idle_timeout=conf.haproxy_ssh_idle_timeout,
+                keepalive=conf.haproxy_ssh_keepalive)
         device_extra = self.device_ref.get('extra') or {}
         if ((device_extra.get('local_conf_dir') is None) or
                 (device_extra['local_conf_dir'] == "None")):
             self.localpath = '/tmp/'
         else:
-            self.localpath = device_extra['localpath']
+            self.localpath = device_extra['local_conf_dir']
         if ((device_extra.get('remote_conf_dir') is None) or
                 (device_extra['remote_conf_dir'] == "None")):
             self.remotepath = '/etc/haproxy/'
@@ -50,12 +104,128 @@ class HaproxyDriver(BaseDriver):
                 (device_extra['interface'] == "None")):
             self.interface = 'eth0'
         else:
-            self.interface = device_ref['interface']
+            self.interface = device_extra['interface']
         if ((device_extra.get('socket') is None) or
                 (device_extra['socket'] == "None")):
             self.haproxy_socket = '/tmp/haproxy.sock'
         else:
             self.haproxy_socket = device_extra['socket']
+        self.reloader = self._get_reloader(device_extra)
+        self.socket_channel = HaproxySocketChannel(self.connection_pool,
+                self.haproxy_socket, timeout=conf.haproxy_socket_timeout)
+        self._request_lock = RequestLock()
+        self._request_depth = 0
+        self._transaction = None
+        self._persist_thread = None
+        self.runtime_add_server = bool(device_extra.get('runtime_add_server'))
+        self._stats_lock = threading.Lock()
+        self._stats = None
+        self._stats_time = 0
+
+    def _get_reloader(self, device_extra):
+        method = (device_extra.get('reload_method') or
+                  self.conf.haproxy_reload_method)
+        master_socket = device_extra.get('master_socket')
+        if method == 'auto':
+            method = 'master-worker' if master_socket else 'graceful'
+        if method == 'master-worker':
+            if master_socket:
+                return MasterWorkerReload(master_socket)
+            logger.error('[HAPROXY] master-worker reload requires '
+                         'master_socket, use graceful')
+            method = 'graceful'
+        if method == 'restart':
+            return RestartReload()
+        if method != 'graceful':
+            logger.error('[HAPROXY] unknown reload method %s, use graceful',
+                         method)
+        # NOTE: sockets are taken over from the stats socket set for the
+        # device, expose_fd turns it on or off explicitly
+        expose_fd = device_extra.get('expose_fd')
+        if expose_fd is None:
+            expose_fd = device_extra.get('socket') not in (None, 'None')
+        fd_socket = self.haproxy_socket if expose_fd else None
+        return GracefulReload('%s/%s' % (self.remotepath,
+                                         self.configfilename),
+                              device_extra.get('pidfile') or
+                                  '/var/run/haproxy.pid',
+                              fd_socket)
+
+    def _new_transaction(self):
+        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
+                                        self.configfilename))
+        remote = RemoteConfig(self.device_ref, self.localpath,
+                              self.remotepath, self.configfilename,
+                              pool=self.connection_pool,
+                              reloader=self.reloader)
+        return HaproxyConfigTransaction(remote, config_file)
+
+    def _get_transaction(self):
+        '''
+            Wait for background persist and start new transaction, or
+            continue the failed one so its changes are not lost
+        '''
+        thread, self._persist_thread = self._persist_thread, None
+        if thread is not None:
+            transaction = thread.wait()
+            if transaction is not None:
+                return transaction
+        return self._new_transaction()
+
+    def _persist(self, transaction):
+        try:
+            transaction.commit()
+        except Exception:
+            logger.exception('[HAPROXY] failed to persist runtime changes, '
+                             'retry with the next request')
+            return transaction
+
+    def begin_request(self, ctx):
+        self._request_lock.acquire()
+        if self._transaction is None:
+            self._transaction = self._get_transaction()
+        self._request_depth += 1
+
+    def commit_request(self, ctx):
+        if self._request_depth != 1:
+            return
+        transaction = self._transaction
+        if (self.conf.haproxy_async_persist and transaction.dirty and
+                not transaction.needs_reload):
+            self._persist_thread = eventlet.spawn(self._persist, transaction)
+        else:
+            transaction.commit()
+
+    def end_request(self, ctx):
+        self._request_depth -= 1
+        if not self._request_depth:
+            self._transaction = None
+        self._request_lock.release()
+
+    @contextlib.contextmanager
+    def _edit_config(self, reload=True):
+        '''
+            Edit the config within the current request or, outside of
+            a request, push the change right away
+
+            reload=False is for edits already applied to the running
+            haproxy through the runtime API, they only need to persist.
+
+            The request lock is held for the whole edit. It belongs to
+            the request, so steps of the request running in other green
+            threads join its transaction, while an edit made outside of
+            the request waits for it to finish.
+        '''
+        with self._request_lock:
+            transaction = self._transaction
+            if transaction is None:
+                transaction = self._get_transaction()
+                yield transaction.get_config_file()
+                transaction.mark_dirty(reload)
+                transaction.commit()
+            else:
+                yield transaction.get_config_file()
+                transaction.mark_dirty(reload)
 
     def add_probe_to_server_farm(self, serverfarm, probe):
         '''
@@ -71,14 +241,10 @@ class HaproxyDriver(BaseDriver):
         haproxy_serverfarm.name = serverfarm['name']
         self.del_lines = ['option httpchk', 'option ssl-hello-chk',
                                                         'http-check expect']
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                        self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
-        remote.get_config()
         if type_of_operation == 'del':
-            config_file.del_lines_from_backend_block(haproxy_serverfarm,
-                                                                self.del_lines)
+            with self._edit_config() as config_file:
+                config_file.del_lines_from_backend_block(haproxy_serverfarm,
+                                                         self.del_lines)
         elif type_of_operation == 'add':
             pr_type = probe['type'].lower()
             if pr_type not in ('http', 'https', 'tcp'):
@@ -114,11 +280,11 @@ class HaproxyDriver(BaseDriver):
                 self.new_lines = ["option httpchk"]
             elif pr_type == "https":
                 self.new_lines = ["option ssl-hello-chk"]
-            config_file.del_lines_from_backend_block(haproxy_serverfarm,
-                    self.del_lines)
-            config_file.add_lines_to_backend_block(haproxy_serverfarm,
-                    self.new_lines)
-        remote.put_config()
+            with self._edit_config() as config_file:
+                config_file.del_lines_from_backend_block(haproxy_serverfarm,
+                        self.del_lines)
+                config_file.add_lines_to_backend_block(haproxy_serverfarm,
+                        self.new_lines)
 
     def add_real_server_to_server_farm(self, serverfarm, rserver):
         haproxy_serverfarm = HaproxyBackend()
@@ -129,36 +295,83 @@ class HaproxyDriver(BaseDriver):
         haproxy_rserver.address = rserver['address']
         haproxy_rserver.port = rserver['port']
         haproxy_rserver.maxconn = rserver['maxCon']
-        #Modify remote config file, check and restart remote haproxy
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                        self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
         logger.debug('[HAPROXY] Creating rserver %s in the'
                      'backend block %s' %
                      (haproxy_rserver.name, haproxy_serverfarm.name))
-        remote.get_config()
-        config_file.add_rserver_to_backend_block(haproxy_serverfarm,
-                                             haproxy_rserver)
-        remote.put_config()
+        applied = False
+        if self.runtime_add_server:
+            remote_socket = RemoteSocketOperation(self.device_ref,
+                                        haproxy_serverfarm, rserver,
+                                        pool=self.connection_pool,
+                                        channel=self.socket_channel)
+            applied = remote_socket.add_server(haproxy_rserver.address,
+                    haproxy_rserver.port, 'check maxconn %s weight %s' %
+                    (haproxy_rserver.maxconn, haproxy_rserver.weight))
+        with self._edit_config(reload=not applied) as config_file:
+            config_file.add_rserver_to_backend_block(haproxy_serverfarm,
+                                                     haproxy_rserver)
 
     def delete_real_server_from_server_farm(self, serverfarm, rserver):
         haproxy_serverfarm = HaproxyBackend()
         haproxy_serverfarm.name = serverfarm['name']
         haproxy_rserver = HaproxyRserver()
         haproxy_rserver.name = rserver['name']
-        #Modify remote config file, check and restart remote haproxy
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                                self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
         logger.debug('[HAPROXY] Deleting rserver %s in the'
                      'backend block %s' %
                      (haproxy_rserver.name, haproxy_serverfarm.name))
-        remote.get_config()
-        config_file.del_rserver_from_backend_block(haproxy_serverfarm,
-                                               haproxy_rserver)
-        remote.put_config()
+        applied = False
+        if self.runtime_add_server:
+            remote_socket = RemoteSocketOperation(self.device_ref,
+                                        haproxy_serverfarm, rserver,
+                                        pool=self.connection_pool,
+                                        channel=self.socket_channel)
+            applied = remote_socket.del_server()
+        with self._edit_config(reload=not applied) as config_file:
+            config_file.del_rserver_from_backend_block(haproxy_serverfarm,
+                                                       haproxy_rserver)
+
+    def update_real_server_in_server_farm(self, serverfarm, old_rserver,
+                                          new_rserver):
+        '''
+            Apply address, port, weight and maxconn changes through
+            the runtime API, reload haproxy only if that fails
+        '''
+        if old_rserver['name'] != new_rserver['name']:
+            return super(HaproxyDriver, self).\
+                    update_real_server_in_server_farm(serverfarm,
+                                                      old_rserver,
+                                                      new_rserver)
+        haproxy_serverfarm = HaproxyBackend()
+        haproxy_serverfarm.name = serverfarm['name']
+        haproxy_rserver = HaproxyRserver()
+        haproxy_rserver.name = new_rserver['name']
+        haproxy_rserver.weight = new_rserver['weight']
+        haproxy_rserver.address = new_rserver['address']
+        haproxy_rserver.port = new_rserver['port']
+        haproxy_rserver.maxconn = new_rserver['maxCon']
+        remote_socket = RemoteSocketOperation(self.device_ref,
+                                        haproxy_serverfarm, new_rserver,
+                                        pool=self.connection_pool,
+                                        channel=self.socket_channel)
+        logger.debug('[HAPROXY] Updating rserver %s in the backend block %s',
+                     haproxy_rserver.name, haproxy_serverfarm.name)
+        applied = True
+        if (old_rserver['address'] != new_rserver['address'] or
+                old_rserver['port'] != new_rserver['port']):
+            applied = remote_socket.set_addr(haproxy_rserver.address,
+                                             haproxy_rserver.port)
+        if applied and old_rserver['weight'] != new_rserver['weight']:
+            applied = remote_socket.set_weight(haproxy_rserver.weight)
+        if applied and old_rserver['maxCon'] != new_rserver['maxCon']:
+            applied = remote_socket.set_maxconn(haproxy_rserver.maxconn)
+        with self._edit_config(reload=not applied) as config_file:
+            section = config_file.get_section(haproxy_serverfarm.type,
+                                              haproxy_serverfarm.name)
+            line = section and section.get_server(haproxy_rserver.name)
+            haproxy_rserver.disabled = bool(line and
+                                            line.endswith(' disabled'))
+            config_file.add_rserver_to_backend_block(haproxy_serverfarm,
+                                                     haproxy_rserver)
 
     def create_virtual_ip(self, virtualserver, serverfarm):
         if not bool(virtualserver['name']):
@@ -173,17 +386,12 @@ class HaproxyDriver(BaseDriver):
         logger.debug('[HAPROXY] create VIP %s' % haproxy_serverfarm.name)
         #Add new IP address
         remote_interface = RemoteInterface(self.device_ref,
-                                           haproxy_virtualserver)
+                                           haproxy_virtualserver,
+                                           pool=self.connection_pool)
         remote_interface.add_ip()
-        #Modify remote config file, check and restart remote haproxy
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                        self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
-        remote.get_config()
-        config_file.add_frontend(haproxy_virtualserver, haproxy_serverfarm)
-        remote.put_config()
-        remote.validate_config()
+        with self._edit_config() as config_file:
+            config_file.add_frontend(haproxy_virtualserver,
+                                     haproxy_serverfarm)
 
     def delete_virtual_ip(self, virtualserver):
         logger.debug('[HAPROXY] delete VIP')
@@ -193,46 +401,76 @@ class HaproxyDriver(BaseDriver):
         haproxy_virtualserver = HaproxyFronted()
         haproxy_virtualserver.name = virtualserver['name']
         haproxy_virtualserver.bind_address = virtualserver['address']
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                        self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
-        #Check ip for using in the another frontend
-        if not config_file.find_string_in_the_block('frontend',
-            haproxy_virtualserver.bind_address):
+        with self._edit_config() as config_file:
+            #Check ip for using in the another frontend
+            frontends = config_file.get_frontends_by_address(
+                    haproxy_virtualserver.bind_address)
+            config_file.delete_block(haproxy_virtualserver)
+        if not [name for name in frontends
+                if name != haproxy_virtualserver.name]:
             logger.debug('[HAPROXY] ip %s does not using in the other '
                                  'frontend, delete it from remote interface' %
                                   haproxy_virtualserver.bind_address)
             remote_interface = RemoteInterface(self.device_ref,
-                                               haproxy_virtualserver)
+                                               haproxy_virtualserver,
+                                               pool=self.connection_pool)
             remote_interface.del_ip()
-        remote.get_config()
-        config_file.delete_block(haproxy_virtualserver)
-        remote.put_config()
+
+    def get_statistics_all(self):
+        '''
+            Statistics of all proxies and servers of the device keyed by
+            (backend, server), one "show stat" per haproxy_stats_ttl
+        '''
+        with self._stats_lock:
+            now = time.time()
+            if (self._stats is None or
+                    now - self._stats_time >= self.conf.haproxy_stats_ttl):
+                remote_stats = RemoteStatistics(self.device_ref,
+                                                pool=self.connection_pool,
+                                                channel=self.socket_channel)
+                self._stats = remote_stats.get_all()
+                self._stats_time = now
+            return self._stats
+
+    def get_device_state(self):
+        '''
+            Backends, their servers and frontends from the config file,
+            servers in maintenance by "show stat" are out of service
+        '''
+        with self.request_context():
+            config_file = self._transaction.get_config_file()
+            stats = self.get_statistics_all()
+            serverfarms = {}
+            rservers = {}
+            for section in config_file.get_sections('backend'):
+                serverfarms[section.name] = {}
+                for name, line in section.servers():
+                    row = stats.get((section.name, name)) or {}
+                    if (line.endswith(' disabled') or
+                            row.get('status') == 'MAINT'):
+                        state = 'outofservice'
+                    else:
+                        state = 'inservice'
+                    rservers[(section.name, name)] = {'state': state}
+            vips = dict((section.name, {}) for section in
+                        config_file.get_sections('frontend'))
+        return {'serverfarm': serverfarms, 'rserver': rservers, 'vip': vips}
 
     def get_statistics(self, serverfarm, rserver):
-        haproxy_rserver = HaproxyRserver()
-        haproxy_rserver.name = rserver['name']
-        haproxy_serverfarm = HaproxyBackend()
-        haproxy_serverfarm.name = serverfarm['name']
-        remote_socket = RemoteSocketOperation(self.device_ref,
-                                        haproxy_serverfarm, haproxy_rserver,
-                                        self.interface, self.haproxy_socket)
-        out = remote_socket.get_statistics()
+        row = self.get_statistics_all().get((serverfarm['name'],
+                                             rserver['name']))
         statistics = {}
-        if out:
-            status_line = out.split(",")
-            statistics['weight'] = status_line[18]
-            statistics['state'] = status_line[17]
-            statistics['connCurrent'] = [4]
-            statistics['connTotal'] = [7]
-            statistics['connFail'] = [13]
-            statistics['connMax'] = [5]
-            statistics['connRateLimit'] = [34]
-            statistics['bandwRateLimit'] = [35]
-# NOTE: broken because use indeterminate state variable
-#        logger.debug('[HAPROXY] statistics rserver state is \'%s\'',
-#                statistics.state)
+        if row:
+            statistics['weight'] = row.get('weight')
+            statistics['state'] = row.get('status')
+            statistics['connCurrent'] = row.get('scur')
+            statistics['connTotal'] = row.get('stot')
+            statistics['connFail'] = row.get('econ')
+            statistics['connMax'] = row.get('smax')
+            statistics['connRateLimit'] = row.get('rate_lim')
+            statistics['bandwRateLimit'] = row.get('rate_max')
+            logger.debug('[HAPROXY] statistics rserver state is \'%s\'',
+                         statistics['state'])
         return statistics
 
     def suspend_real_server(self, serverfarm, rserver):
@@ -247,23 +485,22 @@ class HaproxyDriver(BaseDriver):
         haproxy_rserver.name = rserver['name']
         haproxy_serverfarm = HaproxyBackend()
         haproxy_serverfarm.name = serverfarm['name']
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                        self.configfilename))
-        remote_config = RemoteConfig(self.device_ref, self.localpath,
-                                     self.remotepath, self.configfilename)
         remote_socket = RemoteSocketOperation(self.device_ref,
-                                        haproxy_serverfarm, haproxy_rserver,
-                                        self.interface, self.haproxy_socket)
-        remote_config.get_config()
+                                        haproxy_serverfarm, rserver,
+                                        pool=self.connection_pool,
+                                        channel=self.socket_channel)
         if type_of_operation == 'suspend':
-            config_file.enable_disable_reserver_in_backend_block(
-                             haproxy_serverfarm, haproxy_rserver, 'disable')
-            remote_socket.suspend_server()
+            operation = 'disable'
+            applied = remote_socket.suspend_server()
         elif type_of_operation == 'activate':
+            operation = 'enable'
+            applied = remote_socket.activate_server()
+        else:
+            return
+        #Runtime state is already changed, reload only if socket failed
+        with self._edit_config(reload=not applied) as config_file:
             config_file.enable_disable_reserver_in_backend_block(
-                             haproxy_serverfarm, haproxy_rserver, 'enable')
-            remote_socket.activate_server()
-        remote_config.put_config()
+                             haproxy_serverfarm, haproxy_rserver, operation)
 
     def create_server_farm(self, serverfarm, predictor):
         if not bool(serverfarm['name']):
@@ -281,13 +518,8 @@ class HaproxyDriver(BaseDriver):
         elif predictor['type'] == 'HashURL':
             haproxy_serverfarm.balance = 'uri'
 
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                                self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
-        remote.get_config()
-        config_file.add_backend(haproxy_serverfarm)
-        remote.put_config()
+        with self._edit_config() as config_file:
+            config_file.add_backend(haproxy_serverfarm)
 
     def delete_server_farm(self, serverfarm):
         if not bool(serverfarm['name']):
@@ -295,13 +527,49 @@ class HaproxyDriver(BaseDriver):
             return 'SERVER FARM NAME ERROR'
         haproxy_serverfarm = HaproxyBackend()
         haproxy_serverfarm.name = serverfarm['name']
-        config_file = HaproxyConfigFile('%s/%s' % (self.localpath,
-                                                self.configfilename))
-        remote = RemoteConfig(self.device_ref, self.localpath,
-                              self.remotepath, self.configfilename)
-        remote.get_config()
-        config_file.delete_block(haproxy_serverfarm)
-        remote.put_config()
+        with self._edit_config() as config_file:
+            config_file.delete_block(haproxy_serverfarm)
+
+
+class HaproxyConfigTransaction(object):
+    '''
+    Config changes made to one haproxy device within one request
+
+    The config is fetched from the device on first use, all edits go to
+    the parsed copy in memory and commit() writes and pushes it back
+    once: one upload, one validation and at most one reload however many
+    edits were made. Reload is skipped if all edits are already applied
+    through the runtime API.
+    '''
+    def __init__(self, remote_config, config_file):
+        self.remote_config = remote_config
+        self.config_file = config_file
+        self.fetched = False
+        self.dirty = False
+        self.needs_reload = False
+        self._lock = threading.Lock()
+
+    def get_config_file(self):
+        with self._lock:
+            if not self.fetched:
+                self.remote_config.get_config()
+                self.config_file.load()
+                self.fetched = True
+        return self.config_file
+
+    def mark_dirty(self, reload=True):
+        self.dirty = True
+        self.needs_reload = self.needs_reload or reload
+
+    def commit(self):
+        if not self.dirty:
+            return
+        logger.debug('[HAPROXY] commit configuration changes')
+        self.config_file.save()
+        if not self.remote_config.push_config(reload=self.needs_reload):
+            raise exception.Error('Haproxy rejected the new configuration')
+        self.dirty = False
+        self.needs_reload = False
 
 
 class HaproxyConfigBlock:
@@ -362,117 +630,276 @@ class HaproxyRserver():
         self.weight = 1
 
 
+class HaproxyConfigSection(object):
+    '''
+    One section of haproxy config file
+
+    Lines are kept in their original order, server lines are keyed by
+    server name so that they can be found, replaced and removed in O(1).
+    '''
+    def __init__(self, header=None):
+        self.header = header
+        words = header.split() if header else []
+        self.type = words[0] if words else ''
+        self.name = words[1] if len(words) > 1 else ''
+        self.address = words[2] if len(words) > 2 else ''
+        self._lines = OrderedDict()
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _parse_server(line):
+        words = line.split()
+        if len(words) > 1 and words[0] == 'server':
+            return words[1]
+        return None
+
+    def add_line(self, line):
+        server_name = self._parse_server(line)
+        if server_name is not None:
+            self._lines[('server', server_name)] = line
+        else:
+            self._lines[self._counter.next()] = line
+
+    def get_server(self, name):
+        return self._lines.get(('server', name))
+
+    def set_server(self, name, line):
+        '''
+            Replace server line in place or append a new one
+        '''
+        self._lines[('server', name)] = line
+
+    def set_option(self, keyword, line):
+        '''
+            Replace the first line with keyword in place or append line
+        '''
+        for key, old_line in self._lines.iteritems():
+            if not isinstance(key, tuple) and \
+                    old_line.split()[:1] == [keyword]:
+                self._lines[key] = line
+                return
+        self.add_line(line)
+
+    def del_server(self, name):
+        return self._lines.pop(('server', name), None) is not None
+
+    def del_lines_containing(self, strings):
+        for key, line in self._lines.items():
+            for s in strings:
+                if line.find(s) >= 0:
+                    logger.debug('[HAPROXY] delete line \'%s\'' % s)
+                    del self._lines[key]
+                    break
+
+    def lines(self):
+        return self._lines.values()
+
+    def servers(self):
+        '''
+            (name, line) of every server line
+        '''
+        return [(key[1], line) for key, line in self._lines.iteritems()
+                if isinstance(key, tuple)]
+
+    def bind_addresses(self):
+        addresses = []
+        if self.address:
+            addresses.append(self.address.rsplit(':', 1)[0])
+        for line in self._lines.itervalues():
+            words = line.split()
+            if len(words) > 1 and words[0] == 'bind':
+                addresses.append(words[1].rsplit(':', 1)[0])
+        return addresses
+
+    def serialize(self):
+        if self.header is None:
+            return list(self._lines.itervalues())
+        return [self.header] + list(self._lines.itervalues())
+
+
 class HaproxyConfigFile:
+    '''
+    Parsed haproxy config file
+
+    The file is parsed once on first use and kept in memory: a list of
+    sections in their original order, an index of named proxies by
+    (type, name) and an index from bind address to frontends. Blank and
+    comment lines are kept in the section they follow, so an unchanged
+    file is written back as it was read. Edits change only the memory
+    model, save() writes the whole file back in one pass.
+    '''
+    section_types = ('global', 'defaults', 'listen', 'backend', 'frontend')
+    proxy_types = ('listen', 'backend', 'frontend')
+
     def __init__(self, haproxy_config_file_path='/tmp/haproxy.cfg'):
         self.haproxy_config_file_path = haproxy_config_file_path
+        self._sections = None
+        self._proxies = None
+        self._binds = None
+        self._final_newline = True
 
     def get_config_file(self):
         return self.haproxy_config_file_path
 
+    def load(self):
+        '''
+            Parse config file, drop all unsaved changes
+        '''
+        self._sections = []
+        self._proxies = {}
+        self._binds = {}
+        section = HaproxyConfigSection()
+        self._sections.append(section)
+        with open(self.haproxy_config_file_path, 'r') as config_file:
+            text = config_file.read()
+        self._final_newline = not text or text.endswith('\n')
+        for line in text.splitlines():
+            words = line.split()
+            if words and words[0] in self.section_types:
+                section = HaproxyConfigSection(line)
+                self._add_section(section)
+            else:
+                section.add_line(line)
+        for section in self._sections:
+            self._index_section(section)
+
+    def save(self):
+        '''
+            Write config file
+        '''
+        lines = []
+        for section in self._get_sections():
+            lines.extend(section.serialize())
+        logger.debug('[HAPROXY] writing configuration to %s' %
+                                            self.haproxy_config_file_path)
+        text = '\n'.join(lines)
+        if lines and self._final_newline:
+            text += '\n'
+        with open(self.haproxy_config_file_path, 'w') as config_file:
+            config_file.write(text)
+
+    def _get_sections(self):
+        if self._sections is None:
+            self.load()
+        return self._sections
+
+    def _add_section(self, section):
+        self._sections.append(section)
+        if section.type in self.proxy_types:
+            self._proxies[(section.type, section.name)] = section
+
+    def _index_section(self, section):
+        if section.type not in ('frontend', 'listen'):
+            return
+        for address in section.bind_addresses():
+            self._binds.setdefault(address, set()).add(section.name)
+
+    def _unindex_section(self, section):
+        for address in section.bind_addresses():
+            names = self._binds.get(address)
+            if names is not None:
+                names.discard(section.name)
+                if not names:
+                    del self._binds[address]
+
+    def get_section(self, block_type, name):
+        self._get_sections()
+        return self._proxies.get((block_type, name))
+
+    def get_sections(self, block_type):
+        return [section for section in self._get_sections()
+                if section.type == block_type]
+
+    def get_frontends_by_address(self, address):
+        '''
+            Names of frontends and listen sections bound to the address
+        '''
+        self._get_sections()
+        return sorted(self._binds.get(address, ()))
+
     def add_lines_to_backend_block(self, HaproxyBackend, NewLines):
         '''
              Add lines to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] add lines to backend %s' % HaproxyBackend.name)
-        for i in new_config_file.keys():
-            if (i.find(HaproxyBackend.type) == 0 and
-                    i.find('%s' % HaproxyBackend.name) >= 0):
-                for j in NewLines:
-                    logger.debug('[HAPROXY] add line \'%s\'' % j)
-                    new_config_file[i].append("\t%s" % j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is None:
+            return
+        for j in NewLines:
+            logger.debug('[HAPROXY] add line \'%s\'' % j)
+            section.add_line('\t%s' % j)
 
     def del_lines_from_backend_block(self, HaproxyBackend, DelLines):
         '''
             Delete lines from backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] delete lines from backend %s',
                 HaproxyBackend.name)
-        for i in new_config_file.keys():
-            if (i.find(HaproxyBackend.type) == 0 and
-                    i.find('%s' % HaproxyBackend.name) >= 0):
-                logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                for s in DelLines:
-                    for j in new_config_file[i]:
-                        if j.find(s) >= 0:
-                            logger.debug('[HAPROXY] delete line \'%s\'' % s)
-                            new_config_file[i].remove(j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            section.del_lines_containing(DelLines)
 
     def add_rserver_to_backend_block(self, HaproxyBackend, HaproxyRserver):
         '''
             Add real server to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] backend %s rserver %s' % (HaproxyBackend.name,
                                                           HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                          HaproxyBackend.name) >= 0:
-                new_config_file[i].append('\tserver %s %s:%s %s maxconn %s'
-                                              'inter %s rise %s fall %s' %
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is None:
+            return
+        line = ('\tserver %s %s:%s %s maxconn %s weight %s '
+                'inter %s rise %s fall %s' %
                 (HaproxyRserver.name, HaproxyRserver.address,
                 HaproxyRserver.port, HaproxyRserver.check,
-                HaproxyRserver.maxconn, HaproxyRserver.inter,
-                HaproxyRserver.rise, HaproxyRserver.fall))
-        self._write_config_file(new_config_file)
+                HaproxyRserver.maxconn, HaproxyRserver.weight,
+                HaproxyRserver.inter, HaproxyRserver.rise,
+                HaproxyRserver.fall))
+        if HaproxyRserver.disabled:
+            line = '%s disabled' % line
+        section.set_server(HaproxyRserver.name, line)
 
     def del_rserver_from_backend_block(self, HaproxyBackend, HaproxyRserver):
         '''
             Delete real server to backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] From backend %s delete rserver %s' %
                           (HaproxyBackend.name, HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                         HaproxyBackend.name) >= 0:
-                for j in new_config_file[i]:
-                    logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                    if (j.find('server') >= 0 and
-                        j.find(HaproxyRserver.name) >= 0):
-                        new_config_file[i].remove(j)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is not None:
+            section.del_server(HaproxyRserver.name)
 
     def enable_disable_reserver_in_backend_block(self, HaproxyBackend,
                                 HaproxyRserver, type_of_operation):
         '''
             Disable/Enable server in the backend section config file
         '''
-        new_config_file = self._read_config_file()
         logger.debug('[HAPROXY] backend %s rserver %s' % (HaproxyBackend.name,
                                                           HaproxyRserver.name))
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
-        for i in new_config_file.keys():
-            if i.find(HaproxyBackend.type) == 0 and i.find('%s' %
-                                         HaproxyBackend.name) >= 0:
-                for j in new_config_file[i]:
-                    logger.debug('[HAPROXY] found %s' % new_config_file[i])
-                    if (j.find('server') >= 0 and
-                                           j.find(HaproxyRserver.name) >= 0):
-                        if type_of_operation == 'disable':
-                            tmp_str = ('%s disabled' % j)
-                        elif type_of_operation == 'enable':
-                            tmp_str = j.replace(' disabled', '')
-                        new_config_file[i].remove(j)
-                        new_config_file[i].append(tmp_str)
-        self._write_config_file(new_config_file)
+        section = self.get_section(HaproxyBackend.type, HaproxyBackend.name)
+        if section is None:
+            return
+        line = section.get_server(HaproxyRserver.name)
+        if line is None:
+            return
+        line = line.replace(' disabled', '')
+        if type_of_operation == 'disable':
+            line = '%s disabled' % line
+        section.set_server(HaproxyRserver.name, line)
 
     def add_frontend(self, HaproxyFronted, HaproxyBackend=None):
         '''
             Add frontend section to haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyFronted.name == '':
             logger.error('[HAPROXY] Empty fronted name')
             return 'FRONTEND NAME ERROR'
@@ -480,121 +907,68 @@ class HaproxyConfigFile:
             logger.error('[HAPROXY] Empty bind adrress or port')
             return 'FRONTEND ADDRESS OR PORT ERROR'
         logger.debug('[HAPROXY] Adding frontend %s' % HaproxyFronted.name)
-        new_config_block = []
-        new_config_block.append('\tbind %s:%s' % (HaproxyFronted.bind_address,
-                                                     HaproxyFronted.bind_port))
-        new_config_block.append('\tmode %s' % HaproxyFronted.mode)
+        self._remove_section('frontend', HaproxyFronted.name)
+        section = HaproxyConfigSection('frontend %s' % HaproxyFronted.name)
+        section.add_line('\tbind %s:%s' % (HaproxyFronted.bind_address,
+                                           HaproxyFronted.bind_port))
+        section.add_line('\tmode %s' % HaproxyFronted.mode)
         if HaproxyBackend is not None:
-            new_config_block.append('\tdefault_backend %s' %
-                                           HaproxyBackend.name)
-        new_config_file['frontend %s' % HaproxyFronted.name] = new_config_block
-        self._write_config_file(new_config_file)
+            section.add_line('\tdefault_backend %s' % HaproxyBackend.name)
+        self._add_section(section)
+        self._index_section(section)
         return HaproxyFronted.name
 
+    def _remove_section(self, block_type, name):
+        self._get_sections()
+        section = self._proxies.pop((block_type, name), None)
+        if section is not None:
+            self._sections = [other for other in self._sections
+                              if other is not section]
+            self._unindex_section(section)
+        return section
+
     def delete_block(self, HaproxyBlock):
         '''
             Delete fronend section from haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyBlock.name == '':
             logger.error('[HAPROXY] Empty block name')
             return 'BLOCK NAME ERROR'
         logger.debug('[HAPROXY] Try to delete block %s %s' %
                          (HaproxyBlock.type, HaproxyBlock.name))
-        for i in new_config_file.keys():
-            if i.find(HaproxyBlock.type) == 0 and i.find('%s' %
-                                         HaproxyBlock.name) >= 0:
-                logger.debug('[HAPROXY] Delete block %s %s' %
+        if self._remove_section(HaproxyBlock.type, HaproxyBlock.name):
+            logger.debug('[HAPROXY] Delete block %s %s' %
                           (HaproxyBlock.type, HaproxyBlock.name))
-                del new_config_file[i]
-        self._write_config_file(new_config_file)
 
     def find_string_in_the_block(self, block_type, check_string):
         """
             Find string in the block
         """
-        new_config_file = self._read_config_file()
-        for i in new_config_file.keys():
-            if (i.find(block_type) == 0 and
-                        new_config_file[i].find(check_string) >= 0):
-                return True
-            else:
-                return False
+        for section in self.get_sections(block_type):
+            for line in section.serialize():
+                if line.find(check_string) >= 0:
+                    return True
+        return False
 
     def add_backend(self, HaproxyBackend):
         '''
             Add backend section to haproxy config file
         '''
-        new_config_file = self._read_config_file()
         if HaproxyBackend.name == '':
             logger.error('[HAPROXY] Empty backend name')
             return 'BACKEND NAME ERROR'
+        section = self.get_section('backend', HaproxyBackend.name)
+        if section is not None:
+            # NOTE: servers and probe lines of an existing backend are kept
+            logger.debug('[HAPROXY] Updating backend')
+            section.set_option('balance',
+                               '\tbalance %s' % HaproxyBackend.balance)
+            return HaproxyBackend.name
         logger.debug('[HAPROXY] Adding backend')
-        new_config_block = []
-        new_config_block.append('\tbalance %s' % HaproxyBackend.balance)
-        new_config_file['backend %s' % HaproxyBackend.name] =\
-                                                         new_config_block
-        self._write_config_file(new_config_file)
+        section = HaproxyConfigSection('backend %s' % HaproxyBackend.name)
+        section.add_line('\tbalance %s' % HaproxyBackend.balance)
+        self._add_section(section)
         return HaproxyBackend.name
 
-    def _read_config_file(self):
-        haproxy_config_file = open(self.haproxy_config_file_path, 'r')
-        config_file = {}
-        block_name = ''
-        current_block = []
-        for line in haproxy_config_file:
-            if not line.strip():
-                continue
-            tmp_line = line.strip()
-            if tmp_line.find('global') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('defaults') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('listen') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('backend') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            elif tmp_line.find('frontend') == 0:
-                config_file[block_name] = current_block
-                block_name = line.rstrip()
-                current_block = []
-                continue
-            else:
-                current_block.append(line.rstrip())
-        #Writing last block
-        config_file[block_name] = current_block
-        haproxy_config_file.close()
-        return config_file
-
-    def _write_config_file(self, config_file):
-        haproxy_config_file = open(self.haproxy_config_file_path, 'w+')
-        logging.debug('[HAPROXY] writing configuration to %s' %
-                                            self.haproxy_config_file_path)
-        haproxy_config_file.write('global\n')
-        for v in config_file['global']:
-            haproxy_config_file.write('%s\n' % v)
-        del config_file['global']
-        haproxy_config_file.write('defaults\n')
-        for v in config_file['defaults']:
-            haproxy_config_file.write('%s\n' % v)
-        del config_file['defaults']
-        for k, v in sorted(config_file.iteritems()):
-            haproxy_config_file.write('%s\n' % k)
-            for out_line in v:
-                haproxy_config_file.write('%s\n' % out_line)
-        haproxy_config_file.close()
-
 if __name__ == '__main__':
     pass
@@ -1,139 +1,490 @@
+import contextlib
 import logging
+import socket
+import threading
+import time
+
 import paramiko
 
 
 logger = logging.getLogger(__name__)
 
 
-class RemoteConfig(object):
-    def __init__(self, device_ref, localpath, remotepath, configfilename):
+class PoolExhausted(paramiko.SSHException):
+    pass
+
+
+class SSHConnectionPool(object):
+    '''
+    Bounded pool of SSH connections to one haproxy device
+
+    Connections are kept open between operations with transport keepalives,
+    checked before every checkout and closed after idle_timeout seconds
+    without use. At most max_size connections are open at the same time,
+    callers wait for a free slot when the pool is exhausted.
+    '''
+    def __init__(self, device_ref, max_size=4, idle_timeout=300,
+                 keepalive=30):
         self.host = device_ref['ip']
         self.user = device_ref['user']
         self.password = device_ref['password']
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._free = []
+        self._dedicated = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_size)
+
+    def _connect(self):
+        logger.debug('[HAPROXY] open ssh connection to %s', self.host)
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.host, username=self.user, password=self.password)
+        if self.keepalive:
+            ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def _is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self, ssh):
+        try:
+            ssh.close()
+        except Exception:
+            logger.exception('[HAPROXY] failed to close ssh connection '
+                             'to %s', self.host)
+
+    def _pop_free(self):
+        '''
+            Take the most recently used connection, drop idle ones
+        '''
+        with self._lock:
+            deadline = time.time() - self.idle_timeout
+            idle = [ssh for ssh, last_used in self._free
+                    if last_used < deadline]
+            self._free = [(ssh, last_used) for ssh, last_used in self._free
+                          if last_used >= deadline]
+            ssh = self._free.pop()[0] if self._free else None
+        for idle_ssh in idle:
+            logger.debug('[HAPROXY] evict idle ssh connection to %s',
+                         self.host)
+            self._close(idle_ssh)
+        return ssh
+
+    def get(self):
+        self._slots.acquire()
+        try:
+            ssh = self._pop_free()
+            while ssh is not None:
+                if self._is_alive(ssh):
+                    return ssh
+                logger.debug('[HAPROXY] drop dead ssh connection to %s',
+                             self.host)
+                self._close(ssh)
+                ssh = self._pop_free()
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put(self, ssh, broken=False):
+        try:
+            if broken or not self._is_alive(ssh):
+                self._close(ssh)
+            else:
+                with self._lock:
+                    self._free.append((ssh, time.time()))
+        finally:
+            self._slots.release()
+
+    def get_dedicated(self):
+        '''
+            Open a connection for exclusive long-lived use
+
+            The connection takes a slot until it is given back with
+            put_dedicated(), so it counts toward max_size. It never
+            waits for a slot and dedicated connections never hold every
+            slot, so pooled operations can't be starved by them.
+        '''
+        with self._lock:
+            if (self._dedicated + 1 >= self.max_size or
+                    not self._slots.acquire(False)):
+                raise PoolExhausted('no free ssh connection slot for %s' %
+                                    self.host)
+            self._dedicated += 1
+        try:
+            return self._connect()
+        except Exception:
+            self._release_dedicated()
+            raise
+
+    def _release_dedicated(self):
+        with self._lock:
+            self._dedicated -= 1
+        self._slots.release()
+
+    def put_dedicated(self, ssh):
+        try:
+            self._close(ssh)
+        finally:
+            self._release_dedicated()
+
+    @contextlib.contextmanager
+    def connection(self):
+        ssh = self.get()
+        broken = False
+        try:
+            yield ssh
+        except (paramiko.SSHException, socket.error, EOFError):
+            broken = True
+            raise
+        finally:
+            self.put(ssh, broken)
+
+    def close_all(self):
+        with self._lock:
+            free, self._free = self._free, []
+        for ssh, _last_used in free:
+            self._close(ssh)
+
+
+class HaproxySocketChannel(object):
+    '''
+    Long-lived session with haproxy stats socket of one device
+
+    One socat process is started over a dedicated SSH connection and
+    switched to the interactive prompt mode, so commands are written
+    to the same session and every response ends with the prompt. Many
+    commands can be sent at once and their responses read back in
+    order. The session is reopened when haproxy or SSH closes it.
+
+    The SSH connection takes a slot of the pool while the session is
+    open and is closed when it was not used for the pool idle_timeout.
+    '''
+    prompt = '\n> '
+
+    def __init__(self, pool, haproxy_socket, timeout=10, cli_timeout=3600):
+        self.pool = pool
+        self.haproxy_socket = haproxy_socket
+        self.timeout = timeout
+        self.cli_timeout = cli_timeout
+        self._ssh = None
+        self._channel = None
+        self._buffer = ''
+        self._last_used = 0
+        self._lock = threading.Lock()
+
+    def _is_open(self):
+        return (self._channel is not None and not self._channel.closed and
+                not self._channel.exit_status_ready())
+
+    def _open(self):
+        logger.debug('[HAPROXY] open stats socket session %s on %s',
+                     self.haproxy_socket, self.pool.host)
+        self._ssh = self.pool.get_dedicated()
+        self._channel = self._ssh.get_transport().open_session()
+        self._channel.settimeout(self.timeout)
+        self._channel.exec_command('sudo socat stdio unix-connect:%s' %
+                                   self.haproxy_socket)
+        self._buffer = ''
+        self._send(['prompt', 'set timeout cli %s' % self.cli_timeout])
+        self._read_response()
+        self._read_response()
+
+    def close(self):
+        channel, ssh = self._channel, self._ssh
+        self._channel = self._ssh = None
+        self._buffer = ''
+        if channel is not None:
+            try:
+                channel.close()
+            except Exception:
+                logger.exception('[HAPROXY] failed to close stats '
+                                 'socket session')
+        if ssh is not None:
+            self.pool.put_dedicated(ssh)
+
+    def _send(self, commands):
+        self._channel.sendall(''.join('%s\n' % command
+                                      for command in commands))
+
+    def _read_response(self):
+        while True:
+            index = self._buffer.find(self.prompt)
+            if index >= 0:
+                response = self._buffer[:index]
+                self._buffer = self._buffer[index + len(self.prompt):]
+                return response
+            data = self._channel.recv(4096)
+            if not data:
+                raise EOFError('haproxy closed stats socket session')
+            self._buffer += data
+
+    def execute_many(self, commands):
+        '''
+            Send all commands at once, return list of their responses
+        '''
+        with self._lock:
+            try:
+                if (not self._is_open() or time.time() - self._last_used >
+                        self.pool.idle_timeout):
+                    self.close()
+                    self._open()
+                self._send(commands)
+                responses = [self._read_response() for command in commands]
+                self._last_used = time.time()
+                return responses
+            except Exception:
+                self.close()
+                raise
+
+    def execute(self, command):
+        return self.execute_many([command])[0]
+
+
+def execute(ssh, command):
+    '''
+        Run command and wait for it, return exit status and output
+    '''
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    return stdout.channel.recv_exit_status(), output
+
+
+class RestartReload(object):
+    '''
+    Restart haproxy service, drops all established connections
+    '''
+    name = 'restart'
+
+    def reload(self, ssh):
+        status, output = execute(ssh, 'sudo service haproxy restart')
+        return status == 0
+
+
+class GracefulReload(object):
+    '''
+    Start new haproxy process and let the old ones finish their
+    connections (-sf). With fd_socket the listening sockets are taken
+    over from the old process (-x), so no SYN is lost in between.
+    '''
+    name = 'graceful'
+
+    def __init__(self, config_path, pidfile, fd_socket=None):
+        self.config_path = config_path
+        self.pidfile = pidfile
+        self.fd_socket = fd_socket
+
+    def reload(self, ssh):
+        command = 'sudo haproxy -f %s -p %s -D' % (self.config_path,
+                                                   self.pidfile)
+        if self.fd_socket:
+            command = '%s -x %s' % (command, self.fd_socket)
+        command = '%s -sf $(cat %s)' % (command, self.pidfile)
+        status, output = execute(ssh, command)
+        return status == 0
+
+
+class MasterWorkerReload(object):
+    '''
+    Ask haproxy master process to reload its workers via master socket
+    '''
+    name = 'master-worker'
+
+    def __init__(self, master_socket):
+        self.master_socket = master_socket
+
+    def reload(self, ssh):
+        status, output = execute(ssh,
+                'echo reload | sudo socat stdio unix-connect:%s' %
+                self.master_socket)
+        return status == 0 and 'Success=0' not in output
+
+
+class RemoteConfig(object):
+    def __init__(self, device_ref, localpath, remotepath, configfilename,
+                 pool, reloader=None):
         self.remotepath = remotepath
         self.configfilename = configfilename
         self.localpath = localpath
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.pool = pool
+        self.reloader = reloader or RestartReload()
 
     def get_config(self):
         logger.debug('[HAPROXY] get config from remote server %s/%s to %s/%s' %
                       (self.remotepath, self.configfilename,
                        self.localpath, self.configfilename))
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        sftp = self.ssh.open_sftp()
-        sftp.get('%s/%s' % (self.remotepath, self.configfilename),
-                 '%s/%s' % (self.localpath, self.configfilename))
-        sftp.close()
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            sftp = ssh.open_sftp()
+            sftp.get('%s/%s' % (self.remotepath, self.configfilename),
+                     '%s/%s' % (self.localpath, self.configfilename))
+            sftp.close()
         return True
 
     def put_config(self):
         logger.debug('[HAPROXY] put configuration to remote server')
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        sftp = self.ssh.open_sftp()
-        sftp.put('%s/%s' % (self.localpath, self.configfilename),
-                 '/tmp/%s' % self.configfilename)
-        self.ssh.exec_command('sudo mv /tmp/%s %s' %
-                               (self.configfilename, self.remotepath))
-        sftp.close()
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            sftp = ssh.open_sftp()
+            sftp.put('%s/%s' % (self.localpath, self.configfilename),
+                     '/tmp/%s' % self.configfilename)
+            ssh.exec_command('sudo mv /tmp/%s %s' %
+                             (self.configfilename, self.remotepath))
+            sftp.close()
         return True
 
+    def push_config(self, reload=True):
+        '''
+            Upload config, validate it and reload haproxy
+
+            The new file replaces the remote config only if haproxy
+            accepts it, everything is done over one connection. Without
+            reload the file is only installed, for changes that are
+            already applied through the runtime API. If the reload fails
+            the previous file is put back and haproxy reloaded with it.
+        '''
+        logger.debug('[HAPROXY] push configuration to remote server')
+        tmp_path = '/tmp/%s' % self.configfilename
+        backup_path = '%s.orig' % tmp_path
+        config_path = '%s/%s' % (self.remotepath, self.configfilename)
+        with self.pool.connection() as ssh:
+            sftp = ssh.open_sftp()
+            sftp.put('%s/%s' % (self.localpath, self.configfilename),
+                     tmp_path)
+            sftp.close()
+            status, ssh_out = execute(ssh, 'haproxy -c -f %s' % tmp_path)
+            if 'Configuration file is valid' not in ssh_out:
+                logger.error('[HAPROXY] remote configuration is not valid: '
+                             '%s', ssh_out)
+                return False
+            if reload:
+                status, ssh_out = execute(ssh, 'sudo cp -p %s %s' %
+                                          (config_path, backup_path))
+                if status != 0:
+                    logger.error('[HAPROXY] failed to back up '
+                                 'configuration: %s', ssh_out)
+                    return False
+            status, ssh_out = execute(ssh, 'sudo mv %s %s' %
+                                      (tmp_path, self.remotepath))
+            if status != 0:
+                logger.error('[HAPROXY] failed to install configuration: '
+                             '%s', ssh_out)
+                return False
+            if not reload:
+                logger.debug('[HAPROXY] configuration installed, '
+                             'reload is not needed')
+                return True
+            logger.debug('[HAPROXY] reload haproxy, method %s',
+                         self.reloader.name)
+            try:
+                reloaded = self.reloader.reload(ssh)
+            except Exception:
+                self._restore(ssh, backup_path, config_path)
+                raise
+            if not reloaded:
+                logger.error('[HAPROXY] %s reload failed',
+                             self.reloader.name)
+                self._restore(ssh, backup_path, config_path)
+                return False
+        return True
+
+    def _restore(self, ssh, backup_path, config_path):
+        '''
+            Put the previous config back after a failed reload
+        '''
+        try:
+            status, ssh_out = execute(ssh, 'sudo mv %s %s' %
+                                      (backup_path, config_path))
+            if status != 0:
+                logger.error('[HAPROXY] failed to restore configuration: '
+                             '%s', ssh_out)
+                return
+            if not self.reloader.reload(ssh):
+                logger.error('[HAPROXY] %s reload with the restored '
+                             'configuration failed', self.reloader.name)
+        except Exception:
+            logger.exception('[HAPROXY] failed to restore configuration')
+
     def validate_config(self):
         '''
             Validate conifig and restart haproxy
         '''
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        stdin, stdout, stderr = self.ssh.exec_command('haproxy -c -f %s/%s' %
-                               (self.remotepath, self.configfilename))
-        ssh_out = stdout.read()
-        logger.debug('[HAPROXY] ssh_out - %s - %s' % (ssh_out,
-                         ssh_out.find('Configuration file is valid')))
-        if 'Configuration file is valid' in ssh_out:
-            logger.debug('[HAPROXY] remote configuration is valid, '
-                          'restart haproxy')
-            self.ssh.exec_command('sudo service haproxy restart')
-            return True
-        else:
-            logger.error('[HAPROXY] remote configuration is not valid')
-            return False
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            stdin, stdout, stderr = ssh.exec_command('haproxy -c -f %s/%s' %
+                                   (self.remotepath, self.configfilename))
+            ssh_out = stdout.read()
+            logger.debug('[HAPROXY] ssh_out - %s - %s' % (ssh_out,
+                             ssh_out.find('Configuration file is valid')))
+            if 'Configuration file is valid' in ssh_out:
+                logger.debug('[HAPROXY] remote configuration is valid, '
+                              'reload haproxy')
+                return self.reloader.reload(ssh)
+            else:
+                logger.error('[HAPROXY] remote configuration is not valid')
+                return False
 
 
 class RemoteService(object):
     '''
     Operations with haproxy daemon
     '''
-    def __init__(self, device_ref):
-        self.host = device_ref['ip']
-        self.user = device_ref['user']
-        self.password = device_ref['password']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def __init__(self, device_ref, pool):
+        self.pool = pool
 
     def start(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        self.ssh.exec_command('sudo service haproxy start')
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            ssh.exec_command('sudo service haproxy start')
         return True
 
     def stop(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        self.ssh.exec_command('sudo service haproxy stop')
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            ssh.exec_command('sudo service haproxy stop')
         return True
 
     def restart(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        self.ssh.exec_command('sudo service haproxy restart')
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            ssh.exec_command('sudo service haproxy restart')
         return True
 
 
 class RemoteInterface(object):
-    def __init__(self, device_ref, frontend):
+    def __init__(self, device_ref, frontend, pool):
         device_extra = device_ref.get('extra')
         self.interface = device_extra.get('interface')
         self.IP = frontend.bind_address
-        self.host = device_ref['ip']
-        self.user = device_ref['user']
-        self.password = device_ref['password']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.pool = pool
 
     def add_ip(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        logger.debug('[HAPROXY] try add IP-%s to inteface %s' %
-                                (self.IP,  self.interface))
-        stdin, stdout, stderr = self.ssh.exec_command('ip addr show dev %s' %
-                                self.interface)
-        ssh_out = stdout.read()
-        if ssh_out.find(self.IP) < 0:
-            self.ssh.exec_command('sudo ip addr add %s/32 dev %s' %
-                                                (self.IP, self.interface))
-            logger.debug('[HAPROXY] remote add ip %s to inteface %s' %
-                                              (self.IP, self.interface))
-        else:
-            logger.debug('[HAPROXY] remote ip %s is already configured on the \
-                                              %s' % (self.IP, self.interface))
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            logger.debug('[HAPROXY] try add IP-%s to inteface %s' %
+                                    (self.IP,  self.interface))
+            stdin, stdout, stderr = ssh.exec_command('ip addr show dev %s' %
+                                    self.interface)
+            ssh_out = stdout.read()
+            if ssh_out.find(self.IP) < 0:
+                ssh.exec_command('sudo ip addr add %s/32 dev %s' %
+                                                    (self.IP, self.interface))
+                logger.debug('[HAPROXY] remote add ip %s to inteface %s' %
+                                                  (self.IP, self.interface))
+            else:
+                logger.debug('[HAPROXY] remote ip %s is already configured '
+                             'on the %s' % (self.IP, self.interface))
         return True
 
     def del_ip(self):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        stdin, stdout, stderr = self.ssh.exec_command('ip addr show dev %s' %
-                               (self.interface))
-        ssh_out = stdout.read()
-        if  ssh_out.find(self.IP) >= 0:
-            logger.debug('[HAPROXY] remote delete ip %s from inteface %s' %
-                                    (self.IP, self.interface))
-            self.ssh.exec_command('sudo ip addr del %s/32 dev %s' % (self.IP,
-                                                   self.interface))
-        else:
-            logger.debug('[HAPROXY] remote ip %s is not configured on the %s' %
-                                    (self.IP, self.interface))
-        self.ssh.close()
+        with self.pool.connection() as ssh:
+            stdin, stdout, stderr = ssh.exec_command('ip addr show dev %s' %
+                                   (self.interface))
+            ssh_out = stdout.read()
+            if  ssh_out.find(self.IP) >= 0:
+                logger.debug('[HAPROXY] remote delete ip %s from inteface %s' %
+                                        (self.IP, self.interface))
+                ssh.exec_command('sudo ip addr del %s/32 dev %s' % (self.IP,
+                                                       self.interface))
+            else:
+                logger.debug('[HAPROXY] remote ip %s is not configured on '
+                             'the %s' % (self.IP, self.interface))
         return True
 
 
@@ -141,53 +492,167 @@ class RemoteSocketOperation(object):
     '''
     Remote operations via haproxy socket
     '''
-    def __init__(self, device_ref, backend, rserver):
+    def __init__(self, device_ref, backend, rserver, pool, channel=None):
         device_extra = device_ref.get('extra')
         self.interface = device_extra.get('interface')
         self.haproxy_socket = device_extra.get('socket')
-        self.host = device_ref['ip']
-        self.user = device_ref['user']
-        self.password = device_ref['password']
         self.backend_name = backend.name
         self.rserver_name = rserver['name']
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.pool = pool
+        self.channel = channel
 
     def suspend_server(self):
-        self._operation_with_server_via_socket('disable')
-        return True
+        return self._operation_with_server_via_socket('disable')
 
     def activate_server(self):
-        self._operation_with_server_via_socket('enable')
-        return True
+        return self._operation_with_server_via_socket('enable')
+
+    def set_weight(self, weight):
+        return self._set('weight %s/%s %s' %
+                         (self.backend_name, self.rserver_name, weight))
+
+    def set_maxconn(self, maxconn):
+        return self._set('maxconn server %s/%s %s' %
+                         (self.backend_name, self.rserver_name, maxconn))
+
+    def set_state(self, state):
+        '''
+            Set administrative state of the server: ready, drain or maint
+        '''
+        return self._set('server %s/%s state %s' %
+                         (self.backend_name, self.rserver_name, state))
+
+    def set_addr(self, address, port=None):
+        command = 'set server %s/%s addr %s' % (self.backend_name,
+                                                self.rserver_name, address)
+        if port:
+            command = '%s port %s' % (command, port)
+        ssh_out = self._runtime_command(command)
+        return 'changed' in ssh_out or 'no need to change' in ssh_out
+
+    def add_server(self, address, port, options=''):
+        '''
+            Add server to the running haproxy, needs haproxy 2.4 or newer
+
+            New servers start in maintenance mode, so the server is
+            enabled right after it is registered.
+        '''
+        ssh_out = self._runtime_command('add server %s/%s %s:%s %s' %
+                (self.backend_name, self.rserver_name, address, port,
+                 options))
+        if 'New server registered' not in ssh_out:
+            return False
+        return self.activate_server()
+
+    def del_server(self):
+        if not self.set_state('maint'):
+            return False
+        ssh_out = self._runtime_command('del server %s/%s' %
+                                        (self.backend_name,
+                                         self.rserver_name))
+        return 'Server deleted' in ssh_out
+
+    def _set(self, args):
+        return self._runtime_command('set %s' % args).strip() == ''
+
+    def _runtime_command(self, command):
+        if self.channel is not None:
+            try:
+                ssh_out = self.channel.execute(command)
+            except (paramiko.SSHException, socket.error, EOFError):
+                logger.exception('[HAPROXY] stats socket session failed, '
+                                 'run "%s" with socat', command)
+            else:
+                logger.debug('[HAPROXY] runtime command "%s", result "%s"',
+                             command, ssh_out.strip())
+                return ssh_out
+        with self.pool.connection() as ssh:
+            stdin, stdout, stderr = ssh.exec_command(
+                    'echo "%s" | sudo socat stdio unix-connect:%s' %
+                    (command, self.haproxy_socket))
+            ssh_out = stdout.read()
+        logger.debug('[HAPROXY] runtime command "%s", result "%s"',
+                     command, ssh_out.strip())
+        return ssh_out
 
     def _operation_with_server_via_socket(self, operation):
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        stdin, stdout, stderr = self.ssh.exec_command(
-                'echo %s server %s/%s | sudo socat stdio unix-connect:%s' %
-                (operation,  self.backend_name,
-                 self.rserver_name, self.haproxy_socket))
-        ssh_out = stdout.read()
-        if  ssh_out == "":
+        ssh_out = self._runtime_command('%s server %s/%s' %
+                (operation, self.backend_name, self.rserver_name))
+        if not ssh_out.strip():
             out = 'ok'
         else:
                 out = 'is not ok'
-        logger.debug('[HAPROXY] disable server %s/%s. Result is "%s"' %
-                      (self.backend_name, self.rserver_name, out))
-        self.ssh.close()
+        logger.debug('[HAPROXY] %s server %s/%s. Result is "%s"' %
+                      (operation, self.backend_name, self.rserver_name, out))
+        return not ssh_out.strip()
 
     def get_statistics(self):
         """
             Get statistics from rserver / server farm
             for all serverafarm use BACKEND as self.rserver_name
         """
-        self.ssh.connect(self.host, username=self.user, password=self.password)
-        stdin, stdout, stderr = self.ssh.exec_command(
-           'echo show stat | sudo socat stdio unix-connect:%s | grep %s,%s ' %
-            (self.haproxy_socket, self.backend_name, self.rserver_name))
-        ssh_out = stdout.read()
+        with self.pool.connection() as ssh:
+            stdin, stdout, stderr = ssh.exec_command(
+                'echo show stat | sudo socat stdio unix-connect:%s | '
+                'grep %s,%s ' % (self.haproxy_socket, self.backend_name,
+                                 self.rserver_name))
+            ssh_out = stdout.read()
         logger.debug('[HAPROXY] get statistics about reserver %s/%s.'
                     ' Result is \'%s\' ', self.backend_name, self.rserver_name,
                     ssh_out)
-        self.ssh.close()
         return ssh_out
+
+
+class RemoteStatistics(object):
+    '''
+    Statistics of all proxies and servers from haproxy stats socket
+    '''
+    def __init__(self, device_ref, pool, channel=None):
+        device_extra = device_ref.get('extra')
+        self.haproxy_socket = device_extra.get('socket')
+        self.pool = pool
+        self.channel = channel
+
+    def show_stat(self):
+        if self.channel is not None:
+            try:
+                return self.channel.execute('show stat')
+            except (paramiko.SSHException, socket.error, EOFError):
+                logger.exception('[HAPROXY] stats socket session failed, '
+                                 'get statistics with socat')
+        with self.pool.connection() as ssh:
+            stdin, stdout, stderr = ssh.exec_command(
+                    'echo show stat | sudo socat stdio unix-connect:%s' %
+                    self.haproxy_socket)
+            return stdout.read()
+
+    def get_all(self):
+        return self.parse(self.show_stat())
+
+    @staticmethod
+    def parse(csv_text):
+        '''
+            Parse "show stat" CSV into {(pxname, svname): {column: value}}
+
+            Numeric values are converted to int, empty values to None.
+        '''
+        lines = csv_text.splitlines()
+        if not lines or not lines[0].startswith('#'):
+            return {}
+        columns = [c.strip() for c in lines[0].lstrip('#').split(',')]
+        table = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            row = {}
+            for column, value in zip(columns, line.split(',')):
+                if not column:
+                    continue
+                if not value:
+                    value = None
+                elif value.isdigit() or (value[0] == '-' and
+                                         value[1:].isdigit()):
+                    value = int(value)
+                row[column] = value
+            table[(row['pxname'], row['svname'])] = row
+        return table
@@ -60,3 +60,19 @@ class PredictorNotFound(NotFound):
 
 class VirtualServerNotFound(NotFound):
     message = 'Virtual Server not found'
+
+
+class BadRequest(exception.HTTPBadRequest):
+    message = 'Bad request.'
+
+    def __init__(self, message=None, **kwargs):
+        super(BadRequest, self).__init__(message)
+        self.kwargs = kwargs
+
+
+class InvalidMarker(BadRequest):
+    message = 'Marker not found'
+
+
+class InvalidListParameter(BadRequest):
+    message = 'Invalid list parameter'
@@ -15,16 +15,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import datetime
 import logging
 import openstack.common.exception
 
 from balancer.db import api as db_api
-from balancer import exception
+from balancer.db import models
 from balancer.core import lb_status
 
 
 logger = logging.getLogger(__name__)
 
+# Fields that are not changed by updates
+READ_ONLY_FIELDS = frozenset(['id', 'device_id', 'tenant_id', 'lb_id',
+                              'sf_id', 'parent_id', 'status', 'deployed',
+                              'created_at', 'updated_at'])
+
 
 class Balancer():
     def __init__(self, conf):
@@ -35,6 +42,7 @@ class Balancer():
         self.probes = []
         self.vips = []
         self.conf = conf
+        self._snapshot = {}
 
     def parseParams(self, params):
         obj_dict = params.copy()
@@ -67,19 +75,16 @@ class Balancer():
         self.sf._predictor = predictor_ref
 
         """ Parse RServer nodes and attach them to SF """
+        # We need to check if there is already real server with the
+        # same IP deployed
+        parent_refs = db_api.server_get_all_by_address_on_device(self.conf,
+                [node.get('address') for node in nodes_list],
+                lb_ref['device_id'])
         for node in nodes_list:
             rs_ref = db_api.server_pack_extra(node)
-            # We need to check if there is already real server with the
-            # same IP deployed
-            try:
-                parent_ref = db_api.server_get_by_address_on_device(self.conf,
-                                                        rs_ref['address'],
-                                                        lb_ref['device_id'])
-            except exception.ServerNotFound:
-                pass
-            else:
-                if parent_ref.get('address') != '':
-                    rs_ref['parent_id'] = parent_ref['id']
+            parent_ref = parent_refs.get(rs_ref['address'])
+            if parent_ref is not None and parent_ref.get('address') != '':
+                rs_ref['parent_id'] = parent_ref['id']
 
             self.rs.append(rs_ref)
             self.sf._rservers.append(rs_ref)
@@ -106,88 +111,158 @@ class Balancer():
 #                st.name = st.id
 #                self.sf._sticky.append(st)
 
-    def update(self):
-        db_api.loadbalancer_update(self.conf, self.lb['id'], self.lb)
-        for st in self.sf._sticky:
-            db_api.sticky_update(self.conf, st['id'], st)
-        for rs in self.rs:
-            db_api.server_update(self.conf, rs['id'], rs)
-        for pr in self.probes:
-            db_api.probe_update(self.conf, pr['id'], pr)
+    def updateParams(self, params):
+        """Change the aggregate to the state described by params.
+
+        Fields of the load balancer are changed, algorithm changes the
+        predictor. nodes, healthMonitor, virtualIps and sessionPersistence
+        are full lists of these objects when given: objects with a known
+        id are changed, the others are added and objects not listed are
+        removed.
+        """
+        params = params.copy()
+        nodes_list = params.pop('nodes', None)
+        probes_list = params.pop('healthMonitor', None)
+        vips_list = params.pop('virtualIps', None)
+        stic = params.pop('sessionPersistence', None)
+
+        for key, value in params.iteritems():
+            if key not in self.lb or key in READ_ONLY_FIELDS:
+                logger.debug("Ignored attribute %s of LB. Value is %s",
+                             key, value)
+                continue
+            self.lb[key] = value
+            if key == 'algorithm':
+                self.sf._predictor['type'] = value
+
+        if nodes_list is not None:
+            self.rs = self._updateRefs(self.rs, nodes_list,
+                                       db_api.server_pack_extra)
+            new_rs = [rs for rs in self.rs if not rs['id']]
+            parent_refs = db_api.server_get_all_by_address_on_device(
+                    self.conf, [rs['address'] for rs in new_rs],
+                    self.lb['device_id'])
+            for rs in new_rs:
+                parent_ref = parent_refs.get(rs['address'])
+                if parent_ref is not None and parent_ref.get('address') != '':
+                    rs['parent_id'] = parent_ref['id']
+        if probes_list is not None:
+            self.probes = self._updateRefs(self.probes, probes_list,
+                                           db_api.probe_pack_extra)
+        if vips_list is not None:
+            self.vips = self._updateRefs(self.vips, vips_list,
+                                         db_api.virtualserver_pack_extra)
+        if stic is not None:
+            self.sf._sticky = self._updateRefs(self.sf._sticky, stic,
+                                               db_api.sticky_pack_extra)
+
         for vip in self.vips:
-            db_api.virtualserver_update(self.conf, vip['id'], vip)
+            if not vip['id']:
+                vip['id'] = models.create_uuid()
+                vip['name'] = vip['id']
+                vip['appProto'] = self.lb['protocol']
+            elif 'protocol' in params:
+                vip['appProto'] = self.lb['protocol']
+
+    def _updateRefs(self, refs, values_list, pack):
+        refs_by_id = dict((ref['id'], ref) for ref in refs)
+        result = []
+        for values in values_list:
+            ref = refs_by_id.get(values.get('id'))
+            if ref is None:
+                values = dict((key, value) for key, value in
+                              values.iteritems() if key != 'id')
+                result.append(pack(values))
+                continue
+            extra = dict(ref['extra'] or {})
+            for key, value in values.iteritems():
+                if key in READ_ONLY_FIELDS:
+                    continue
+                if key in ref:
+                    ref[key] = value
+                else:
+                    extra[key] = value
+            ref['extra'] = extra
+            result.append(ref)
+        return result
+
+    def update(self):
+        """Write the aggregate to DB, see savetoDB."""
+        self.savetoDB()
 
     def getLB(self):
         return self.lb
 
-    def savetoDB(self):
-        try:
-            lb_ref = db_api.loadbalancer_update(self.conf, self.lb['id'],
-                                                self.lb)
-        except exception.LoadBalancerNotFound:
-            lb_ref = db_api.loadbalancer_create(self.conf, self.lb)
-
-        self.sf['lb_id'] = lb_ref['id']
-        try:
-            sf_ref = db_api.serverfarm_update(self.conf, self.sf['id'],
-                                              self.sf)
-        except exception.ServerFarmNotFound:
-            sf_ref = db_api.serverfarm_create(self.conf, self.sf)
-
-        self.sf._predictor['sf_id'] = sf_ref['id']
-        try:
-            db_api.predictor_update(self.conf, self.sf._predictor['id'],
-                                    self.sf._predictor)
-        except exception.PredictorNotFound:
-            db_api.predictor_create(self.conf, self.sf._predictor)
-
-        stickies = self.sf._sticky
-        vips = []
-
-        self.sf = sf_ref
-        self.sf._rservers = []
-        self.sf._probes = []
-        self.sf._sticky = []
-
-        for rs in self.rs:
-            rs['sf_id'] = sf_ref['id']
-            try:
-                rs_ref = db_api.server_update(self.conf, rs['id'], rs)
-            except exception.ServerNotFound:
-                rs_ref = db_api.server_create(self.conf, rs)
-            self.sf._rservers.append(rs_ref)
-
-        for pr in self.probes:
-            pr['sf_id'] = sf_ref['id']
-            try:
-                pr_ref = db_api.probe_update(self.conf, pr['id'], pr)
-            except exception.ProbeNotFound:
-                pr_ref = db_api.probe_create(self.conf, pr)
-            self.sf._probes.append(pr_ref)
-
+    def savetoDB(self, delete_removed=True):
+        """Write the aggregate to DB in one transaction.
+
+        Only objects changed since the last load or save are written, new
+        ones are inserted. Removed ones are deleted, or kept until a save
+        with delete_removed.
+        """
+        for ref in self._get_refs():
+            if not ref['id']:
+                ref['id'] = models.create_uuid()
+
+        self.sf['lb_id'] = self.lb['id']
+        self.sf._predictor['sf_id'] = self.sf['id']
+        for ref in self.rs + self.probes + self.sf._sticky:
+            ref['sf_id'] = self.sf['id']
         for vip in self.vips:
-            vip['sf_id'] = sf_ref['id']
-            vip['lb_id'] = lb_ref['id']
-            try:
-                vip_ref = db_api.virtualserver_update(self.conf, vip['id'],
-                                                      vip)
-            except exception.VirtualServerNotFound:
-                vip_ref = db_api.virtualserver_create(self.conf, vip)
-            vips.append(vip_ref)
-
-        for st in stickies:
-            st['sf_id'] = sf_ref['id']
-            try:
-                st_ref = db_api.sticky_update(self.conf, st['id'], st)
-            except exception.StickyNotFound:
-                st_ref = db_api.sticky_create(self.conf, st)
-            self.sf._sticky.append(st_ref)
-
-        self.rs = self.sf._rservers
-        self.probes = self.sf._probes
-        self.vips = vips
-
-    def loadFromDB(self, lb_id):
+            vip['sf_id'] = self.sf['id']
+            vip['lb_id'] = self.lb['id']
+
+        refs = self._get_refs()
+        new_refs, updates = self._get_changes(refs)
+        keys = set((type(ref), ref['id']) for ref in refs)
+        removed = dict((key, values) for key, values in
+                       self._snapshot.iteritems() if key not in keys)
+        deletes = removed.keys() if delete_removed else []
+        db_api.save_all(self.conf, new_refs, updates, deletes=deletes,
+                        lb_ids=[self.lb['id']])
+
+        self.sf._rservers = list(self.rs)
+        self.sf._probes = list(self.probes)
+        self._take_snapshot()
+        if not delete_removed:
+            self._snapshot.update(removed)
+
+    def _get_refs(self):
+        refs = [self.lb, self.sf, self.sf._predictor]
+        refs += self.rs + self.probes + self.vips + self.sf._sticky
+        return refs
+
+    def _take_snapshot(self):
+        self._snapshot = {}
+        for ref in self._get_refs():
+            self._snapshot[type(ref), ref['id']] = \
+                    copy.deepcopy(dict(ref.iteritems()))
+
+    def _get_changes(self, refs):
+        new_refs, updates = [], []
+        seen = set()
+        for ref in refs:
+            if id(ref) in seen:
+                continue
+            seen.add(id(ref))
+            old_values = self._snapshot.get((type(ref), ref['id']))
+            if old_values is None:
+                new_refs.append(ref)
+                continue
+            values = dict((key, value) for key, value in ref.iteritems()
+                          if old_values.get(key) != value)
+            if not values:
+                continue
+            if ref is self.lb:
+                ref['updated_at'] = values['updated_at'] = \
+                        datetime.datetime.utcnow()
+            updates.append((type(ref), ref['id'], values))
+        return new_refs, updates
+
+    def loadFromDB(self, lb_id, eager=True):
+        if eager:
+            self._loadFromDBEager(lb_id)
+            return
         self.lb = db_api.loadbalancer_get(self.conf, lb_id)
         self.sf = db_api.serverfarm_get_all_by_lb_id(self.conf, lb_id)[0]
         sf_id = self.sf['id']
@@ -211,6 +286,28 @@ class Balancer():
         self.sf._sticky = []
         for st in sticks:
             self.sf._sticky.append(st)
+        self._take_snapshot()
+
+    def _loadFromDBEager(self, lb_id):
+        self.loadFromAggregate(
+                db_api.loadbalancer_get_aggregate(self.conf, lb_id))
+
+    def loadFromAggregate(self, lb_ref):
+        """Load from a load balancer with its object graph loaded."""
+        self.lb = lb_ref
+        self.sf = self.lb.serverfarms[0]
+
+        self.vips = list(self.sf.virtualservers)
+        self.sf._predictor = self.sf.predictors[0]
+
+        self.rs = list(self.sf.servers)
+        self.sf._rservers = list(self.rs)
+
+        self.probes = list(self.sf.probes)
+        self.sf._probes = list(self.probes)
+
+        self.sf._sticky = list(self.sf.stickies)
+        self._take_snapshot()
 
     def removeFromDB(self):
         lb_id = self.lb['id']
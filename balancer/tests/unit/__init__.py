@@ -1,3 +1,7 @@
+import os
+import subprocess
+import sys
+
 from sqlalchemy import pool, event
 
 
@@ -5,3 +9,23 @@ from sqlalchemy import pool, event
 def on_connect(dbapi_con, con_record):
     if type(dbapi_con).__module__.startswith('pysqlite'):
         dbapi_con.cursor().execute('PRAGMA journal_mode=MEMORY')
+
+
+def run_monkey_patched(func):
+    """Run a module level function in a new monkey patched interpreter.
+
+    The API server calls eventlet.monkey_patch() before anything else is
+    imported, patching the test process itself would leak into other
+    tests. Return the exit status and the output of the interpreter.
+    """
+    top_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           os.pardir, os.pardir, os.pardir))
+    script = ("import eventlet\n"
+              "eventlet.monkey_patch()\n"
+              "from %s import %s\n"
+              "%s()\n" % (func.__module__, func.__name__, func.__name__))
+    process = subprocess.Popen([sys.executable, '-c', script],
+                               cwd=top_dir, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output
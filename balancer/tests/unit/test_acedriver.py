@@ -17,6 +17,13 @@
 
 import unittest
 
+import ipaddr
+import mock
+
+from balancer.core import executor
+from balancer.drivers.cisco_ace import nat_pool
+from balancer.drivers.cisco_ace import running_config
+from balancer.drivers.cisco_ace import xml_agent
 from balancer.drivers.cisco_ace.ace_driver import AceDriver
 
 
@@ -34,7 +41,16 @@ class TestDriver(AceDriver):
 dev = {'ip': '10.4.15.21', 'port': '10443', \
        'login': 'admin', 'password': 'cisco123'}
 
-conf = []
+
+def get_fake_conf():
+    conf = mock.Mock()
+    conf.ace_connection_pool_size = 4
+    conf.ace_connection_idle_timeout = 60
+    conf.ace_request_timeout = 60
+    conf.ace_config_ttl = 30
+    return conf
+
+conf = get_fake_conf()
 driver = TestDriver(conf, dev)
 driver.ReadyToTest()
 
@@ -622,3 +638,381 @@ class Ace_DriverTestCase(unittest.TestCase):
 
     def test_16b_deleteRServer_typeRedirect(self):
         driver.delete_real_server(rs_redirect)
+
+
+RESPONSE_OK = """<response_xml>
+<config_status>
+<command>configure</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>probe tcp p1</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>end</command><status code="100" text="XML_CMD_SUCCESS"/>
+</config_status>
+</response_xml>"""
+
+RESPONSE_FAILED = """<response_xml>
+<config_status>
+<command>configure</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>probe tcp p1</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>end</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>configure</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>rserver host r1</command><status code="100" text="XML_CMD_SUCCESS"/>
+<command>ip address 1.2.3</command>
+<status code="1" text="Invalid IP address"/>
+<command>end</command><status code="100" text="XML_CMD_SUCCESS"/>
+</config_status>
+</response_xml>"""
+
+
+class TestAceDriverRequest(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(get_fake_conf(), dev)
+        self.send = mock.Mock(return_value=RESPONSE_OK)
+        self.driver._send = self.send
+
+    def test_request_sends_one_batch(self):
+        with self.driver.request_context():
+            self.assertEqual(self.driver.deployConfig('probe tcp p1'), 'OK')
+            self.assertEqual(self.driver.deployConfig('rserver host r1'),
+                             'OK')
+            self.assertFalse(self.send.called)
+        self.send.assert_called_once_with(
+                ['configure', 'probe tcp p1', 'end',
+                 'configure', 'rserver host r1', 'end'])
+        self.assertIsNone(self.driver._batch)
+
+    def test_nested_request_sends_one_batch(self):
+        with self.driver.request_context():
+            with self.driver.request_context():
+                self.driver.deployConfig('probe tcp p1')
+            self.assertFalse(self.send.called)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_get_config_flushes_batch(self):
+        with self.driver.request_context():
+            self.driver.deployConfig('probe tcp p1')
+            self.driver.getConfig('probe')
+            self.assertEqual(self.send.call_args_list, [
+                mock.call(['configure', 'probe tcp p1', 'end']),
+                mock.call(['show runn probe'])])
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_failed_command_rolls_back(self):
+        self.send.return_value = RESPONSE_FAILED
+        rollback = mock.Mock()
+        with self.assertRaises(xml_agent.AceCommandError) as cm:
+            with self.driver.request_context() as ctx:
+                ctx.add_rollback(rollback)
+                self.driver.deployConfig('probe tcp p1')
+                self.driver.deployConfig('rserver host r1\nip address 1.2.3')
+        self.assertIn('ip address 1.2.3: Invalid IP address',
+                      str(cm.exception))
+        rollback.assert_called_once_with(False)
+
+    def _deploy(self, ctx, name):
+        self.driver.deployConfig('probe tcp %s' % (name,))
+        rollback = mock.Mock(side_effect=lambda good:
+                self.driver.deployConfig('no probe tcp %s' % (name,)))
+        ctx.add_rollback(rollback)
+        return rollback
+
+    def test_failed_request_not_sent(self):
+        with self.assertRaises(ValueError):
+            with self.driver.request_context() as ctx:
+                rollback = self._deploy(ctx, 'p1')
+                raise ValueError()
+        rollback.assert_called_once_with(False)
+        self.assertFalse(self.send.called)
+
+    def test_failed_request_rolls_back_sent_config(self):
+        with self.assertRaises(ValueError):
+            with self.driver.request_context() as ctx:
+                rollback1 = self._deploy(ctx, 'p1')
+                self.driver.getConfig('probe')
+                rollback2 = self._deploy(ctx, 'p2')
+                raise ValueError()
+        rollback1.assert_called_once_with(False)
+        rollback2.assert_called_once_with(False)
+        self.assertEqual(self.send.call_args_list, [
+            mock.call(['configure', 'probe tcp p1', 'end']),
+            mock.call(['show runn probe']),
+            mock.call(['configure', 'no probe tcp p1', 'end'])])
+
+    def test_failed_request_with_parallel_steps(self):
+        self.driver.conf.device_parallel_operations = 2
+        rollbacks = []
+
+        def step(ctx, name):
+            rollbacks.append(self._deploy(ctx, name))
+
+        with self.assertRaises(ValueError):
+            with self.driver.request_context() as ctx:
+                rollbacks.append(self._deploy(ctx, 'p0'))
+                self.driver.getConfig('probe')
+                executor.execute_parallel(ctx, step,
+                        [('p1',), ('p2',), ('p3',)])
+                raise ValueError()
+        for rollback in rollbacks:
+            rollback.assert_called_once_with(False)
+        self.assertEqual(self.send.call_args_list, [
+            mock.call(['configure', 'probe tcp p0', 'end']),
+            mock.call(['show runn probe']),
+            mock.call(['configure', 'no probe tcp p0', 'end'])])
+
+    def test_deploy_config_outside_request(self):
+        self.assertEqual(self.driver.deployConfig('probe tcp p1'), 'OK')
+        self.send.return_value = 'error'
+        self.assertEqual(self.driver.deployConfig('probe tcp p1'), Exception)
+        self.send.side_effect = IOError()
+        self.assertEqual(self.driver.deployConfig('probe tcp p1'), Exception)
+
+
+class TestXmlAgent(unittest.TestCase):
+    def test_map_errors(self):
+        lines, owners = xml_agent.build_batch(
+                ['probe tcp p1', 'rserver host r1\nip address 1.2.3'])
+        self.assertEqual(owners, [0, 0, 0, 1, 1, 1, 1])
+        errors = xml_agent.map_errors(RESPONSE_FAILED, lines, owners)
+        self.assertEqual(errors,
+                         {1: [('ip address 1.2.3', 'Invalid IP address')]})
+        self.assertEqual(xml_agent.map_errors(RESPONSE_OK, lines, owners),
+                         {})
+        self.assertIsNone(xml_agent.map_errors('XML_CMD_SUCCESS', lines,
+                                               owners))
+
+    @mock.patch('balancer.drivers.cisco_ace.xml_agent.httplib')
+    def test_pool_reuses_connection(self, mock_httplib):
+        conn = mock_httplib.HTTPSConnection.return_value
+        conn.getresponse.return_value.read.return_value = 'data'
+        conn.getresponse.return_value.will_close = False
+        pool = xml_agent.HTTPSConnectionPool('10.0.0.1', 443)
+        self.assertEqual(pool.request('body', {}), 'data')
+        self.assertEqual(pool.request('body', {}), 'data')
+        self.assertEqual(mock_httplib.HTTPSConnection.call_count, 1)
+        conn.request.assert_called_with('POST', '/bin/xml_agent', 'body', {})
+
+    @mock.patch('balancer.drivers.cisco_ace.xml_agent.httplib')
+    def test_pool_retries_reused_connection(self, mock_httplib):
+        mock_httplib.HTTPException = Exception
+        conn = mock_httplib.HTTPSConnection.return_value
+        conn.sock = object()
+        response = mock.Mock(will_close=False)
+        response.read.return_value = 'data'
+        conn.getresponse.side_effect = [ValueError(), response]
+        pool = xml_agent.HTTPSConnectionPool('10.0.0.1', 443)
+        self.assertEqual(pool.request('body', {}), 'data')
+        conn.close.assert_called_once_with()
+        self.assertEqual(conn.request.call_count, 2)
+
+
+RUNNING_CONFIG = """Generating configuration....
+
+interface vlan 100
+  ip address 10.0.0.2 255.255.255.0
+  nat-pool 1 10.0.0.100 10.0.0.110 netmask 255.255.255.0 pat
+  nat-pool 2 10.0.0.120 netmask 255.255.255.0
+  service-policy input int-1
+  no shutdown
+interface vlan 200
+  ip address 10.1.0.2 255.255.255.0
+
+policy-map multi-match int-1
+  class vip1
+    loadbalance vip inservice
+  class vip2
+    loadbalance vip inservice
+"""
+
+
+class TestRunningConfig(unittest.TestCase):
+    def test_parse(self):
+        config = running_config.RunningConfig.parse(RUNNING_CONFIG)
+        self.assertEqual(config.get_nat_pools(), [
+            {'vlan': '100', 'id': '1', 'ip1': '10.0.0.100',
+             'ip2': '10.0.0.110', 'netmask': '255.255.255.0'},
+            {'vlan': '100', 'id': '2', 'ip1': '10.0.0.120',
+             'ip2': '10.0.0.120', 'netmask': '255.255.255.0'}])
+        self.assertEqual(sorted(config.vlans), ['100', '200'])
+        self.assertEqual(config.vlans['100']['service_policies'],
+                         set(['int-1']))
+        self.assertEqual(config.get_policy_map_classes('int-1'),
+                         set(['vip1', 'vip2']))
+
+    def test_update(self):
+        config = running_config.RunningConfig.parse(RUNNING_CONFIG)
+        config.add_nat_pool({'vlan': 200, 'id': 3, 'ip1': '10.1.0.100',
+                             'netmask': '255.255.255.0', 'pat': True})
+        config.delete_nat_pool('100', '1')
+        self.assertEqual([(p['vlan'], p['id'])
+                          for p in config.get_nat_pools()],
+                         [('100', '2'), ('200', '3')])
+        config.delete_policy_map('int-1')
+        self.assertEqual(config.get_policy_map_classes('int-1'), set())
+        self.assertEqual(config.vlans['100']['service_policies'], set())
+
+    def test_expired(self):
+        config = running_config.RunningConfig(timestamp=0)
+        self.assertTrue(config.expired(30))
+        self.assertFalse(running_config.RunningConfig().expired(30))
+
+
+class TestAceDriverRunningConfig(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(get_fake_conf(), dev)
+        self.send = mock.Mock(return_value=RESPONSE_OK)
+        self.driver._send = self.send
+        self.driver.getConfig = mock.Mock(return_value=RUNNING_CONFIG)
+
+    def test_read_once(self):
+        with self.driver.request_context():
+            self.assertEqual(len(self.driver.get_nat_pools()), 2)
+            self.driver.create_nat_pool({'vlan': 200, 'id': 3,
+                                         'ip1': '10.1.0.100',
+                                         'netmask': '255.255.255.0'})
+            self.assertEqual(len(self.driver.get_nat_pools()), 3)
+        self.assertEqual(len(self.driver.get_nat_pools()), 3)
+        self.driver.getConfig.assert_called_once_with('')
+
+    def test_expired_between_requests(self):
+        self.driver.conf.ace_config_ttl = 0
+        with self.driver.request_context():
+            self.driver.get_nat_pools()
+            self.driver.get_nat_pools()
+        with self.driver.request_context():
+            self.driver.get_nat_pools()
+        self.assertEqual(self.driver.getConfig.call_count, 2)
+
+    def test_failed_request_drops_config(self):
+        with self.assertRaises(ValueError):
+            with self.driver.request_context():
+                self.driver.get_nat_pools()
+                raise ValueError()
+        self.assertIsNone(self.driver._running_config)
+
+    def test_delete_last_virtual_ip(self):
+        self.driver.getConfig.return_value = \
+                "policy-map multi-match global\n  class vip1\n"
+        vip = {'name': 'vip1', 'address': '10.0.0.10',
+               'extra': {'allVLANs': True}}
+        self.driver.delete_virtual_ip(vip)
+        self.assertIn(mock.call(['configure',
+                                 'no policy-map multi-match global', 'end']),
+                      self.send.call_args_list)
+        self.assertNotIn('global', self.driver._running_config.policy_maps)
+
+    def test_delete_virtual_ip(self):
+        self.driver.getConfig.return_value = \
+                "policy-map multi-match global\n  class vip1\n  class vip2\n"
+        vip = {'name': 'vip1', 'address': '10.0.0.10',
+               'extra': {'allVLANs': True}}
+        self.driver.delete_virtual_ip(vip)
+        self.assertNotIn(mock.call(['configure',
+                                    'no policy-map multi-match global',
+                                    'end']),
+                         self.send.call_args_list)
+        self.assertEqual(self.driver._running_config.policy_maps['global'],
+                         set(['vip2']))
+
+
+class TestNatPoolIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = nat_pool.NatPoolIndex(max_id=4)
+        self.pool1 = {'vlan': '100', 'id': '1', 'ip1': '10.0.0.100',
+                      'ip2': '10.0.0.110', 'netmask': '255.255.255.0'}
+        self.pool2 = {'vlan': '200', 'id': '2', 'ip1': '10.0.1.254',
+                      'netmask': '255.255.255.0'}
+        self.index.add(self.pool1)
+        self.index.add(self.pool2)
+
+    def test_find(self):
+        find = self.index.find
+        self.assertEqual(find(ipaddr.IPNetwork('10.0.0.1/24')), self.pool1)
+        self.assertEqual(find(ipaddr.IPNetwork('10.0.1.1/24')), self.pool2)
+        self.assertEqual(find(ipaddr.IPNetwork('10.0.0.0/16')), self.pool1)
+        self.assertIsNone(find(ipaddr.IPNetwork('10.0.0.96/29')))
+        self.assertIsNone(find(ipaddr.IPNetwork('10.0.1.0/25')))
+        self.assertIsNone(find(ipaddr.IPNetwork('2001:db8::/32')))
+
+    def test_find_large_network(self):
+        self.index.add({'vlan': '300', 'id': '3', 'ip1': '2001:db8::10',
+                        'netmask': '64'})
+        pool = self.index.find(ipaddr.IPNetwork('2001:db8::1/32'))
+        self.assertEqual(pool['id'], '3')
+
+    def test_free_id(self):
+        self.assertEqual(self.index.get_free_id(), 3)
+        self.index.remove('100', '1')
+        self.assertEqual(self.index.get_free_id(), 1)
+        self.assertIsNone(self.index.find(ipaddr.IPNetwork('10.0.0.1/24')))
+        self.assertEqual(len(self.index), 1)
+
+    def test_free_id_shared(self):
+        self.index.add(dict(self.pool1, vlan='300'))
+        self.index.remove('100', '1')
+        self.assertEqual(self.index.get_free_id(), 3)
+
+    def test_no_free_id(self):
+        self.index.add({'vlan': '100', 'id': 3, 'ip1': '10.0.2.1',
+                        'netmask': '255.255.255.0'})
+        self.index.add({'vlan': '100', 'id': 4, 'ip1': '10.0.3.1',
+                        'netmask': '255.255.255.0'})
+        self.assertRaises(nat_pool.NoFreeNatPoolId, self.index.get_free_id)
+
+    def test_last_host(self):
+        self.assertEqual(str(nat_pool.get_last_host(
+                ipaddr.IPNetwork('10.0.0.5/24'))), '10.0.0.254')
+        self.assertEqual(str(nat_pool.get_last_host(
+                ipaddr.IPNetwork('10.0.0.5/32'))), '10.0.0.5')
+
+
+class TestAceDriverNatPool(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(get_fake_conf(), dev)
+        self.driver._send = mock.Mock(return_value=RESPONSE_OK)
+        self.driver.getConfig = mock.Mock(return_value=RUNNING_CONFIG)
+
+    def test_find_nat_pool_for_vip(self):
+        vip = {'ipVersion': 'IPv4', 'address': '10.0.0.10',
+               'mask': '255.255.255.0'}
+        self.assertEqual(self.driver.find_nat_pool_for_vip(vip)['id'], '1')
+
+    def test_generate_nat_pool_for_vip(self):
+        vip = {'ipVersion': 'IPv6', 'address': '2001:db8::1', 'mask': '32',
+               'extra': {'VLAN': '300'}}
+        nat_pool = self.driver.generate_nat_pool_for_vip(vip)
+        self.assertEqual(nat_pool['id'], 3)
+        self.assertEqual(nat_pool['ip1'],
+                         '2001:db8:ffff:ffff:ffff:ffff:ffff:fffe')
+        self.driver.create_nat_pool(nat_pool)
+        self.assertEqual(self.driver.find_nat_pool_for_vip(vip)['id'], '3')
+        self.assertEqual(
+                self.driver.generate_nat_pool_for_vip(vip)['id'], 4)
+
+
+class TestAceDriverDeviceState(unittest.TestCase):
+    def setUp(self):
+        self.driver = AceDriver(get_fake_conf(), dev)
+        self.driver.getConfig = mock.Mock(return_value="""
+probe http p1
+  port 80
+rserver host rs1
+  ip address 10.0.0.1
+  inservice
+serverfarm host sf1
+  probe p1
+  rserver rs1 80
+    inservice
+  rserver rs2 80
+  predictor leastconns
+class-map match-all vip1
+  2 match virtual-address 10.0.0.10 tcp eq www
+""")
+
+    def test_get_device_state(self):
+        self.driver._running_config = running_config.RunningConfig()
+        self.assertEqual(self.driver.get_device_state(), {
+            'serverfarm': {'sf1': {}},
+            'rserver': {('sf1', 'rs1'): {'state': 'inservice'},
+                        ('sf1', 'rs2'): {'state': 'outofservice'}},
+            'probe': {'p1': {}},
+            'vip': {'vip1': {}},
+        })
+        self.driver.getConfig.assert_called_once_with('')
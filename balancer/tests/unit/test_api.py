@@ -1,7 +1,11 @@
+import datetime
+import json
 import unittest
 import mock
+import webob
 import balancer.exception as exception
 
+from balancer.api import utils
 from balancer.api.v1 import loadbalancers
 from balancer.api.v1 import devices
 
@@ -12,6 +16,7 @@ class TestLoadBalancersController(unittest.TestCase):
         self.conf = mock.Mock()
         self.controller = loadbalancers.Controller(self.conf)
         self.req = mock.Mock()
+        self.req.params = {}
 
     @mock.patch('balancer.core.api.lb_find_for_vm', autospec=True)
     def test_find_lb_for_vm(self, mock_lb_find_for_vm):
@@ -30,6 +35,16 @@ class TestLoadBalancersController(unittest.TestCase):
         self.assertTrue(mock_lb_get_index.called)
         self.assertEqual(resp, {'loadbalancers': 'foo'})
 
+    @mock.patch('balancer.core.api.lb_get_index', autospec=True)
+    def test_index_list_params(self, mock_lb_get_index):
+        self.req.headers = {'X-Tenant-Id': 'fake_tenant_id'}
+        self.req.params = {'status': 'ACTIVE', 'limit': '10', 'marker': 'm',
+                           'fields': 'name'}
+        self.controller.index(self.req)
+        mock_lb_get_index.assert_called_once_with(self.conf,
+                'fake_tenant_id', filters={'status': 'ACTIVE'}, limit=10,
+                marker='m', fields=set(['id', 'name']))
+
     @mock.patch('balancer.core.api.create_lb', autospec=True)
     @mock.patch('balancer.db.api.loadbalancer_create', autospec=True)
     def test_create(self, mock_loadbalancer_create, mock_create_lb):
@@ -200,6 +215,7 @@ class TestDeviceController(unittest.TestCase):
         self.conf = mock.Mock()
         self.controller = devices.Controller(self.conf)
         self.req = mock.Mock()
+        self.req.params = {}
 
     @mock.patch('balancer.core.api.device_get_index', autospec=True)
     def test_index(self, mock_device_get_index):
@@ -224,6 +240,20 @@ class TestDeviceController(unittest.TestCase):
         self.assertTrue(self.controller.delete.wsgi_code == 202,
         "incorrect HTTP status code")
 
+    @mock.patch('balancer.core.api.device_show_drift', autospec=True)
+    def test_show_drift(self, mock_show_drift):
+        mock_show_drift.return_value = 'foo'
+        resp = self.controller.show_drift(self.req, id='123')
+        mock_show_drift.assert_called_once_with(self.conf, '123')
+        self.assertEqual({'drift': 'foo'}, resp)
+
+    @mock.patch('balancer.core.api.device_fix_drift', autospec=True)
+    def test_fix_drift(self, mock_fix_drift):
+        mock_fix_drift.return_value = 'foo'
+        resp = self.controller.fix_drift(self.req, id='123')
+        mock_fix_drift.assert_called_once_with(self.conf, '123')
+        self.assertEqual({'drift': 'foo'}, resp)
+
     @unittest.skip('need to implement Controller.device_info')
     @mock.patch('balancer.core.api.device_info', autospec=True)
     def test_info(self, mock_device_info):
@@ -231,3 +261,54 @@ class TestDeviceController(unittest.TestCase):
         resp = self.controller.device_info(self.req)
         self.assertTrue(mock_device_info.called)
         self.assertEqual({'devices': 'foo'}, resp)
+
+
+class TestListParams(unittest.TestCase):
+    def setUp(self):
+        self.req = mock.Mock()
+
+    def test_empty(self):
+        self.req.params = {}
+        self.assertEqual(utils.get_list_params(self.req), {})
+
+    def test_all(self):
+        self.req.params = {'name': 'lb1', 'other': 'x', 'marker': 'm',
+                           'limit': '5', 'sort_key': 'name',
+                           'sort_dir': 'desc', 'fields': 'name, status'}
+        params = utils.get_list_params(self.req, ('name', 'status'),
+                                       ('id', 'name'))
+        self.assertEqual(params, {'filters': {'name': 'lb1'},
+                                  'marker': 'm',
+                                  'limit': 5,
+                                  'sort_key': 'name',
+                                  'sort_dir': 'desc',
+                                  'fields': set(['id', 'name', 'status'])})
+
+    def test_invalid(self):
+        for params in ({'limit': 'x'}, {'limit': '-1'},
+                       {'sort_key': 'password'}, {'sort_dir': 'up'}):
+            self.req.params = params
+            self.assertRaises(exception.InvalidListParameter,
+                              utils.get_list_params, self.req)
+
+
+class TestStreamingJSONResponseSerializer(unittest.TestCase):
+    def setUp(self):
+        self.serializer = utils.StreamingJSONResponseSerializer()
+        self.response = webob.Response()
+
+    def test_default(self):
+        result = {'loadbalancers': [{'id': i, 'name': u'lb\u044f',
+                          'created_at': datetime.datetime(2012, 1, 1)}
+                                    for i in range(100)],
+                  'count': 100}
+        self.serializer.chunk_size = 1024
+        self.serializer.default(self.response, result)
+        chunks = list(self.response.app_iter)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(''.join(chunks)),
+                         json.loads(self.serializer.to_json(result)))
+
+    def test_default_not_streamed(self):
+        self.serializer.default(self.response, 'OK')
+        self.assertEqual(self.response.body, '"OK"')
@@ -0,0 +1,76 @@
+import mock
+import unittest
+
+from balancer.core import cache
+from balancer.db import session as db_session
+
+
+class TestMemoryCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.MemoryCache(2, 60)
+
+    def test_get_copy(self):
+        value = {'nodes': [1]}
+        self.cache.set('key', value)
+        value['nodes'].append(2)
+        result = self.cache.get('key')
+        self.assertEqual(result, {'nodes': [1]})
+        result['nodes'].append(3)
+        self.assertEqual(self.cache.get('key'), {'nodes': [1]})
+
+    def test_lru(self):
+        self.cache.set('key1', 1)
+        self.cache.set('key2', 2)
+        self.cache.get('key1')
+        self.cache.set('key3', 3)
+        self.assertEqual(self.cache.get('key1'), 1)
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertEqual(self.cache.get('key3'), 3)
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 100
+        self.cache.set('key', 1)
+        mock_time.return_value = 159
+        self.assertEqual(self.cache.get('key'), 1)
+        mock_time.return_value = 161
+        self.assertIsNone(self.cache.get('key'))
+
+
+class TestCached(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('balancer.core.cache.CACHE', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conf = mock.Mock()
+        self.conf.cache.backend = 'memory'
+        self.conf.cache.max_size = 100
+        self.conf.cache.ttl = 60
+        self.func = mock.Mock(__name__='func', return_value={'id': 'lb1'})
+        self.cached = cache.cached('view')(self.func)
+
+    def test_cached(self):
+        self.assertEqual(self.cached(self.conf, 'lb1'), {'id': 'lb1'})
+        self.assertEqual(self.cached(self.conf, 'lb1'), {'id': 'lb1'})
+        self.assertEqual(self.func.call_count, 1)
+        self.cached(self.conf, 'lb2')
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_invalidate(self):
+        self.cached(self.conf, 'lb1')
+        cache.invalidate(self.conf, ['lb1'])
+        self.cached(self.conf, 'lb1')
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_invalidated_by_db_changes(self):
+        self.assertIn(cache.invalidate, db_session._CHANGE_LISTENERS)
+
+    @mock.patch('balancer.db.session._LOCAL')
+    def test_transaction_not_cached(self, mock_local):
+        self.cached(self.conf, 'lb1')
+        self.cached(self.conf, 'lb1')
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_unknown_backend(self):
+        self.conf.cache.backend = 'fake'
+        self.assertRaises(ValueError, cache.get_cache, self.conf)
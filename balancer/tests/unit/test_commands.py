@@ -3,6 +3,10 @@ import unittest
 import mock
 import types
 
+from balancer.core import executor
+from balancer.db import api as db_api
+from balancer.loadbalancers import vserver
+
 
 class TestDecorators(unittest.TestCase):
     """Need help with def fin coverage"""
@@ -192,6 +196,27 @@ class TestRserver(unittest.TestCase):
         self.assertFalse(mock_f1.called,\
                 "server_update called")
 
+    def test_update_rserver_in_server_farm(self):
+        new_rs = dict(self.rs, weight=3)
+        cmd.update_rserver_in_server_farm(self.ctx, 'sf', self.rs, new_rs)
+        self.ctx.device.update_real_server_in_server_farm.\
+                assert_called_once_with('sf', self.rs, new_rs)
+        rollback_fn = self.ctx.add_rollback.call_args[0][0]
+        rollback_fn(False)
+        self.assertEqual(
+                self.ctx.device.update_real_server_in_server_farm.\
+                        call_args_list[-1],
+                mock.call('sf', new_rs, self.rs))
+
+    def test_update_rserver_with_parent(self):
+        new_rs = dict(self.rs, parent_id='parent', name='child')
+        cmd.update_rserver_in_server_farm(self.ctx, 'sf', dict(self.rs),
+                                          new_rs)
+        old_rs, new_rs = self.ctx.device.update_real_server_in_server_farm.\
+                call_args[0][1:]
+        self.assertEqual(old_rs['name'], 'parent')
+        self.assertEqual(new_rs['name'], 'parent')
+
 
 class TestSticky(unittest.TestCase):
     def setUp(self):
@@ -365,6 +390,10 @@ class TestServerFarm(unittest.TestCase):
 class TestLoadbalancer(unittest.TestCase):
     def setUp(self):
         self.ctx = mock.MagicMock()
+        self.ctx.conf.device_parallel_operations = 4
+        binding = executor.bind_context(self.ctx)
+        binding.__enter__()
+        self.addCleanup(binding.__exit__, None, None, None)
         self.rserver = mock.MagicMock()
         self.probe = mock.MagicMock()
         self.sticky = mock.MagicMock()
@@ -407,12 +436,6 @@ class TestLoadbalancer(unittest.TestCase):
         self.assertTrue(mf7.called, "delete_sticky not called")
         self.assertTrue(mf4.called, "delete_server_farm not called")
 
-    @mock.patch("balancer.core.commands.create_server_farm")
-    def test_update_loadbalancer(self, mock_func):
-        self.lb0 = mock.MagicMock()
-        cmd.update_loadbalancer(self.ctx, self.balancer, self.lb0)
-        self.assertTrue(mock_func.called, "function not called")
-
     @mock.patch("balancer.core.commands.create_rserver")
     @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
     def test_add_node_to_loadbalancer(self, mock_f1, mock_f2):
@@ -435,6 +458,16 @@ class TestLoadbalancer(unittest.TestCase):
         self.assertTrue(mock_f1.called, "add_probe not called")
         self.assertTrue(mock_f2.called, "create_probe not called")
 
+    @mock.patch("balancer.core.executor.execute_parallel")
+    def test_add_nodes_grouped_by_address(self, mock_execute):
+        rservers = [{'address': '10.0.0.1', 'port': 80},
+                    {'address': '10.0.0.2', 'port': 80},
+                    {'address': '10.0.0.1', 'port': 81}]
+        cmd.add_nodes_to_loadbalancer(self.ctx, self.balancer, rservers)
+        self.assertEqual(mock_execute.call_args[0][2],
+                         [(self.balancer, [rservers[0], rservers[2]]),
+                          (self.balancer, [rservers[1]])])
+
     @mock.patch("balancer.core.commands.remove_probe_from_server_farm")
     @mock.patch("balancer.core.commands.delete_probe")
     def test_makeDeleteProbeFromLBChain(self, mock_f1, mock_f2):
@@ -453,3 +486,113 @@ class TestLoadbalancer(unittest.TestCase):
         cmd.remove_sticky_from_loadbalancer(
                 self.ctx, self.balancer, self.sticky)
         self.assertTrue(mock_func.called, "delete_sticky not called")
+
+
+def get_fake_balancer():
+    balancer = vserver.Balancer(mock.Mock())
+    balancer.lb = db_api.loadbalancer_pack_extra({'id': 'lb1',
+                                                  'algorithm': 'RoundRobin'})
+    balancer.sf = db_api.serverfarm_pack_extra({'id': 'sf1', 'name': 'sf1'})
+    balancer.sf._predictor = db_api.predictor_pack_extra(
+            {'id': 'pr1', 'type': 'RoundRobin'})
+    balancer.rs = [db_api.server_pack_extra({'id': 'rs%d' % i,
+                                             'name': 'rs%d' % i,
+                                             'address': '10.0.0.%d' % i,
+                                             'port': '80',
+                                             'parent_id': '',
+                                             'state': 'inservice'})
+                   for i in range(3)]
+    balancer.probes = [db_api.probe_pack_extra({'id': 'probe1',
+                                                'type': 'HTTP'})]
+    balancer.vips = [db_api.virtualserver_pack_extra({'id': 'vip1',
+                                                      'address': '10.0.1.1',
+                                                      'port': '80'})]
+    balancer.sf._sticky = [db_api.sticky_pack_extra({'id': 'st1',
+                                                     'type': 'HTTPCookie'})]
+    return balancer
+
+
+class TestUpdateLoadbalancer(unittest.TestCase):
+    def setUp(self):
+        self.ctx = mock.MagicMock()
+        self.old = get_fake_balancer()
+        self.new = get_fake_balancer()
+        self.commands = mock.Mock()
+        for name in ('delete_vip', 'create_vip',
+                     'remove_sticky_from_loadbalancer',
+                     'add_sticky_to_loadbalancer',
+                     'makeDeleteProbeFromLBChain',
+                     'add_probe_to_loadbalancer',
+                     'remove_nodes_from_loadbalancer',
+                     'add_nodes_to_loadbalancer',
+                     'update_server_farm', 'update_rserver_in_server_farm',
+                     'activate_rserver', 'suspend_rserver'):
+            patcher = mock.patch.object(cmd, name,
+                                        getattr(self.commands, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_unchanged(self):
+        self.new.lb['name'] = 'lb2'
+        self.new.rs[0]['deployed'] = 'True'
+        cmd.update_loadbalancer(self.ctx, self.old, self.new)
+        self.assertEqual(self.commands.method_calls, [])
+
+    def test_server_farm(self):
+        self.new.sf._predictor['type'] = 'LeastConnections'
+        cmd.update_loadbalancer(self.ctx, self.old, self.new)
+        self.assertEqual(self.commands.method_calls, [
+            mock.call.update_server_farm(self.ctx, self.old.sf, self.new.sf),
+        ])
+
+    def test_nodes(self):
+        rs0, rs1, rs2 = self.new.rs
+        rs3 = db_api.server_pack_extra({'id': 'rs3', 'address': '10.0.0.3'})
+        rs0['weight'] = 5
+        rs2['state'] = 'outofservice'
+        rs2['parent_id'] = self.old.rs[2]['parent_id'] = 'rs0'
+        self.new.rs = [rs0, rs2, rs3]
+        cmd.update_loadbalancer(self.ctx, self.old, self.new)
+        self.assertEqual(self.commands.method_calls, [
+            mock.call.remove_nodes_from_loadbalancer(self.ctx, self.old,
+                                                     [self.old.rs[1]]),
+            mock.call.update_rserver_in_server_farm(
+                    self.ctx, self.new.sf, dict(self.old.rs[0].iteritems()),
+                    dict(rs0.iteritems())),
+            mock.call.suspend_rserver(self.ctx, self.new.sf,
+                    dict(rs2.iteritems(), name='rs0')),
+            mock.call.add_nodes_to_loadbalancer(self.ctx, self.new, [rs3]),
+        ])
+        self.assertEqual(rs2['name'], 'rs2')
+
+    def test_recreate_changed(self):
+        self.new.probes[0]['probeInterval'] = 10
+        self.new.vips[0]['appProto'] = 'HTTPS'
+        self.new.sf._sticky = []
+        cmd.update_loadbalancer(self.ctx, self.old, self.new)
+        self.assertEqual(self.commands.method_calls, [
+            mock.call.delete_vip(self.ctx, self.old.vips[0]),
+            mock.call.remove_sticky_from_loadbalancer(
+                    self.ctx, self.old, self.old.sf._sticky[0]),
+            mock.call.makeDeleteProbeFromLBChain(self.ctx, self.old,
+                                                 self.old.probes[0]),
+            mock.call.add_probe_to_loadbalancer(self.ctx, self.new,
+                                                self.new.probes[0]),
+            mock.call.create_vip(self.ctx, self.new.vips[0], self.new.sf),
+        ])
+
+
+class TestUpdateServerFarm(unittest.TestCase):
+    def setUp(self):
+        self.ctx = mock.MagicMock()
+        self.old_sf = mock.MagicMock()
+        self.new_sf = mock.MagicMock()
+
+    def test_update_server_farm(self):
+        cmd.update_server_farm(self.ctx, self.old_sf, self.new_sf)
+        self.ctx.device.create_server_farm.assert_called_once_with(
+                self.new_sf, self.new_sf._predictor)
+        rollback = self.ctx.add_rollback.call_args[0][0]
+        rollback(False)
+        self.assertEqual(self.ctx.device.create_server_farm.call_args,
+                         mock.call(self.old_sf, self.old_sf._predictor))
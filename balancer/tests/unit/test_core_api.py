@@ -30,7 +30,11 @@ class TestBalancer(unittest.TestCase):
     patch_logger = mock.patch("logging.getLogger")
 
     def setUp(self):
+        patcher = mock.patch("balancer.db.api.transaction")
+        self.mock_transaction = patcher.start()
+        self.addCleanup(patcher.stop)
         self.conf = mock.MagicMock()
+        self.conf.cache.backend = 'none'
         value = mock.MagicMock
         self.dict_list = ({'id': 1, 'name': 'name', 'extra': {
             'stragearg': value, 'anotherarg': value}, },
@@ -91,20 +95,33 @@ class TestBalancer(unittest.TestCase):
         mock_commands.called_once_with(exception.Invalid)
 
     @patch_balancer
-    @mock.patch("balancer.db.api.predictor_pack_extra")
+    @mock.patch("balancer.core.commands.update_loadbalancer")
     @mock.patch("balancer.drivers.get_device_driver")
-    def test_update_lb_0(self, mock_driver, mock_api, mock_bal):
-        """No exception, key.lower!='algorithm'"""
-        api.update_lb(self.conf, self.lb_id, self.lb_body_0, async=False)
-        self.assertFalse(mock_api.called)
+    def test_update_lb_0(self, mock_driver, mock_command, mock_bal):
+        """No exception"""
+        old_bal, new_bal = mock.MagicMock(), mock.MagicMock()
+        mock_bal.side_effect = [old_bal, new_bal]
+        res = api.update_lb(self.conf, self.lb_id, self.lb_body, async=False)
+        self.assertEqual(res, self.lb_id)
+        new_bal.updateParams.assert_called_once_with(self.lb_body)
+        new_bal.savetoDB.assert_called_once_with(delete_removed=False)
+        ctx = mock_driver.return_value.request_context.return_value.\
+                __enter__.return_value
+        mock_command.assert_called_once_with(ctx, old_bal, new_bal)
+        self.assertEqual(new_bal.lb.status, 'ACTIVE')
+        self.assertTrue(new_bal.update.called)
+        self.assertFalse(old_bal.updateParams.called)
 
     @patch_balancer
-    @mock.patch("balancer.db.api.predictor_pack_extra")
+    @mock.patch("balancer.core.commands.update_loadbalancer")
     @mock.patch("balancer.drivers.get_device_driver")
-    def test_update_lb_1(self, mock_driver, mock_api, mock_bal):
-        """No exception, key.lower='algorithm'"""
-        api.update_lb(self.conf, self.lb_id, self.lb_body, async=False)
-        self.assertTrue(mock_api.called)
+    def test_update_lb_1(self, mock_driver, mock_command, mock_bal):
+        """Exception during deploy"""
+        mock_command.side_effect = exception.Error
+        res = api.update_lb(self.conf, self.lb_id, self.lb_body, async=False)
+        self.assertIsNone(res)
+        self.assertEqual(mock_bal.return_value.lb.status, 'ERROR')
+        self.assertTrue(mock_bal.return_value.update.called)
 
     @patch_balancer
     @mock.patch("balancer.drivers.get_device_driver")
@@ -124,20 +141,39 @@ class TestBalancer(unittest.TestCase):
 
     @patch_balancer
     @mock.patch("balancer.drivers.get_device_driver")
-    @mock.patch("balancer.core.commands.add_node_to_loadbalancer")
-    def test_lb_add_nodes(self, mock_command, mock_driver, mock_bal):
-        api.lb_add_nodes(self.conf, self.lb_id, self.lb_nodes)
-        self.assertTrue(mock_command.called)
-        self.assertTrue(mock_command.call_count == 2)
-        self.assertTrue(mock_driver.called)
-        self.assertTrue(mock_driver.call_count == 2)
+    @mock.patch("balancer.core.commands.add_nodes_to_loadbalancer")
+    @mock.patch("balancer.db.api.server_create_all")
+    @mock.patch("balancer.db.api.server_get_all_by_address_on_device")
+    def test_lb_add_nodes(self, mock_parent, mock_create, mock_command,
+                          mock_driver, mock_bal):
+        mock_parent.return_value = {}
+        rs_refs = [{'id': 0}, {'id': 1}]
+        mock_create.return_value = rs_refs
+        res = api.lb_add_nodes(self.conf, self.lb_id, self.lb_nodes)
+        self.assertEqual(res, {'nodes': [{'id': 0}, {'id': 1}]})
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertEqual(len(mock_create.call_args[0][1]), 2)
+        self.assertEqual(mock_command.call_count, 1)
+        self.assertIs(mock_command.call_args[0][2], rs_refs)
+        self.assertEqual(mock_driver.call_count, 1)
+        self.assertFalse(mock_bal.return_value.removeFromDB.called)
+        self.assertFalse(mock_bal.return_value.savetoDB.called)
 
-    @patch_balancer
-    @mock.patch("balancer.db.api.unpack_extra")
-    def test_lb_show_nodes(self, mock_api, mock_bal):
-        mock_bal.return_value.rs = self.dict_list
-        api.lb_show_nodes(self.conf, 1)
-        self.assertTrue(mock_api.called)
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    @mock.patch("balancer.db.api.server_get_all_by_sf_id")
+    def test_lb_show_nodes(self, mock_get_rs, mock_get_sf):
+        mock_get_sf.return_value = [{'id': 'sf1'}]
+        mock_get_rs.return_value = self.dict_list
+        res = api.lb_show_nodes(self.conf, 1, fields=['id'], limit=2)
+        mock_get_sf.assert_called_once_with(self.conf, 1)
+        mock_get_rs.assert_called_once_with(self.conf, 'sf1', limit=2)
+        self.assertEqual(len(res['nodes']), len(self.dict_list))
+
+    @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
+    def test_lb_show_nodes_not_found(self, mock_get_sf):
+        mock_get_sf.return_value = []
+        self.assertRaises(exc.LoadBalancerNotFound,
+                          api.lb_show_nodes, self.conf, 1)
 
     @patch_balancer
     @mock.patch("balancer.drivers.get_device_driver")
@@ -198,14 +234,12 @@ class TestBalancer(unittest.TestCase):
     @mock.patch("balancer.db.api.server_destroy")
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.db.api.serverfarm_get")
-    @mock.patch("balancer.core.commands.delete_rserver_from_server_farm")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    def test_lb_update_node_0(self, mock_com0, mock_com1, *mocks):
+    @mock.patch("balancer.core.commands.update_rserver_in_server_farm")
+    def test_lb_update_node_0(self, mock_com0, *mocks):
         """"""
         api.lb_update_node(self.conf, self.lb_id, self.lb_node_id,
                 self.lb_node)
         self.assertTrue(mock_com0.called)
-        self.assertTrue(mock_com1.called)
 
     @patch_balancer
     @mock.patch("balancer.drivers.get_device_driver")
@@ -215,15 +249,13 @@ class TestBalancer(unittest.TestCase):
     @mock.patch("balancer.db.api.loadbalancer_get")
     @mock.patch("balancer.db.api.serverfarm_get")
     @mock.patch("balancer.db.api.server_destroy")
-    @mock.patch("balancer.core.commands.delete_rserver_from_server_farm")
-    @mock.patch("balancer.core.commands.add_rserver_to_server_farm")
-    def test_lb_update_node_1(self, mock_com0, mock_com1, mock_api0, *mocks):
+    @mock.patch("balancer.core.commands.update_rserver_in_server_farm")
+    def test_lb_update_node_1(self, mock_com0, mock_api0, *mocks):
         """"""
         mock_api0.return_value = self.dictionary
         api.lb_update_node(self.conf, self.lb_id, 1,
                 self.lb_node)
         self.assertTrue(mock_com0.called)
-        self.assertTrue(mock_com1.called)
 
     @mock.patch("balancer.db.api.unpack_extra")
     @mock.patch("balancer.db.api.serverfarm_get_all_by_lb_id")
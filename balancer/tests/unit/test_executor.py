@@ -0,0 +1,138 @@
+import unittest
+
+import eventlet
+import mock
+
+from balancer.core import executor
+from balancer.drivers.cisco_ace.ace_driver import AceDriver
+from balancer.drivers.haproxy.HaproxyDriver import HaproxyDriver
+from balancer.tests.unit import run_monkey_patched
+from balancer.tests.unit import test_acedriver
+from balancer.tests.unit import test_haproxy_driver
+
+
+def run_steps_on_real_drivers():
+    ace = AceDriver(test_acedriver.get_fake_conf(), test_acedriver.dev)
+    ace._send = mock.Mock(return_value=test_acedriver.RESPONSE_OK)
+    conf = test_haproxy_driver.get_fake_conf()
+    with mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig') \
+            as mock_remote:
+        with mock.patch('balancer.drivers.haproxy.HaproxyDriver.'
+                        'HaproxyConfigFile'):
+            haproxy = HaproxyDriver(conf, test_haproxy_driver.device_fake)
+            for driver in (ace, haproxy):
+                driver.conf.device_parallel_operations = 2
+                rollbacks = []
+
+                def step(ctx, name):
+                    assert executor.current_context() is ctx
+                    assert executor.request_owner() is ctx.owner
+                    driver.delete_server_farm({'name': name})
+                    rollback = mock.Mock(name=name)
+                    rollbacks.append(rollback)
+                    ctx.add_rollback(rollback)
+
+                with eventlet.Timeout(5):
+                    with driver.request_context() as ctx:
+                        executor.execute_parallel(ctx, step,
+                                [('sf%s' % i,) for i in range(4)])
+                        assert len(ctx.rollback_stack) == 4
+                for rollback in rollbacks:
+                    rollback.assert_called_once_with(True)
+    assert ace._send.call_count == 1
+    assert len(ace._send.call_args[0][0]) == 4 * 3
+    assert mock_remote.return_value.push_config.call_count == 1
+
+
+class TestExecuteParallel(unittest.TestCase):
+    def setUp(self):
+        self.ctx = mock.MagicMock(rollback_stack=[])
+        self.ctx.add_rollback.side_effect = self.ctx.rollback_stack.append
+        self.ctx.conf.device_parallel_operations = 2
+        self.ctx.device.wrap_rollback.side_effect = lambda rollback: rollback
+        binding = executor.bind_context(self.ctx)
+        binding.__enter__()
+        self.addCleanup(binding.__exit__, None, None, None)
+        executor.DEVICE_SEMAPHORES.clear()
+
+    def test_rollbacks_in_order(self):
+        def step(ctx, name, delay):
+            eventlet.sleep(delay)
+            ctx.add_rollback(name + '1')
+            ctx.add_rollback(name + '2')
+
+        executor.execute_parallel(self.ctx, step,
+                [('a', 0.03), ('b', 0.01), ('c', 0)])
+        self.assertEqual(self.ctx.rollback_stack,
+                         ['a1', 'a2', 'b1', 'b2', 'c1', 'c2'])
+
+    def test_step_context(self):
+        def step(ctx):
+            self.assertIsInstance(ctx, executor.StepContext)
+            self.assertIs(ctx.device, self.ctx.device)
+            self.assertIs(ctx.conf, self.ctx.conf)
+            self.assertIs(executor.current_context(), ctx)
+            self.assertIs(executor.request_owner(), self.ctx.owner)
+
+        executor.execute_parallel(self.ctx, step, [(), ()])
+        self.assertIs(executor.current_context(), self.ctx)
+
+    def test_rollbacks_wrapped_by_driver(self):
+        def step(ctx, name):
+            ctx.add_rollback(name)
+
+        self.ctx.device.wrap_rollback.side_effect = lambda rollback: \
+                rollback.upper()
+        executor.execute_parallel(self.ctx, step, [('a',), ('b',)])
+        self.assertEqual(self.ctx.rollback_stack, ['A', 'B'])
+
+    def test_outside_request(self):
+        with executor.bind_context(None):
+            with self.assertRaises(RuntimeError):
+                executor.execute_parallel(self.ctx, mock.Mock(), [()])
+
+    def test_nested_steps(self):
+        def step(ctx):
+            executor.execute_parallel(ctx, mock.Mock(), [()])
+
+        with self.assertRaises(RuntimeError):
+            executor.execute_parallel(self.ctx, step, [()])
+
+    def test_real_drivers_monkey_patched(self):
+        status, output = run_monkey_patched(run_steps_on_real_drivers)
+        self.assertEqual(status, 0, output)
+
+    def test_concurrency_limit(self):
+        running = []
+        peak = []
+
+        def step(ctx, i):
+            running.append(i)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.remove(i)
+
+        executor.execute_parallel(self.ctx, step, [(i,) for i in range(6)])
+        self.assertEqual(max(peak), 2)
+
+    def test_limit_shared_by_device(self):
+        sem = executor.get_device_semaphore(self.ctx.conf, self.ctx.device)
+        self.assertIs(executor.get_device_semaphore(self.ctx.conf,
+                                                    self.ctx.device), sem)
+        self.assertIsNot(executor.get_device_semaphore(self.ctx.conf,
+                                                       mock.Mock()), sem)
+
+    def test_first_error_raised(self):
+        def step(ctx, name, error):
+            ctx.add_rollback(name)
+            if error:
+                raise error
+
+        with self.assertRaises(KeyError):
+            executor.execute_parallel(self.ctx, step,
+                    [('a', None), ('b', KeyError()), ('c', ValueError())])
+        self.assertEqual(self.ctx.rollback_stack, ['a', 'b', 'c'])
+
+    def test_no_steps(self):
+        executor.execute_parallel(self.ctx, mock.Mock(), [])
+        self.assertEqual(self.ctx.rollback_stack, [])
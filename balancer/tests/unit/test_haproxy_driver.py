@@ -3,10 +3,15 @@
 import unittest
 import os
 import shutil
+import tempfile
 import filecmp
+import eventlet
 import mock
 
 from mock import Mock, MagicMock
+from openstack.common import exception
+from balancer.core import executor
+from balancer.tests.unit import run_monkey_patched
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyConfigFile
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyFronted
 from balancer.drivers.haproxy.HaproxyDriver import HaproxyBackend
@@ -17,6 +22,13 @@ from balancer.drivers.haproxy.RemoteControl import RemoteConfig
 from balancer.drivers.haproxy.RemoteControl import RemoteService
 from balancer.drivers.haproxy.RemoteControl import RemoteInterface
 from balancer.drivers.haproxy.RemoteControl import RemoteSocketOperation
+from balancer.drivers.haproxy.RemoteControl import SSHConnectionPool
+from balancer.drivers.haproxy.RemoteControl import HaproxySocketChannel
+from balancer.drivers.haproxy.RemoteControl import PoolExhausted
+from balancer.drivers.haproxy.RemoteControl import RemoteStatistics
+from balancer.drivers.haproxy.RemoteControl import GracefulReload
+from balancer.drivers.haproxy.RemoteControl import MasterWorkerReload
+from balancer.drivers.haproxy.RemoteControl import RestartReload
 
 device_fake = {'ip': '192.168.19.86',
     'port': '22',
@@ -63,11 +75,153 @@ haproxy_rserver1.port = '12345'
 haproxy_rserver1.fall = '11'
 
 
+class TestHaproxyConfigFile(unittest.TestCase):
+    def setUp(self):
+        self.testfiles = os.path.join(os.path.dirname(__file__), 'testfiles')
+        self.path = '/tmp/test_haproxy.cfg'
+        shutil.copyfile(os.path.join(self.testfiles, 'haproxy.cfg'),
+                        self.path)
+        self.config = HaproxyConfigFile(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _reread(self):
+        config = HaproxyConfigFile(self.path)
+        config.load()
+        return config
+
+    def test_save_unchanged(self):
+        self.config.load()
+        self.config.save()
+        self.assertTrue(filecmp.cmp(self.path,
+                os.path.join(self.testfiles, 'haproxy.cfg'), shallow=False))
+
+    def test_save_repeated_sections_and_blank_lines(self):
+        text = ('# managed by hand\n'
+                '\n'
+                'defaults\n'
+                '\tmode http\n'
+                '\n'
+                'frontend web 1.1.1.1:80\n'
+                '\t# comment\n'
+                '\tdefault_backend web\n'
+                '\n'
+                'defaults\n'
+                '\tmode tcp\n'
+                '\n'
+                'backend web\n'
+                '\tbalance roundrobin\n')
+        with open(self.path, 'w') as config_file:
+            config_file.write(text)
+        self.config.load()
+        self.config.save()
+        with open(self.path) as config_file:
+            self.assertEqual(config_file.read(), text)
+        web = HaproxyBackend()
+        web.name = 'web'
+        self.config.add_rserver_to_backend_block(web, haproxy_rserver)
+        self.config.save()
+        config = self._reread()
+        self.assertEqual([section.lines() for section in
+                          config.get_sections('defaults')],
+                         [['\tmode http', ''], ['\tmode tcp', '']])
+        self.assertTrue(config.get_section('backend', 'web').get_server(
+                haproxy_rserver.name))
+        self.assertEqual(config.get_section('frontend', 'web').lines(),
+                         ['\t# comment', '\tdefault_backend web', ''])
+
+    def test_delete_block(self):
+        block = HaproxyListen()
+        block.name = 'appli2-insert'
+        self.config.delete_block(block)
+        self.config.save()
+        self.assertTrue(filecmp.cmp(self.path,
+                os.path.join(self.testfiles,
+                             'haproxy_without_appli2-insert.cfg'),
+                shallow=False))
+
+    def test_edits_are_saved_once(self):
+        self.config.add_backend(backend)
+        self.config.add_rserver_to_backend_block(backend, haproxy_rserver)
+        self.config.add_rserver_to_backend_block(backend, haproxy_rserver1)
+        self.config.del_rserver_from_backend_block(backend, haproxy_rserver)
+        self.config.add_frontend(frontend, backend)
+        self.assertFalse(self._reread().get_section('backend',
+                                                    'test_backend'))
+        self.config.save()
+        section = self._reread().get_section('backend', 'test_backend')
+        self.assertIsNone(section.get_server('new_test_server'))
+        self.assertTrue(section.get_server('new_test_server_2'))
+        self.assertEqual(section.lines()[0], '\tbalance source')
+
+    def test_add_backend_keeps_servers(self):
+        self.config.add_backend(backend)
+        self.config.add_rserver_to_backend_block(backend, haproxy_rserver)
+        self.config.add_lines_to_backend_block(backend, ['option httpchk'])
+        updated = HaproxyBackend()
+        updated.name = backend.name
+        updated.balance = 'leastconn'
+        self.config.add_backend(updated)
+        section = self.config.get_section('backend', 'test_backend')
+        self.assertEqual(section.lines(), [
+            '\tbalance leastconn',
+            section.get_server(haproxy_rserver.name),
+            '\toption httpchk'])
+
+    def test_enable_disable_rserver(self):
+        block = HaproxyListen()
+        block.name = 'appli4-backup'
+        server = HaproxyRserver()
+        server.name = 'inst1'
+        self.config.enable_disable_reserver_in_backend_block(block, server,
+                                                             'disable')
+        section = self.config.get_section('listen', 'appli4-backup')
+        self.assertTrue(section.get_server('inst1').endswith(' disabled'))
+        self.assertEqual(section.lines()[3], section.get_server('inst1'))
+        self.config.enable_disable_reserver_in_backend_block(block, server,
+                                                             'enable')
+        self.assertFalse(section.get_server('inst1').endswith(' disabled'))
+
+    def test_probe_lines(self):
+        self.config.add_backend(backend)
+        self.config.add_lines_to_backend_block(backend, ['option httpchk',
+                                                         'option forwardfor'])
+        self.config.del_lines_from_backend_block(backend, ['option httpchk'])
+        self.config.add_lines_to_backend_block(backend,
+                                               ['option ssl-hello-chk'])
+        lines = self.config.get_section('backend', 'test_backend').lines()
+        self.assertEqual(lines, ['\tbalance source', '\toption forwardfor',
+                                 '\toption ssl-hello-chk'])
+
+    def test_frontends_by_address(self):
+        self.assertEqual(self.config.get_frontends_by_address('0.0.0.0'),
+                         ['appli1-rewrite', 'appli2-insert', 'appli3-relais',
+                          'appli4-backup', 'appli5-backup', 'ssl-relay'])
+        self.config.add_frontend(frontend, backend)
+        self.assertEqual(self.config.get_frontends_by_address('1.1.1.1'),
+                         ['test_frontend'])
+        self.config.delete_block(frontend)
+        self.assertEqual(self.config.get_frontends_by_address('1.1.1.1'), [])
+
+    def test_find_string_in_the_block(self):
+        self.assertTrue(self.config.find_string_in_the_block('listen',
+                                                             'app1inst3'))
+        self.assertFalse(self.config.find_string_in_the_block('frontend',
+                                                              'app1inst3'))
+
+
+def get_fake_pool():
+    pool = MagicMock()
+    pool.connection.return_value.__exit__.return_value = False
+    return pool, pool.connection.return_value.__enter__.return_value
+
+
 class TestHaproxyDriverRemoteConfig (unittest.TestCase):
     def setUp(self):
+        self.pool, self.ssh = get_fake_pool()
         self.remote_config = RemoteConfig(device_fake, '/tmp',
-                        '/etc/haproxy', 'haproxy.conf')
-        self.remote_config.ssh = Mock()
+                        '/etc/haproxy', 'haproxy.conf', pool=self.pool)
 
     def test_get_config(self):
         self.assertTrue(self.remote_config.get_config())
@@ -75,17 +229,64 @@ class TestHaproxyDriverRemoteConfig (unittest.TestCase):
     def test_put_config(self):
         self.assertTrue(self.remote_config.put_config())
 
+    def _set_output(self, output, status=0):
+        stdout = MagicMock()
+        stdout.read.return_value = output
+        stdout.channel.recv_exit_status.return_value = status
+        self.ssh.exec_command.return_value = [None, stdout, None]
+
+    def test_push_config(self):
+        self._set_output('Configuration file is valid\n')
+        self.assertTrue(self.remote_config.push_config())
+        self.assertEqual(self.ssh.exec_command.call_args_list, [
+            mock.call('haproxy -c -f /tmp/haproxy.conf'),
+            mock.call('sudo cp -p /etc/haproxy/haproxy.conf '
+                      '/tmp/haproxy.conf.orig'),
+            mock.call('sudo mv /tmp/haproxy.conf /etc/haproxy'),
+            mock.call('sudo service haproxy restart')])
+
+    def test_push_config_without_reload(self):
+        self._set_output('Configuration file is valid\n')
+        self.assertTrue(self.remote_config.push_config(reload=False))
+        self.assertEqual(self.ssh.exec_command.call_count, 2)
+
+    def test_push_config_invalid(self):
+        self._set_output('[ALERT] parsing error\n', 1)
+        self.assertFalse(self.remote_config.push_config())
+        self.assertEqual(self.ssh.exec_command.call_count, 1)
+
+    def test_push_config_reload_failed(self):
+        self._set_output('Configuration file is valid\n')
+        self.remote_config.reloader = Mock()
+        self.remote_config.reloader.reload.return_value = False
+        self.assertFalse(self.remote_config.push_config())
+        self.assertEqual(self.ssh.exec_command.call_args_list[-1],
+                mock.call('sudo mv /tmp/haproxy.conf.orig '
+                          '/etc/haproxy/haproxy.conf'))
+        self.assertEqual(self.remote_config.reloader.reload.call_args_list,
+                         [mock.call(self.ssh), mock.call(self.ssh)])
+
+    def test_push_config_reload_error(self):
+        self._set_output('Configuration file is valid\n')
+        self.remote_config.reloader = Mock()
+        self.remote_config.reloader.reload.side_effect = [IOError(), True]
+        self.assertRaises(IOError, self.remote_config.push_config)
+        self.assertEqual(self.ssh.exec_command.call_args_list[-1],
+                mock.call('sudo mv /tmp/haproxy.conf.orig '
+                          '/etc/haproxy/haproxy.conf'))
+        self.assertEqual(self.remote_config.reloader.reload.call_count, 2)
+
     def test_validate_config_bad(self):
         file_channel = MagicMock(spec=file)
-        self.remote_config.ssh.exec_command.return_value = [file_channel,
+        self.ssh.exec_command.return_value = [file_channel,
                                               file_channel, file_channel]
         self.assertFalse(self.remote_config.validate_config())
 
 
 class TestHaproxyDriverRemoteService (unittest.TestCase):
     def setUp(self):
-        self.remote_service = RemoteService(device_fake)
-        self.remote_service.ssh = Mock()
+        self.pool, self.ssh = get_fake_pool()
+        self.remote_service = RemoteService(device_fake, pool=self.pool)
 
     def test_start_service(self):
         self.assertTrue(self.remote_service.start())
@@ -99,10 +300,11 @@ class TestHaproxyDriverRemoteService (unittest.TestCase):
 
 class TestHaproxyDriverRemoteInterface (unittest.TestCase):
     def setUp(self):
-        self.remote_interface = RemoteInterface(device_fake, frontend)
-        self.remote_interface.ssh = Mock()
+        self.pool, self.ssh = get_fake_pool()
+        self.remote_interface = RemoteInterface(device_fake, frontend,
+                                                pool=self.pool)
         file_channel = MagicMock(spec=file)
-        self.remote_interface.ssh.exec_command.return_value = [file_channel,
+        self.ssh.exec_command.return_value = [file_channel,
                                                  file_channel, file_channel]
 
     def test_add_ip(self):
@@ -114,22 +316,585 @@ class TestHaproxyDriverRemoteInterface (unittest.TestCase):
 
 class TestHaproxyDriverRemoteSocketOperation (unittest.TestCase):
     def setUp(self):
+        self.pool, self.ssh = get_fake_pool()
         self.remote_socket = RemoteSocketOperation(device_fake,
-                                                backend, rserver)
-        self.remote_socket.ssh = Mock()
+                                                backend, rserver,
+                                                pool=self.pool)
         file_channel = MagicMock(spec=file)
-        self.remote_socket.ssh.exec_command.return_value = [file_channel,
+        self.file_channel = file_channel
+        self.ssh.exec_command.return_value = [file_channel,
                                                 file_channel, file_channel]
 
     def test_suspend_server(self):
+        self.file_channel.read.return_value = ''
         self.assertTrue(self.remote_socket.suspend_server())
 
     def test_activate_server(self):
+        self.file_channel.read.return_value = ''
         self.assertTrue(self.remote_socket.activate_server())
 
+    def test_set_weight(self):
+        self.file_channel.read.return_value = '\n'
+        self.assertTrue(self.remote_socket.set_weight(5))
+        self.ssh.exec_command.assert_called_once_with(
+                'echo "set weight test_backend/test_real_server 5" | '
+                'sudo socat stdio unix-connect:/tmp/haproxy.sock')
+
+    def test_set_weight_failed(self):
+        self.file_channel.read.return_value = 'No such server.\n'
+        self.assertFalse(self.remote_socket.set_weight(5))
+
+    def test_set_addr(self):
+        self.file_channel.read.return_value = ('IP changed from '
+                '\'123.123.123.123\' to \'10.0.0.1\' by \'stats socket '
+                'command\'\n')
+        self.assertTrue(self.remote_socket.set_addr('10.0.0.1', 80))
+
+    def test_add_server(self):
+        self.file_channel.read.side_effect = ['New server registered.\n',
+                                              '']
+        self.assertTrue(self.remote_socket.add_server('10.0.0.1', 80))
+        self.assertEqual(self.ssh.exec_command.call_count, 2)
+
+    def test_add_server_not_supported(self):
+        self.file_channel.read.return_value = 'Unknown command.\n'
+        self.assertFalse(self.remote_socket.add_server('10.0.0.1', 80))
+        self.assertEqual(self.ssh.exec_command.call_count, 1)
+
+    def test_del_server(self):
+        self.file_channel.read.side_effect = ['', 'Server deleted.\n']
+        self.assertTrue(self.remote_socket.del_server())
+
     def test_get_statistics(self):
         self.assertTrue(self.remote_socket.get_statistics())
 
 
+@mock.patch('paramiko.SSHClient')
+class TestSSHConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = SSHConnectionPool(device_fake, max_size=2,
+                                      idle_timeout=300, keepalive=30)
+
+    def test_connection_reused(self, mock_client):
+        with self.pool.connection() as ssh1:
+            pass
+        with self.pool.connection() as ssh2:
+            pass
+        self.assertIs(ssh1, ssh2)
+        self.assertEqual(mock_client.return_value.connect.call_count, 1)
+        ssh1.get_transport.return_value.set_keepalive.assert_called_with(30)
+
+    def test_dead_connection_replaced(self, mock_client):
+        with self.pool.connection() as ssh1:
+            pass
+        ssh1.get_transport.return_value.is_active.return_value = False
+        mock_client.return_value = MagicMock()
+        with self.pool.connection() as ssh2:
+            pass
+        self.assertIsNot(ssh1, ssh2)
+        self.assertTrue(ssh1.close.called)
+
+    def test_idle_connection_evicted(self, mock_client):
+        self.pool.idle_timeout = -1
+        with self.pool.connection() as ssh1:
+            pass
+        mock_client.return_value = MagicMock()
+        with self.pool.connection() as ssh2:
+            pass
+        self.assertIsNot(ssh1, ssh2)
+        self.assertTrue(ssh1.close.called)
+
+    def test_broken_connection_closed(self, mock_client):
+        with self.assertRaises(EOFError):
+            with self.pool.connection() as ssh:
+                raise EOFError()
+        self.assertTrue(ssh.close.called)
+        self.assertEqual(self.pool._free, [])
+
+    def test_pool_is_bounded(self, mock_client):
+        mock_client.side_effect = lambda: MagicMock()
+        ssh1 = self.pool.get()
+        ssh2 = self.pool.get()
+        self.assertFalse(self.pool._slots.acquire(False))
+        self.pool.put(ssh1)
+        self.pool.put(ssh2)
+        self.assertEqual(len(self.pool._free), 2)
+        self.pool.close_all()
+        self.assertTrue(ssh1.close.called)
+        self.assertTrue(ssh2.close.called)
+
+    def test_dedicated_connection_takes_slot(self, mock_client):
+        mock_client.side_effect = lambda: MagicMock()
+        ssh = self.pool.get_dedicated()
+        with self.assertRaises(PoolExhausted):
+            self.pool.get_dedicated()
+        pooled = self.pool.get()
+        self.assertFalse(self.pool._slots.acquire(False))
+        self.pool.put(pooled)
+        self.pool.put_dedicated(ssh)
+        self.assertTrue(ssh.close.called)
+        self.assertTrue(self.pool._slots.acquire(False))
+        self.assertTrue(self.pool._slots.acquire(False))
+
+    def test_no_dedicated_connection_from_single_slot(self, mock_client):
+        pool = SSHConnectionPool(device_fake, max_size=1)
+        with self.assertRaises(PoolExhausted):
+            pool.get_dedicated()
+        self.assertFalse(mock_client.called)
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class FakePromptChannel(object):
+    '''Stats socket session in prompt mode, answers in small pieces'''
+    def __init__(self, responses):
+        self.responses = responses
+        self.commands = []
+        self.closed = False
+        self._out = ''
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+
+    def exit_status_ready(self):
+        return self.closed
+
+    def sendall(self, data):
+        for command in data.splitlines():
+            self.commands.append(command)
+            self._out += '%s\n> ' % self.responses.get(command, '')
+
+    def recv(self, size):
+        data, self._out = self._out[:3], self._out[3:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class TestHaproxySocketChannel(unittest.TestCase):
+    def setUp(self):
+        self.pool = MagicMock()
+        self.fake = FakePromptChannel({
+            'show info': 'Name: HAProxy\nVersion: 2.4.0\n',
+            'set weight b/s 300': 'Backend is using a static LB '
+                                  'algorithm and only accepts weights '
+                                  "'0%' and '100%'.\n"})
+        ssh = self.pool.get_dedicated.return_value
+        ssh.get_transport.return_value.open_session.return_value = self.fake
+        self.pool.idle_timeout = 300
+        self.channel = HaproxySocketChannel(self.pool, '/tmp/haproxy.sock')
+
+    def test_session_opened_once(self):
+        self.assertEqual(self.channel.execute('disable server b/s'), '')
+        self.assertEqual(self.channel.execute('enable server b/s'), '')
+        self.assertEqual(self.pool.get_dedicated.call_count, 1)
+        self.assertEqual(self.fake.command,
+                         'sudo socat stdio unix-connect:/tmp/haproxy.sock')
+        self.assertEqual(self.fake.commands,
+                         ['prompt', 'set timeout cli 3600',
+                          'disable server b/s', 'enable server b/s'])
+
+    def test_pipelined_responses(self):
+        responses = self.channel.execute_many(['show info',
+                                               'set weight b/s 300',
+                                               'set weight b/s 0'])
+        self.assertEqual(responses, ['Name: HAProxy\nVersion: 2.4.0\n',
+                                     "Backend is using a static LB algorithm"
+                                     " and only accepts weights '0%' and "
+                                     "'100%'.\n", ''])
+
+    def test_closed_session_reopened(self):
+        self.channel.execute('show info')
+        self.fake.closed = True
+        self.assertEqual(self.channel.execute('disable server b/s'), '')
+        self.assertEqual(self.pool.get_dedicated.call_count, 2)
+
+    def test_idle_session_reopened(self):
+        self.channel.execute('show info')
+        ssh = self.pool.get_dedicated.return_value
+        self.pool.idle_timeout = -1
+        self.channel.execute('show info')
+        self.pool.put_dedicated.assert_called_once_with(ssh)
+        self.assertEqual(self.pool.get_dedicated.call_count, 2)
+
+    def test_eof_closes_session(self):
+        self.channel.execute('show info')
+        self.fake.recv = lambda size: ''
+        with self.assertRaises(EOFError):
+            self.channel.execute('show info')
+        self.assertIsNone(self.channel._channel)
+        self.assertEqual(self.pool.put_dedicated.call_count, 1)
+
+    def test_socket_operation_uses_channel(self):
+        remote_socket = RemoteSocketOperation(device_fake, backend, rserver,
+                                              pool=self.pool,
+                                              channel=self.channel)
+        self.assertTrue(remote_socket.suspend_server())
+        self.assertFalse(self.pool.connection.called)
+        self.assertEqual(self.fake.commands[-1],
+                         'disable server test_backend/test_real_server')
+
+    def test_socket_operation_falls_back_to_socat(self):
+        pool, ssh = get_fake_pool()
+        file_channel = MagicMock(spec=file)
+        file_channel.read.return_value = ''
+        ssh.exec_command.return_value = [file_channel, file_channel,
+                                         file_channel]
+        channel = Mock()
+        channel.execute.side_effect = EOFError()
+        remote_socket = RemoteSocketOperation(device_fake, backend, rserver,
+                                              pool=pool, channel=channel)
+        self.assertTrue(remote_socket.activate_server())
+        self.assertTrue(ssh.exec_command.called)
+
+
+SHOW_STAT = (
+    '# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,'
+    'ereq,econ,eresp,wretr,wredis,status,weight,act,bck,chkfail,chkdown,'
+    'lastchg,downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,type,rate,'
+    'rate_lim,rate_max,\n'
+    'SFname,FRONTEND,,,3,10,2000,120,5000,9000,0,0,0,,,,,OPEN,,,,,,,,,1,2,'
+    '0,,,,0,1,0,4,\n'
+    'SFname,test_real_server,0,0,2,7,30000,100,4000,8000,,0,,5,0,0,0,UP,8,'
+    '1,0,0,0,3600,0,,1,2,1,,100,,2,1,,3,\n'
+    'SFname,BACKEND,0,0,2,7,200,100,4000,8000,0,0,,5,0,0,0,UP,8,1,0,,0,'
+    '3600,0,,1,2,0,,100,,1,1,,3,\n\n')
+
+
+class TestHaproxyStatistics(unittest.TestCase):
+    def test_parse(self):
+        table = RemoteStatistics.parse(SHOW_STAT)
+        self.assertEqual(sorted(table.keys()),
+                         [('SFname', 'BACKEND'), ('SFname', 'FRONTEND'),
+                          ('SFname', 'test_real_server')])
+        row = table[('SFname', 'test_real_server')]
+        self.assertEqual(row['status'], 'UP')
+        self.assertEqual(row['weight'], 8)
+        self.assertEqual(row['scur'], 2)
+        self.assertEqual(row['econ'], 5)
+        self.assertIsNone(row['rate_lim'])
+
+    def test_parse_garbage(self):
+        self.assertEqual(RemoteStatistics.parse('Unknown command.\n'), {})
+
+    def test_show_stat_uses_channel(self):
+        channel = Mock()
+        channel.execute.return_value = SHOW_STAT
+        remote_stats = RemoteStatistics(device_fake, pool=Mock(),
+                                        channel=channel)
+        self.assertEqual(len(remote_stats.get_all()), 3)
+        channel.execute.assert_called_once_with('show stat')
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteStatistics')
+    def test_driver_statistics_cached(self, mock_stats):
+        mock_stats.return_value.get_all.return_value = \
+                RemoteStatistics.parse(SHOW_STAT)
+        driver = HaproxyDriver(get_fake_conf(), device_fake)
+        statistics = driver.get_statistics(server_farm, rserver)
+        self.assertEqual(statistics, {'weight': 8, 'state': 'UP',
+                                      'connCurrent': 2, 'connTotal': 100,
+                                      'connFail': 5, 'connMax': 7,
+                                      'connRateLimit': None,
+                                      'bandwRateLimit': 3})
+        self.assertEqual(driver.get_statistics(server_farm,
+                                               {'name': 'unknown'}), {})
+        self.assertEqual(mock_stats.return_value.get_all.call_count, 1)
+        driver._stats_time -= 5
+        driver.get_statistics_all()
+        self.assertEqual(mock_stats.return_value.get_all.call_count, 2)
+
+
+def edit_in_parallel_steps():
+    conf = get_fake_conf()
+    conf.device_parallel_operations = 4
+    with mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig') \
+            as mock_remote:
+        with mock.patch('balancer.drivers.haproxy.HaproxyDriver.'
+                        'HaproxyConfigFile'):
+            driver = HaproxyDriver(conf, device_fake)
+
+            def step(ctx, name):
+                driver.delete_server_farm({'name': name})
+
+            with eventlet.Timeout(5):
+                with driver.request_context() as ctx:
+                    executor.execute_parallel(ctx, step,
+                                              [('sf1',), ('sf2',)])
+    assert mock_remote.return_value.push_config.call_count == 1
+
+
+def get_fake_conf():
+    conf = Mock()
+    conf.haproxy_ssh_pool_size = 4
+    conf.haproxy_ssh_idle_timeout = 300
+    conf.haproxy_ssh_keepalive = 30
+    conf.haproxy_reload_method = 'auto'
+    conf.haproxy_async_persist = True
+    conf.haproxy_socket_timeout = 10
+    conf.haproxy_stats_ttl = 5
+    return conf
+
+
+class TestHaproxyReload(unittest.TestCase):
+    def setUp(self):
+        self.ssh = MagicMock()
+        self.stdout = MagicMock()
+        self.stdout.read.return_value = ''
+        self.stdout.channel.recv_exit_status.return_value = 0
+        self.ssh.exec_command.return_value = [None, self.stdout, None]
+
+    def _get_reloader(self, **extra):
+        device = dict(device_fake)
+        device['extra'] = dict(device_fake['extra'], **extra)
+        return HaproxyDriver(get_fake_conf(), device).reloader
+
+    def test_default_is_graceful(self):
+        reloader = self._get_reloader()
+        self.assertIsInstance(reloader, GracefulReload)
+        self.assertTrue(reloader.reload(self.ssh))
+        self.ssh.exec_command.assert_called_once_with(
+                'sudo haproxy -f /etc/haproxy/haproxy.cfg '
+                '-p /var/run/haproxy.pid -D -x /tmp/haproxy.sock '
+                '-sf $(cat /var/run/haproxy.pid)')
+
+    def test_graceful_without_socket(self):
+        reloader = self._get_reloader(reload_method='graceful', socket=None)
+        self.assertTrue(reloader.reload(self.ssh))
+        self.ssh.exec_command.assert_called_once_with(
+                'sudo haproxy -f /etc/haproxy/haproxy.cfg '
+                '-p /var/run/haproxy.pid -D '
+                '-sf $(cat /var/run/haproxy.pid)')
+
+    def test_graceful_without_socket_transfer(self):
+        reloader = self._get_reloader(expose_fd=False)
+        self.assertIsInstance(reloader, GracefulReload)
+        self.assertIsNone(reloader.fd_socket)
+
+    def test_graceful_with_socket_transfer(self):
+        reloader = self._get_reloader(reload_method='graceful', socket=None,
+                                      expose_fd=True, pidfile='/run/h.pid')
+        reloader.reload(self.ssh)
+        self.ssh.exec_command.assert_called_once_with(
+                'sudo haproxy -f /etc/haproxy/haproxy.cfg -p /run/h.pid -D '
+                '-x /tmp/haproxy.sock -sf $(cat /run/h.pid)')
+
+    def test_master_worker(self):
+        reloader = self._get_reloader(master_socket='/run/master.sock')
+        self.assertIsInstance(reloader, MasterWorkerReload)
+        self.assertTrue(reloader.reload(self.ssh))
+        self.ssh.exec_command.assert_called_once_with(
+                'echo reload | sudo socat stdio '
+                'unix-connect:/run/master.sock')
+
+    def test_master_worker_failed(self):
+        reloader = MasterWorkerReload('/run/master.sock')
+        self.stdout.read.return_value = 'Success=0\n'
+        self.assertFalse(reloader.reload(self.ssh))
+
+    def test_master_worker_without_socket(self):
+        reloader = self._get_reloader(reload_method='master-worker')
+        self.assertIsInstance(reloader, GracefulReload)
+
+    def test_unknown_method(self):
+        reloader = self._get_reloader(reload_method='fake')
+        self.assertIsInstance(reloader, GracefulReload)
+
+    def test_restart(self):
+        reloader = self._get_reloader(reload_method='restart')
+        self.assertIsInstance(reloader, RestartReload)
+
+
+@mock.patch('balancer.drivers.haproxy.HaproxyDriver.HaproxyConfigFile')
+@mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteConfig')
+class TestHaproxyDriverTransaction(unittest.TestCase):
+    def setUp(self):
+        self.driver = HaproxyDriver(get_fake_conf(), device_fake)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteStatistics')
+    def test_get_device_state(self, mock_stats, mock_remote, mock_config):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as config_file:
+            config_file.write('frontend VirtualServer 115.115.115.115:8080\n'
+                              '\tdefault_backend SFname\n'
+                              'backend SFname\n'
+                              '\tbalance roundrobin\n'
+                              '\tserver rs1 1.1.1.1:80 check\n'
+                              '\tserver rs2 1.1.1.2:80 check disabled\n'
+                              '\tserver rs3 1.1.1.3:80 check\n')
+        mock_config.return_value = HaproxyConfigFile(path)
+        mock_stats.return_value.get_all.return_value = {
+                ('SFname', 'rs3'): {'status': 'MAINT'}}
+        state = self.driver.get_device_state()
+        self.assertEqual(state, {
+            'serverfarm': {'SFname': {}},
+            'rserver': {('SFname', 'rs1'): {'state': 'inservice'},
+                        ('SFname', 'rs2'): {'state': 'outofservice'},
+                        ('SFname', 'rs3'): {'state': 'outofservice'}},
+            'vip': {'VirtualServer': {}},
+        })
+        self.assertFalse(mock_remote.return_value.push_config.called)
+
+    def test_request_pushes_once(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        with self.driver.request_context():
+            self.driver.create_server_farm(server_farm,
+                                           {'type': 'RoundRobin'})
+            self.driver.add_real_server_to_server_farm(server_farm, rserver)
+            self.driver.add_probe_to_server_farm(server_farm, probe)
+            self.assertFalse(remote.push_config.called)
+        self.assertEqual(remote.get_config.call_count, 1)
+        remote.push_config.assert_called_once_with(reload=True)
+        self.assertFalse(remote.put_config.called)
+        self.assertIsNone(self.driver._transaction)
+
+    def test_nested_request_pushes_once(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        with self.driver.request_context():
+            with self.driver.request_context():
+                self.driver.add_real_server_to_server_farm(server_farm,
+                                                           rserver)
+            self.assertFalse(remote.push_config.called)
+        self.assertEqual(remote.push_config.call_count, 1)
+
+    def test_request_without_changes(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        with self.driver.request_context():
+            pass
+        self.assertFalse(remote.get_config.called)
+        self.assertFalse(remote.push_config.called)
+
+    def test_rejected_config_rolls_back(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        remote.push_config.return_value = False
+        rollback = Mock()
+        with self.assertRaises(exception.Error):
+            with self.driver.request_context() as ctx:
+                ctx.add_rollback(rollback)
+                self.driver.delete_server_farm(server_farm)
+        rollback.assert_called_once_with(False)
+        self.assertIsNone(self.driver._transaction)
+
+    def test_failed_request_not_pushed(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        with self.assertRaises(ValueError):
+            with self.driver.request_context():
+                self.driver.delete_server_farm(server_farm)
+                raise ValueError()
+        self.assertFalse(remote.push_config.called)
+
+    def test_change_outside_request(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        self.driver.delete_server_farm(server_farm)
+        self.driver.delete_server_farm(server_farm)
+        self.assertEqual(remote.get_config.call_count, 2)
+        self.assertEqual(remote.push_config.call_count, 2)
+
+    def test_change_outside_request_waits(self, mock_remote, mock_config):
+        remote = mock_remote.return_value
+        thread = eventlet.spawn(self.driver.delete_server_farm, server_farm)
+        with self.driver.request_context():
+            self.driver.delete_server_farm(server_farm)
+            eventlet.sleep(0.01)
+            self.assertFalse(thread.dead)
+        thread.wait()
+        self.assertEqual(remote.get_config.call_count, 2)
+        self.assertEqual(remote.push_config.call_count, 2)
+
+    def test_parallel_steps_join_request(self, mock_remote, mock_config):
+        status, output = run_monkey_patched(edit_in_parallel_steps)
+        self.assertEqual(status, 0, output)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_runtime_change_not_reloaded(self, mock_socket, mock_remote,
+                                         mock_config):
+        remote = mock_remote.return_value
+        mock_socket.return_value.suspend_server.return_value = True
+        with self.driver.request_context():
+            self.driver.suspend_real_server(server_farm, rserver)
+        self.assertFalse(remote.push_config.called)
+        self.driver._persist_thread.wait()
+        remote.push_config.assert_called_once_with(reload=False)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_failed_persist_retried(self, mock_socket, mock_remote,
+                                    mock_config):
+        remote = mock_remote.return_value
+        remote.push_config.return_value = False
+        with self.driver.request_context():
+            self.driver.suspend_real_server(server_farm, rserver)
+        transaction = self.driver._persist_thread.wait()
+        self.assertTrue(transaction.dirty)
+        remote.push_config.return_value = True
+        with self.driver.request_context():
+            self.assertIs(self.driver._transaction, transaction)
+            self.driver.delete_server_farm(server_farm)
+        self.assertEqual(remote.get_config.call_count, 1)
+        self.assertEqual(remote.push_config.call_args_list,
+                         [mock.call(reload=False), mock.call(reload=True)])
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_update_rserver_runtime(self, mock_socket, mock_remote,
+                                    mock_config):
+        remote = mock_remote.return_value
+        remote_socket = mock_socket.return_value
+        new_rserver = dict(rserver, weight='3', port='9191')
+        self.driver.conf.haproxy_async_persist = False
+        with self.driver.request_context():
+            self.driver.update_real_server_in_server_farm(server_farm,
+                                                          rserver,
+                                                          new_rserver)
+        remote_socket.set_addr.assert_called_once_with('123.123.123.123',
+                                                       '9191')
+        remote_socket.set_weight.assert_called_once_with('3')
+        self.assertFalse(remote_socket.set_maxconn.called)
+        remote.push_config.assert_called_once_with(reload=False)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_update_rserver_runtime_failed(self, mock_socket, mock_remote,
+                                           mock_config):
+        remote = mock_remote.return_value
+        remote_socket = mock_socket.return_value
+        remote_socket.set_addr.return_value = False
+        new_rserver = dict(rserver, weight='3', address='10.0.0.1')
+        with self.driver.request_context():
+            self.driver.update_real_server_in_server_farm(server_farm,
+                                                          rserver,
+                                                          new_rserver)
+        self.assertFalse(remote_socket.set_weight.called)
+        remote.push_config.assert_called_once_with(reload=True)
+
+    def test_update_renamed_rserver(self, mock_remote, mock_config):
+        new_rserver = dict(rserver, name='renamed')
+        config_file = mock_config.return_value
+        with self.driver.request_context():
+            self.driver.update_real_server_in_server_farm(server_farm,
+                                                          rserver,
+                                                          new_rserver)
+        self.assertTrue(config_file.del_rserver_from_backend_block.called)
+        self.assertTrue(config_file.add_rserver_to_backend_block.called)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_failed_runtime_change_reloaded(self, mock_socket, mock_remote,
+                                            mock_config):
+        remote = mock_remote.return_value
+        mock_socket.return_value.activate_server.return_value = False
+        with self.driver.request_context():
+            self.driver.activate_real_server(server_farm, rserver)
+        remote.push_config.assert_called_once_with(reload=True)
+
+    @mock.patch('balancer.drivers.haproxy.HaproxyDriver.RemoteSocketOperation')
+    def test_mixed_changes_reloaded(self, mock_socket, mock_remote,
+                                    mock_config):
+        remote = mock_remote.return_value
+        mock_socket.return_value.suspend_server.return_value = True
+        with self.driver.request_context():
+            self.driver.suspend_real_server(server_farm, rserver)
+            self.driver.add_real_server_to_server_farm(server_farm, rserver)
+        remote.push_config.assert_called_once_with(reload=True)
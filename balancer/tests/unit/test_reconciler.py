@@ -0,0 +1,253 @@
+import mock
+import unittest
+
+from balancer.common import cfg
+from balancer.core import reconciler
+
+
+def get_fake_balancer(lb_id='lb1'):
+    balancer = mock.Mock()
+    balancer.lb = {'id': lb_id}
+    balancer.sf = {'id': 'sf1', 'name': 'sf1', 'deployed': 'True'}
+    balancer.rs = [
+        {'id': 'rs1', 'name': 'rs1', 'parent_id': '', 'state': 'inservice'},
+        {'id': 'rs2', 'name': 'rs2', 'parent_id': 'rs1',
+         'state': 'outofservice'},
+        {'id': 'rs3', 'name': 'rs3', 'parent_id': None,
+         'state': 'inservice'},
+    ]
+    balancer.probes = [{'id': 'pr1', 'name': 'pr1', 'deployed': 'True'},
+                       {'id': 'pr2', 'name': 'pr2', 'deployed': 'False'}]
+    balancer.vips = [{'id': 'vip1', 'name': 'vip1', 'deployed': 'True'}]
+    return balancer
+
+
+def get_fake_state():
+    return {
+        'serverfarm': {'sf1': {}},
+        'rserver': {('sf1', 'rs1'): {'state': 'inservice'},
+                    ('sf1', 'rs3'): {'state': 'inservice'}},
+        'probe': {'pr1': {}},
+        'vip': {'vip1': {}},
+    }
+
+
+class TestComputePlan(unittest.TestCase):
+    def setUp(self):
+        self.balancer = get_fake_balancer()
+        self.state = get_fake_state()
+
+    def get_drift(self):
+        plan = reconciler.compute_plan([self.balancer], self.state)
+        return [(entry['kind'], entry['name'], entry['problem'],
+                 entry['action']) for entry, balancer, ref in plan]
+
+    def test_no_drift(self):
+        self.state['rserver'][('sf1', 'rs1')] = {'state': 'outofservice'}
+        self.balancer.rs[1]['parent_id'] = ''
+        self.state['rserver'][('sf1', 'rs2')] = {'state': 'outofservice'}
+        self.balancer.rs[0]['state'] = 'outofservice'
+        self.assertEqual(self.get_drift(), [])
+
+    def test_missing(self):
+        self.balancer.rs[1]['parent_id'] = ''
+        del self.state['probe']['pr1']
+        del self.state['vip']['vip1']
+        self.assertEqual(self.get_drift(), [
+            ('probe', 'pr1', 'missing', 'create_probe'),
+            ('rserver', 'rs2', 'missing', 'add_node'),
+            ('vip', 'vip1', 'missing', 'create_vip'),
+        ])
+
+    def test_missing_serverfarm(self):
+        self.state = {'serverfarm': {}, 'rserver': {}}
+        self.assertEqual(self.get_drift(), [
+            ('serverfarm', 'sf1', 'missing', 'create_server_farm'),
+            ('rserver', 'rs1', 'missing', 'add_node'),
+            ('rserver', 'rs3', 'missing', 'add_node'),
+        ])
+
+    def test_not_deployed(self):
+        self.balancer.sf['deployed'] = 'False'
+        self.balancer.vips[0]['deployed'] = 'False'
+        self.state = {'serverfarm': {}, 'rserver': {}, 'vip': {}}
+        self.assertEqual(self.get_drift(), [])
+
+    def test_state(self):
+        self.state['rserver'][('sf1', 'rs3')] = {'state': 'outofservice'}
+        self.state['rserver'][('sf1', 'rs1')] = {'state': 'outofservice'}
+        self.balancer.rs[0]['state'] = 'outofservice'
+        self.balancer.rs[2]['state'] = 'INSERVICE'
+        plan = reconciler.compute_plan([self.balancer], self.state)
+        self.assertEqual(len(plan), 1)
+        entry, balancer, ref = plan[0]
+        self.assertEqual(entry, {
+            'lb_id': 'lb1', 'kind': 'rserver', 'id': 'rs3', 'name': 'rs3',
+            'problem': 'state', 'action': 'activate_rserver',
+            'expected': 'INSERVICE', 'actual': 'outofservice'})
+        self.assertIs(ref, self.balancer.rs[2])
+
+    def test_unexpected(self):
+        self.state['rserver'][('sf1', 'rs2')] = {'state': 'inservice'}
+        self.state['serverfarm']['sf2'] = {}
+        self.state['rserver'][('sf2', 'rs4')] = {'state': 'inservice'}
+        self.state['vip']['vip2'] = {}
+        self.balancer.rs[1]['parent_id'] = ''
+        self.balancer.rs[1]['name'] = 'rs5'
+        self.assertEqual(self.get_drift(), [
+            ('rserver', 'rs5', 'missing', 'add_node'),
+            ('rserver', 'rs2', 'unexpected', None),
+            ('serverfarm', 'sf2', 'unexpected', None),
+            ('vip', 'vip2', 'unexpected', None),
+        ])
+
+
+@mock.patch('balancer.core.reconciler.commands')
+class TestApplyPlan(unittest.TestCase):
+    def setUp(self):
+        self.driver = mock.MagicMock()
+        self.ctx = self.driver.request_context.return_value.__enter__.\
+                return_value
+        self.balancer1 = get_fake_balancer('lb1')
+        self.balancer2 = get_fake_balancer('lb2')
+        self.state = {'serverfarm': {}, 'rserver': {}, 'vip': {}}
+        self.driver.get_device_state.return_value = self.state
+        self.balancers = {'lb1': self.balancer1, 'lb2': self.balancer2}
+        patcher = mock.patch('balancer.core.reconciler._load_balancer',
+                side_effect=lambda conf, device_id, lb_id:
+                        self.balancers.get(lb_id))
+        self.mock_load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_apply(self, mock_commands):
+        self.state['serverfarm']['sf1'] = {}
+        self.state['rserver'][('sf1', 'rs1')] = {'state': 'outofservice'}
+        plan = reconciler.compute_plan([self.balancer1], self.state)
+        reconciler.apply_plan(self.driver, plan)
+        rs1, rs2, rs3 = self.balancer1.rs
+        mock_commands.activate_rserver.assert_called_once_with(
+                self.ctx, self.balancer1.sf, rs1)
+        # NOTE: rs2 is deployed under the name of its parent rs1
+        mock_commands.add_node_to_loadbalancer.assert_called_once_with(
+                self.ctx, self.balancer1, rs3)
+        mock_commands.create_vip.assert_called_once_with(
+                self.ctx, self.balancer1.vips[0], self.balancer1.sf)
+        self.assertEqual(self.driver.request_context.call_count, 1)
+        self.assertTrue(all(entry['fixed'] for entry, b, ref in plan))
+
+    def test_apply_error(self, mock_commands):
+        mock_commands.create_server_farm.side_effect = [Exception('foo'),
+                                                        None]
+        plan = reconciler.compute_plan([self.balancer1, self.balancer2],
+                                       self.state)
+        reconciler.apply_plan(self.driver, plan)
+        self.assertEqual(self.driver.request_context.call_count, 2)
+        entries = [entry for entry, b, ref in plan]
+        for entry in entries:
+            if entry['lb_id'] == 'lb1':
+                self.assertEqual(entry['error'], 'foo')
+                self.assertNotIn('fixed', entry)
+            else:
+                self.assertTrue(entry['fixed'])
+
+    def test_stale_entries_not_applied(self, mock_commands):
+        plan = reconciler.compute_plan([self.balancer1, self.balancer2],
+                                       self.state)
+        # NOTE: lb1 was deleted and the vip of lb2 created meanwhile
+        del self.balancers['lb1']
+        self.state['vip']['vip1'] = {}
+        reconciler.apply_plan(self.driver, plan)
+        self.mock_load.assert_any_call(self.driver.conf,
+                                       self.driver.device_ref['id'], 'lb1')
+        self.assertEqual(mock_commands.create_server_farm.call_count, 1)
+        self.assertFalse(mock_commands.create_vip.called)
+        for entry, balancer, ref in plan:
+            if entry['lb_id'] == 'lb1' or entry['kind'] == 'vip':
+                self.assertTrue(entry['stale'])
+                self.assertNotIn('fixed', entry)
+            else:
+                self.assertTrue(entry['fixed'])
+                self.assertNotIn('stale', entry)
+
+    def test_unexpected_not_applied(self, mock_commands):
+        self.state['vip']['vip2'] = {}
+        self.balancer1.sf['deployed'] = 'False'
+        self.balancer1.vips = []
+        plan = reconciler.compute_plan([self.balancer1], self.state)
+        reconciler.apply_plan(self.driver, plan)
+        self.assertEqual(len(plan), 1)
+        self.assertFalse(self.driver.request_context.called)
+
+
+@mock.patch('balancer.drivers.get_device_driver')
+@mock.patch('balancer.core.reconciler._load_balancers')
+@mock.patch('balancer.db.api.device_get')
+class TestReconcileDevice(unittest.TestCase):
+    def setUp(self):
+        self.conf = mock.Mock()
+        self.conf.reconciler.concurrency = 2
+        reconciler.REPORTS.clear()
+        self.addCleanup(reconciler.REPORTS.clear)
+
+    def test_report(self, mock_device_get, mock_load, mock_get_driver):
+        mock_load.return_value = [get_fake_balancer()]
+        driver = mock_get_driver.return_value
+        driver.get_device_state.return_value = {'vip': {}}
+        report = reconciler.reconcile_device(self.conf, 'dev1')
+        self.assertIsNone(report['error'])
+        self.assertEqual([entry['name'] for entry in report['drift']],
+                         ['vip1'])
+        self.assertNotIn('fixed', report['drift'][0])
+        self.assertIs(reconciler.get_report(self.conf, 'dev1'), report)
+        self.assertEqual(mock_load.call_count, 1)
+        driver.request_context.assert_called_once_with()
+
+    @mock.patch('balancer.core.reconciler.apply_plan')
+    def test_fix(self, mock_apply, mock_device_get, mock_load,
+                 mock_get_driver):
+        mock_load.return_value = []
+        mock_get_driver.return_value.get_device_state.return_value = {}
+        reconciler.reconcile_device(self.conf, 'dev1', fix=True)
+        mock_apply.assert_called_once_with(mock_get_driver.return_value, [])
+
+    def test_not_supported(self, mock_device_get, mock_load,
+                           mock_get_driver):
+        mock_get_driver.return_value.get_device_state.side_effect = \
+                NotImplementedError
+        report = reconciler.get_report(self.conf, 'dev1')
+        self.assertEqual(report['drift'], [])
+        self.assertIn('not supported', report['error'])
+
+    def test_error(self, mock_device_get, mock_load, mock_get_driver):
+        mock_load.side_effect = ValueError('foo')
+        report = reconciler.reconcile_device(self.conf, 'dev1')
+        self.assertEqual(report['error'], 'foo')
+
+    @mock.patch('balancer.db.api.device_get_all')
+    def test_reconcile_all(self, mock_get_all, mock_device_get, mock_load,
+                           mock_get_driver):
+        mock_get_all.return_value = [{'id': 'dev1'}, {'id': 'dev2'}]
+        mock_load.return_value = []
+        mock_get_driver.return_value.get_device_state.return_value = {}
+        reports = reconciler.reconcile_all(self.conf)
+        self.assertEqual([report['device_id'] for report in reports],
+                         ['dev1', 'dev2'])
+        self.assertEqual(sorted(reconciler.REPORTS), ['dev1', 'dev2'])
+
+
+class TestStart(unittest.TestCase):
+    @mock.patch('eventlet.spawn')
+    def test_start(self, mock_spawn):
+        conf = mock.Mock()
+        conf.reconciler.interval = 600
+        self.assertIs(reconciler.start(conf), mock_spawn.return_value)
+        conf.reconciler.interval = 0
+        self.assertIsNone(reconciler.start(conf))
+        self.assertEqual(mock_spawn.call_count, 1)
+
+    @mock.patch('eventlet.spawn')
+    def test_disabled_by_default(self, mock_spawn):
+        conf = cfg.ConfigOpts()
+        conf([])
+        self.assertIsNone(reconciler.start(conf))
+        self.assertFalse(mock_spawn.called)
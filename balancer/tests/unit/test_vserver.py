@@ -0,0 +1,126 @@
+import unittest
+
+import mock
+
+from balancer.db import api as db_api
+from balancer.db import models
+from balancer.loadbalancers import vserver
+
+
+lb_params = {'name': 'lb1',
+             'algorithm': 'ROUNDROBIN',
+             'protocol': 'HTTP',
+             'device_id': 'device1',
+             'nodes': [{'address': '10.0.0.1', 'port': '80'},
+                       {'address': '10.0.0.2', 'port': '80'}],
+             'healthMonitor': [{'type': 'ICMP'}],
+             'virtualIps': [{'address': '10.0.0.10', 'port': '80'}]}
+
+
+class TestBalancerSave(unittest.TestCase):
+    def setUp(self):
+        self.conf = mock.Mock()
+        self.balancer = vserver.Balancer(self.conf)
+        with mock.patch(
+                "balancer.db.api.server_get_all_by_address_on_device",
+                return_value={'10.0.0.2': {'id': 'parent',
+                                           'address': '10.0.0.2'}}) as m:
+            self.balancer.parseParams(lb_params)
+            self.mock_parents = m
+
+    def test_parse_params_parents(self):
+        self.mock_parents.assert_called_once_with(self.conf,
+                ['10.0.0.1', '10.0.0.2'], 'device1')
+        self.assertEqual([rs['parent_id'] for rs in self.balancer.rs],
+                         [None, 'parent'])
+
+    @mock.patch("balancer.db.api.save_all")
+    def _save(self, mock_save):
+        self.balancer.savetoDB()
+        self.assertEqual(mock_save.call_count, 1)
+        return mock_save.call_args[0][1:]
+
+    def test_savetodb_new(self):
+        new_refs, updates = self._save()
+        self.assertEqual(len(new_refs), 7)
+        self.assertEqual(updates, [])
+        sf = self.balancer.sf
+        self.assertEqual(sf['lb_id'], self.balancer.lb['id'])
+        self.assertEqual(sf._predictor['sf_id'], sf['id'])
+        for ref in self.balancer.rs + self.balancer.probes:
+            self.assertEqual(ref['sf_id'], sf['id'])
+        self.assertEqual(self.balancer.vips[0]['lb_id'],
+                         self.balancer.lb['id'])
+
+    def test_savetodb_unchanged(self):
+        self._save()
+        self.assertEqual(self._save(), ([], []))
+
+    def test_savetodb_changed(self):
+        self._save()
+        self.balancer.rs[0]['weight'] = 5
+        probe = db_api.probe_pack_extra({'type': 'HTTP'})
+        self.balancer.probes.append(probe)
+        new_refs, updates = self._save()
+        self.assertEqual(new_refs, [probe])
+        self.assertEqual(probe['sf_id'], self.balancer.sf['id'])
+        self.assertEqual(updates, [(models.Server, self.balancer.rs[0]['id'],
+                                    {'weight': 5})])
+
+    @mock.patch("balancer.db.api.save_all")
+    def test_update(self, mock_save):
+        self._save()
+        self.balancer.lb['status'] = 'ERROR'
+        self.balancer.update()
+        new_refs, updates = mock_save.call_args[0][1:]
+        self.assertEqual(new_refs, [])
+        self.assertEqual(len(updates), 1)
+        model, lb_id, values = updates[0]
+        self.assertEqual((model, lb_id), (models.LoadBalancer,
+                                          self.balancer.lb['id']))
+        self.assertEqual(values['status'], 'ERROR')
+        self.assertIn('updated_at', values)
+
+    @mock.patch("balancer.db.api.server_get_all_by_address_on_device")
+    def test_update_params(self, mock_parents):
+        mock_parents.return_value = {'10.0.0.3': {'id': 'parent',
+                                                  'address': '10.0.0.3'}}
+        self._save()
+        rs1, rs2 = self.balancer.rs
+        self.balancer.updateParams({
+            'algorithm': 'LeastConnections', 'protocol': 'HTTPS',
+            'device_id': 'device2', 'foo': 'bar',
+            'nodes': [{'id': rs1['id'], 'weight': 5, 'foo': 'bar'},
+                      {'id': 'unknown', 'address': '10.0.0.3'}],
+            'healthMonitor': []})
+        lb = self.balancer.lb
+        self.assertEqual((lb['algorithm'], lb['device_id']),
+                         ('LeastConnections', 'device1'))
+        self.assertEqual(self.balancer.sf._predictor['type'],
+                         'LeastConnections')
+        self.assertEqual(self.balancer.vips[0]['appProto'], 'HTTPS')
+        self.assertIs(self.balancer.rs[0], rs1)
+        self.assertEqual((rs1['weight'], rs1['extra']['foo']), (5, 'bar'))
+        new_rs = self.balancer.rs[1]
+        self.assertEqual((new_rs['id'], new_rs['address'],
+                          new_rs['parent_id']), (None, '10.0.0.3', 'parent'))
+        mock_parents.assert_called_once_with(self.conf, ['10.0.0.3'],
+                                             'device1')
+        self.assertEqual(self.balancer.probes, [])
+
+    @mock.patch("balancer.db.api.save_all")
+    def test_savetodb_removed(self, mock_save):
+        self._save()
+        rs1, rs2 = self.balancer.rs
+        self.balancer.rs = [rs1]
+        lb_ids = [self.balancer.lb['id']]
+        self.balancer.savetoDB(delete_removed=False)
+        self.assertEqual(mock_save.call_args[1],
+                         {'deletes': [], 'lb_ids': lb_ids})
+        self.balancer.savetoDB()
+        self.assertEqual(mock_save.call_args[1],
+                         {'deletes': [(models.Server, rs2['id'])],
+                          'lb_ids': lb_ids})
+        self.balancer.savetoDB()
+        self.assertEqual(mock_save.call_args[1],
+                         {'deletes': [], 'lb_ids': lb_ids})
@@ -331,8 +331,8 @@ class Resource(object):
         return self.dispatch(self.deserializer, action, request)
 
     def serialize_response(self, action, action_result, request):
-        msg = "Called serialize response Action:%s Result:%s  Request:%s" % (action,  action_result,  request)
-        logger.debug(msg)
+        logger.debug("Called serialize response Action:%s Result:%s  "
+                     "Request:%s", action, action_result, request)
 
         try:
             if not self.controller:
@@ -353,8 +353,8 @@ class Resource(object):
         #self.dispatch(self.serializer, action, response,
          #             action_result, request)
         self.serializer.default(response,  action_result)
-        msg = "Response: %s" % response
-        logger.debug(msg)
+        # NOTE: formatting the whole response would read a streamed body
+        logger.debug("Response status: %s", response.status)
         return response
 
     def execute_action(self, action, request, **action_args):
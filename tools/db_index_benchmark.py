@@ -0,0 +1,138 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Show query plans and timings of hot balancer queries on a SQLite database
+before and after the index migration.
+
+Usage: db_index_benchmark.py [SERVERS [SERVERS_PER_FARM]]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from migrate.versioning import api as versioning_api
+from sqlalchemy import create_engine
+
+from balancer.db import migrate_repo
+
+
+QUERIES = (
+    ('server_get_by_address_on_device',
+     "SELECT * FROM server WHERE address = :address AND deployed = 'True'"),
+    ('server_get_all_by_sf_id',
+     "SELECT * FROM server WHERE sf_id = :sf_id"),
+    ('server_get_all_by_parent_id',
+     "SELECT * FROM server WHERE parent_id = :parent_id"),
+    ('loadbalancer_get_all_by_project',
+     "SELECT * FROM loadbalancer WHERE tenant_id = :tenant_id"),
+    ('loadbalancer_get_all_by_vm_id',
+     "SELECT DISTINCT loadbalancer.* FROM loadbalancer, serverfarm, server "
+     "WHERE loadbalancer.tenant_id = :tenant_id "
+     "AND loadbalancer.id = serverfarm.lb_id "
+     "AND server.sf_id = serverfarm.id AND server.vm_id = :vm_id"),
+    ('serverfarm_get_all_by_lb_id',
+     "SELECT * FROM serverfarm WHERE lb_id = :lb_id"),
+    ('probe_get_all_by_sf_id',
+     "SELECT * FROM probe WHERE sf_id = :sf_id"),
+    ('virtualserver_get_all_by_sf_id',
+     "SELECT * FROM virtualserver WHERE sf_id = :sf_id"),
+)
+
+NOW = '2012-01-01 00:00:00'
+
+
+def populate(engine, servers, servers_per_farm):
+    farms = max(servers // servers_per_farm, 1)
+    engine.execute(
+        "INSERT INTO loadbalancer (id, device_id, tenant_id, created_at, "
+        "updated_at) VALUES (?, ?, ?, ?, ?)",
+        [('lb%d' % i, 'dev%d' % (i % 10), 'tenant%d' % (i % 100), NOW, NOW)
+         for i in xrange(farms)])
+    engine.execute(
+        "INSERT INTO serverfarm (id, lb_id) VALUES (?, ?)",
+        [('sf%d' % i, 'lb%d' % i) for i in xrange(farms)])
+    for table in ('probe', 'virtualserver', 'predictor', 'sticky'):
+        engine.execute(
+            "INSERT INTO %s (id, sf_id) VALUES (?, ?)" % (table,),
+            [('%s%d' % (table, i), 'sf%d' % i) for i in xrange(farms)])
+    engine.execute(
+        "INSERT INTO server (id, sf_id, address, parent_id, deployed, vm_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [('rs%d' % i, 'sf%d' % (i % farms),
+          '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+          i % 1000, 'True', i) for i in xrange(servers)])
+
+
+def get_params(servers, servers_per_farm):
+    last = servers - 1
+    farm = 'sf%d' % (last % max(servers // servers_per_farm, 1))
+    return {'address': '10.%d.%d.%d' % (last >> 16 & 255, last >> 8 & 255,
+                                        last & 255),
+            'sf_id': farm,
+            'lb_id': 'lb' + farm[2:],
+            'parent_id': 999,
+            'tenant_id': 'tenant99',
+            'vm_id': last}
+
+
+def report(engine, params, repeat=20):
+    for name, query in QUERIES:
+        plan = engine.execute("EXPLAIN QUERY PLAN " + query,
+                              **params).fetchall()
+        start = time.time()
+        for i in xrange(repeat):
+            engine.execute(query, **params).fetchall()
+        elapsed = (time.time() - start) / repeat * 1000
+        print "%-35s %9.3f ms" % (name, elapsed)
+        for row in plan:
+            print "    %s" % (list(row)[-1],)
+
+
+def main(argv):
+    servers = int(argv[1]) if len(argv) > 1 else 100000
+    servers_per_farm = int(argv[2]) if len(argv) > 2 else 10
+    repo_path = os.path.dirname(migrate_repo.__file__)
+    fd, filename = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    url = 'sqlite:///%s' % (filename,)
+    try:
+        versioning_api.version_control(url, repo_path)
+        versioning_api.upgrade(url, repo_path, 1)
+        engine = create_engine(url)
+        print "Populating %d servers..." % (servers,)
+        populate(engine, servers, servers_per_farm)
+        params = get_params(servers, servers_per_farm)
+
+        print "\nWithout indexes:"
+        report(engine, params)
+
+        versioning_api.upgrade(url, repo_path, 2)
+        engine.execute("ANALYZE")
+        print "\nWith indexes:"
+        report(engine, params)
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv)